@@ -6,7 +6,7 @@ import os
 import hashlib
 import bcrypt
 from dotenv import load_dotenv
-from fastapi import HTTPException, Depends
+from fastapi import HTTPException, Depends, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 load_dotenv()
@@ -72,12 +72,9 @@ def verify_token(token: str):
 # Security scheme for FastAPI
 security = HTTPBearer()
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """
-    Dependency function для проверки JWT токена в заголовке Authorization
-    """
+def decode_user_token(token: str) -> dict:
+    """Декодирует JWT токен в данные текущего пользователя"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         user_type: str = payload.get("type", "user")
@@ -94,4 +91,37 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             "role": role
         }
     except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Dependency function для проверки JWT токена в заголовке Authorization
+    """
+    return decode_user_token(credentials.credentials)
+
+# Cookie с токеном для медиафайлов и потока событий: <img>, <video> и EventSource не передают
+# заголовок Authorization, а токен в URL попадал бы в логи и ломал кэш браузера
+MEDIA_COOKIE = "media_token"
+
+def set_media_cookie(response: Response, token: str, secure: bool = False):
+    """Кладет токен в HttpOnly cookie, которым браузер авторизует загрузку медиа"""
+    response.set_cookie(
+        MEDIA_COOKIE,
+        token,
+        max_age=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        httponly=True,
+        secure=secure,
+        samesite="strict"
+    )
+
+def get_media_user(request: Request) -> dict:
+    """
+    Dependency function для медиафайлов и SSE: токен из заголовка Authorization или из cookie
+    """
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        token = request.cookies.get(MEDIA_COOKIE)
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return decode_user_token(token)
@@ -10,23 +10,28 @@ import logging
 import asyncio
 import sys
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 from datetime import datetime
 from dataclasses import dataclass
 from enum import Enum
-import requests
-import uuid
-import shutil
-from pathlib import Path
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, ContextTypes
+from telegram.error import TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, TypeHandler, filters, ConversationHandler, CallbackQueryHandler, ContextTypes
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import select
 
 # Импорт моделей БД из нашего проекта
 from database import ActiveTicket, User
+from events import publish_event_async, TICKET_CREATED
+from client_stats import upsert_client_async, record_ticket_created_async
+from conversation_store import conversation_store, ConversationPersistence, PersistentMapping, CONVERSATION_TTL
+from media_downloader import media_downloader
+from media_groups import MediaGroupCollector
+from message_writer import message_writer
+from ticket_index import active_tickets
+from webhook import webhook_dispatcher, webhook_enabled, webhook_secret, webhook_url
 
 # Настройка логирования
 logging.basicConfig(
@@ -56,6 +61,46 @@ class States(Enum):
     # Трудоустройство
     JOB_ABOUT = 40
 
+# Сколько обновлений бот обрабатывает одновременно (разных чатов)
+MAX_CONCURRENT_UPDATES = 64
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов
+    
+    Обновления одного чата выполняются строго по очереди, чтобы не ломать
+    ConversationHandler, а долгая обработка (скачивание медиа) в одном чате
+    не задерживает остальных клиентов.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+    
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        
+        lock = self._chat_locks.setdefault(chat.id, asyncio.Lock())
+        self._chat_waiters[chat.id] = self._chat_waiters.get(chat.id, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            self._chat_waiters[chat.id] -= 1
+            if not self._chat_waiters[chat.id]:
+                # Последний в очереди чата - освобождаем блокировку
+                del self._chat_waiters[chat.id]
+                del self._chat_locks[chat.id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
 @dataclass
 class TicketData:
     """Временное хранение данных тикета"""
@@ -63,6 +108,8 @@ class TicketData:
     user_id: int
     username: str
     data: Dict[str, Any]
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
 
 class ZAZABot:
     """Основной класс бота ZAZA"""
@@ -72,9 +119,15 @@ class ZAZABot:
         self.bot_id = bot_id
         self.application = None
         self.db_session = None
-        
-        # Временное хранение данных тикетов
-        self.ticket_data: Dict[int, TicketData] = {}
+        # Способ получения обновлений после запуска: webhook или polling
+        self.mode = None
+        # Альбомы клиентов, которые еще собираются
+        self.media_groups = MediaGroupCollector()
+        
+        # Данные создаваемых тикетов (сохраняются вместе с состоянием диалога)
+        self.ticket_data: PersistentMapping = PersistentMapping(
+            conversation_store, bot_id, "ticket_data", decode=lambda value: TicketData(**value)
+        )
         
         # Настройка БД
         self.setup_database()
@@ -84,81 +137,32 @@ class ZAZABot:
 
     def setup_database(self):
         """Настройка подключения к БД"""
-        # Используем ту же настройку, что и админка
-        from database import engine, SessionLocal
-        from sqlalchemy.orm import sessionmaker
+        # Асинхронные сессии: запрос не блокирует обработку остальных чатов.
+        # Пул общий для ботов процесса, его размер задается DB_POOL_SIZE процесса
+        from database import async_engine, AsyncSessionLocal
         
-        self.engine = engine
-        self.session_maker = SessionLocal
+        self.engine = async_engine
+        self.session_maker = AsyncSessionLocal
 
-    async def download_telegram_file(self, file_id: str, file_type: str) -> Optional[dict]:
-        """Скачивает файл из Telegram и сохраняет на сервере"""
-        try:
-            # Получаем информацию о файле
-            get_file_url = f"https://api.telegram.org/bot{self.bot_token}/getFile"
-            get_file_response = requests.get(get_file_url, params={"file_id": file_id})
-            
-            if get_file_response.status_code != 200:
-                logger.error(f"Ошибка получения информации о файле: {get_file_response.text}")
-                return None
-            
-            file_info = get_file_response.json()["result"]
-            file_path = file_info["file_path"]
-            file_size = file_info.get("file_size", 0)
-            
-            # Проверяем размер файла (Telegram Bot API ограничение 20 МБ)
-            max_size_mb = 20
-            max_size_bytes = max_size_mb * 1024 * 1024
-            
-            if file_size > max_size_bytes:
-                logger.warning(f"Файл слишком большой для скачивания: {file_size / (1024*1024):.1f} МБ (максимум {max_size_mb} МБ)")
-                return None
-            
-            # Создаем уникальное имя файла
-            file_extension = Path(file_path).suffix
-            unique_filename = f"{uuid.uuid4()}{file_extension}"
-            
-            # Определяем папку для сохранения
-            media_folder = {
-                "photo": "photos",
-                "video": "videos", 
-                "document": "documents"
-            }.get(file_type, "documents")
-            
-            # Создаем путь для сохранения в backend/media/
-            backend_dir = Path(__file__).parent  # Папка где находится bot.py
-            save_dir = backend_dir / "media" / media_folder
-            save_dir.mkdir(parents=True, exist_ok=True)
-            save_path = save_dir / unique_filename
-            
-            # Скачиваем файл
-            download_url = f"https://api.telegram.org/file/bot{self.bot_token}/{file_path}"
-            download_response = requests.get(download_url, stream=True)
-            
-            if download_response.status_code != 200:
-                logger.error(f"Ошибка скачивания файла: {download_response.text}")
-                return None
-            
-            # Сохраняем файл
-            with open(save_path, "wb") as f:
-                shutil.copyfileobj(download_response.raw, f)
-            
-            return {
-                "local_path": f"{media_folder}/{unique_filename}",  # Относительный путь от media/
-                "original_filename": Path(file_path).name,
-                "file_size": file_size
-            }
-            
-        except Exception as e:
-            logger.error(f"Исключение при скачивании файла: {e}")
-            return None
+    async def download_telegram_file(self, file_id: str, file_unique_id: Optional[str] = None) -> Optional[dict]:
+        """Скачивает файл из Telegram и сохраняет на сервере (не блокируя другие чаты бота)"""
+        return await media_downloader.download(self.bot_token, file_id, bot_key=self.bot_id, file_unique_id=file_unique_id)
 
     def setup_application(self):
         """Настройка Telegram Application"""
-        self.application = Application.builder().token(self.bot_token).build()
+        # Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+        # Состояния диалогов сохраняются в базу и восстанавливаются при запуске
+        self.application = Application.builder().token(self.bot_token).concurrent_updates(
+            PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES)
+        ).persistence(
+            ConversationPersistence(conversation_store, self.bot_id, States)
+        ).build()
+        
+        # Альбомы чата дообрабатываются до любого следующего обновления этого чата
+        self.application.add_handler(TypeHandler(Update, self.flush_media_groups), group=-1)
         
         # Основной conversation handler для создания тикетов
-        conversation_handler = ConversationHandler(
+        self.conversation_handler = conversation_handler = ConversationHandler(
             entry_points=[CommandHandler('start', self.start_command)],
             states={
                 States.CATEGORY_SELECTION: [
@@ -199,12 +203,20 @@ class ZAZABot:
                 States.JOB_ABOUT: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.job_about)
                 ],
+                # Клиент молчит дольше CONVERSATION_TTL
+                ConversationHandler.TIMEOUT: [
+                    TypeHandler(Update, self.conversation_timed_out)
+                ],
             },
             fallbacks=[
                 CommandHandler('start', self.start_command),
                 CommandHandler('cancel', self.cancel_command)
             ],
-            per_chat=True
+            per_chat=True,
+            name="ticket_flow",
+            persistent=True,
+            # Таймаут ставится в JobQueue; END по таймауту сохраняется через persistence
+            conversation_timeout=CONVERSATION_TTL
         )
         
         # Добавляем conversation handler с высоким приоритетом
@@ -216,6 +228,9 @@ class ZAZABot:
         self.application.add_handler(MessageHandler(filters.PHOTO, self.handle_ticket_message), group=1)
         self.application.add_handler(MessageHandler(filters.VIDEO, self.handle_ticket_message), group=1)
         self.application.add_handler(MessageHandler(filters.Document.ALL, self.handle_ticket_message), group=1)
+        
+        # После всех обработчиков сохраняем изменения ticket_data пользователя
+        self.application.add_handler(TypeHandler(Update, self.save_conversation_data), group=2)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Обработчик команды /start"""
@@ -248,7 +263,9 @@ class ZAZABot:
             category="",
             user_id=user.id,
             username=user.username or user.first_name,
-            data={}
+            data={},
+            first_name=user.first_name,
+            last_name=user.last_name
         )
         
         welcome_text = f"""
@@ -465,16 +482,27 @@ class ZAZABot:
         
         ticket_id = self.ticket_data[user_id].data.get('ticket_id')
         
-        # Сохраняем сообщение в БД
-        await self.save_ticket_message(ticket_id, user_id, update.message)
+        if update.message.media_group_id:
+            # Альбом: сохраним и ответим один раз, когда придут все его сообщения
+            self.media_groups.add(
+                update.message,
+                lambda messages: self.add_dispute_messages(ticket_id, user_id, messages)
+            )
+        else:
+            await self.add_dispute_messages(ticket_id, user_id, [update.message])
         
-        await update.message.reply_text(
-            f"✅ Сообщение добавлено к тикету #{ticket_id}\n\n"
+        return States.DISPUTE_MESSAGES
+    
+    async def add_dispute_messages(self, ticket_id: int, user_id: int, messages: list):
+        """Сохраняет сообщения диспута и подтверждает их клиенту одним ответом"""
+        await self.save_ticket_messages(ticket_id, user_id, messages)
+        
+        added = "Сообщение добавлено" if len(messages) == 1 else f"Сообщения ({len(messages)}) добавлены"
+        await messages[-1].reply_text(
+            f"✅ {added} к тикету #{ticket_id}\n\n"
             f"Продолжайте отправлять сообщения, фото или видео. "
             f"Когда закончите, отправьте команду /finish"
         )
-        
-        return States.DISPUTE_MESSAGES
     
     async def finish_dispute(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Завершение диспута"""
@@ -767,7 +795,7 @@ class ZAZABot:
     async def create_ticket(self, user_id: int, category: str) -> int:
         """Создание тикета в БД"""
         try:
-            with self.session_maker() as session:
+            async with self.session_maker() as session:
                 ticket_data = self.ticket_data[user_id]
                 
                 # Определяем тематику на русском языке
@@ -794,8 +822,19 @@ class ZAZABot:
                 )
                 
                 session.add(new_ticket)
-                session.commit()
-                session.refresh(new_ticket)
+                await session.flush()
+                # Клиент и его статистика обновляются в той же транзакции
+                await upsert_client_async(session, user_id, ticket_data.username, ticket_data.first_name, ticket_data.last_name)
+                await record_ticket_created_async(session, new_ticket)
+                await publish_event_async(session, TICKET_CREATED, {
+                    "ticket_id": new_ticket.id,
+                    "status": new_ticket.status,
+                    "bot_id": self.bot_id,
+                    "telegram_user_id": new_ticket.telegram_user_id,
+                    "courier_id": None
+                })
+                await session.commit()
+                active_tickets.add(user_id, new_ticket.id)
                 
                 logger.info(f"Создан новый тикет #{new_ticket.id} от пользователя {user_id} ({ticket_data.username})")
                 
@@ -806,97 +845,87 @@ class ZAZABot:
             return None
     
     async def check_existing_ticket(self, user_id: int) -> Optional[int]:
-        """Проверка наличия открытого тикета у пользователя"""
+        """Проверка наличия открытого тикета у пользователя (только статус "active")"""
         try:
-            with self.session_maker() as session:
-                # Ищем активные тикеты пользователя (только статус "active")
-                existing_ticket = session.query(ActiveTicket).filter(
-                    ActiveTicket.telegram_user_id == str(user_id),
-                    ActiveTicket.status == "active"
-                ).first()
-                
-                return existing_ticket.id if existing_ticket else None
-                
+            # Индекс в памяти, база - только пока индекс не загружен или после архивации
+            return await active_tickets.lookup(user_id)
         except Exception as e:
             logger.error(f"Ошибка проверки существующего тикета: {e}")
             return None
     
+    async def prepare_ticket_message(self, ticket_id: int, user_id: int, message) -> Tuple[dict, bool]:
+        """Скачивает вложение и готовит поля TicketMessage, второй элемент - не удалось скачать файл"""
+        file_download_failed = False
+        
+        # Определяем тип сообщения и контент
+        message_type = "text"
+        content = message.text or ""
+        attachment = None
+        file_id = None
+        file_info = None
+        
+        if message.photo:
+            message_type = "photo"
+            attachment = message.photo[-1]
+        elif message.video:
+            message_type = "video"
+            attachment = message.video
+        elif message.document:
+            message_type = "document"
+            attachment = message.document
+        if attachment is not None:
+            file_id = attachment.file_id
+        
+        if file_id:
+            content = message.caption or ""
+            # Скачиваем файл до записи в БД - соединение не держится на время загрузки
+            file_info = await self.download_telegram_file(file_id, attachment.file_unique_id)
+            if not file_info:
+                # Файл не удалось скачать (возможно, слишком большой)
+                file_download_failed = True
+        
+        local_file_path = file_info["local_path"] if file_info else None
+        original_filename = file_info["original_filename"] if file_info else None
+        file_size = file_info["file_size"] if file_info else None
+        if message.document:
+            original_filename = original_filename or message.document.file_name
+            file_size = file_size or message.document.file_size
+        
+        fields = {
+            "ticket_id": ticket_id,
+            "telegram_user_id": str(user_id),
+            "message_type": message_type,
+            "content": content,
+            "file_id": file_id,
+            "local_file_path": local_file_path,
+            "original_filename": original_filename,
+            "file_size": file_size,
+            "file_sha256": file_info["sha256"] if file_info else None,
+            "is_from_admin": False
+        }
+        return fields, file_download_failed
+    
     async def save_ticket_message(self, ticket_id: int, user_id: int, message):
         """Сохранение сообщения тикета в БД"""
+        return await self.save_ticket_messages(ticket_id, user_id, [message])
+    
+    async def save_ticket_messages(self, ticket_id: int, user_id: int, messages: list):
+        """Сохранение сообщений тикета (например, альбома) одной пачкой
+        
+        Вложения скачиваются параллельно, сообщения пишутся в исходном порядке
+        общей транзакцией; результат возвращается только после commit.
+        """
         file_download_failed = False
         try:
-            from database import TicketMessage
+            prepared = await asyncio.gather(*(
+                self.prepare_ticket_message(ticket_id, user_id, message) for message in messages
+            ))
+            file_download_failed = any(failed for _, failed in prepared)
             
-            with self.session_maker() as session:
-                # Определяем тип сообщения и контент
-                message_type = "text"
-                content = message.text or ""
-                file_id = None
-                local_file_path = None
-                original_filename = None
-                file_size = None
-                
-                if message.photo:
-                    message_type = "photo"
-                    file_id = message.photo[-1].file_id
-                    content = message.caption or ""
-                    
-                    # Скачиваем фото
-                    file_info = await self.download_telegram_file(file_id, "photo")
-                    if file_info:
-                        local_file_path = file_info["local_path"]
-                        original_filename = file_info["original_filename"]
-                        file_size = file_info["file_size"]
-                    else:
-                        file_download_failed = True
-                        
-                elif message.video:
-                    message_type = "video"
-                    file_id = message.video.file_id
-                    content = message.caption or ""
-                    
-                    # Скачиваем видео
-                    file_info = await self.download_telegram_file(file_id, "video")
-                    if file_info:
-                        local_file_path = file_info["local_path"]
-                        original_filename = file_info["original_filename"]
-                        file_size = file_info["file_size"]
-                    else:
-                        # Файл не удалось скачать (возможно, слишком большой)
-                        file_download_failed = True
-                        
-                elif message.document:
-                    message_type = "document"
-                    file_id = message.document.file_id
-                    content = message.caption or ""
-                    
-                    # Скачиваем документ
-                    file_info = await self.download_telegram_file(file_id, "document")
-                    if file_info:
-                        local_file_path = file_info["local_path"]
-                        original_filename = file_info["original_filename"] or message.document.file_name
-                        file_size = file_info["file_size"] or message.document.file_size
-                    else:
-                        file_download_failed = True
-                
-                # Создаем запись о сообщении
-                ticket_message = TicketMessage(
-                    ticket_id=ticket_id,
-                    telegram_user_id=str(user_id),
-                    message_type=message_type,
-                    content=content,
-                    file_id=file_id,
-                    local_file_path=local_file_path,
-                    original_filename=original_filename,
-                    file_size=file_size,
-                    is_from_admin=False
-                )
-                
-                session.add(ticket_message)
-                session.commit()
-                
-                logger.info(f"Сохранено сообщение для тикета #{ticket_id}")
-                return {"success": True, "file_download_failed": file_download_failed}
+            message_ids = await message_writer.write_many([fields for fields, _ in prepared])
+            
+            logger.info(f"Сохранено сообщений для тикета #{ticket_id}: {len(message_ids)}")
+            return {"success": True, "file_download_failed": file_download_failed}
                 
         except Exception as e:
             logger.error(f"Ошибка сохранения сообщения тикета: {e}")
@@ -905,19 +934,88 @@ class ZAZABot:
     # === ЗАПУСК И ОСТАНОВКА БОТА ===
     
     async def start_bot(self):
-        """Запуск бота"""
+        """Запуск бота: webhook, если он включен, иначе (или при ошибке) polling"""
         logger.info(f"Запуск бота с токеном {self.bot_token[:10]}...")
+        # Незавершенные диалоги: ticket_data здесь, состояния - в initialize() через persistence
+        await self.ticket_data.load()
         await self.application.initialize()
         await self.application.start()
+        # Индекс активных тикетов общий для ботов процесса и запускается один раз
+        active_tickets.start()
+        
+        if webhook_enabled() and self.bot_id is not None:
+            try:
+                await self.application.bot.set_webhook(
+                    url=webhook_url(self.bot_id),
+                    secret_token=webhook_secret(self.bot_id),
+                    allowed_updates=Update.ALL_TYPES
+                )
+                webhook_dispatcher.register(self.bot_id, self.application)
+                self.mode = "webhook"
+                logger.info(f"Бот {self.bot_id} получает обновления через webhook")
+                return
+            except TelegramError as e:
+                logger.warning(f"Не удалось установить webhook бота {self.bot_id}, используется polling: {e}")
+        
+        # start_polling сам снимает установленный ранее webhook
         await self.application.updater.start_polling()
+        self.mode = "polling"
 
-    async def stop_bot(self):
-        """Остановка бота"""
+    async def stop_bot(self, delete_webhook: bool = False):
+        """Остановка бота
+        
+        delete_webhook - снять webhook в Telegram (бот отключен в админке),
+        при обычной остановке процесса webhook остается и Telegram придержит обновления.
+        """
         logger.info("Остановка бота...")
-        await self.application.updater.stop()
-        await self.application.stop()
+        if self.bot_id is not None:
+            webhook_dispatcher.unregister(self.bot_id)
+        if self.application.updater and self.application.updater.running:
+            await self.application.updater.stop()
+        # Новых обновлений больше нет - дописываем и подтверждаем собранные альбомы
+        await self.media_groups.flush_all()
+        if delete_webhook and self.mode == "webhook":
+            try:
+                await self.application.bot.delete_webhook()
+            except TelegramError as e:
+                logger.warning(f"Не удалось снять webhook бота {self.bot_id}: {e}")
+        if self.application.running:
+            await self.application.stop()
         await self.application.shutdown()
     
+    def is_running(self) -> bool:
+        """Бот запущен и получает обновления"""
+        if not self.application.running:
+            return False
+        if self.mode == "polling":
+            return self.application.updater.running
+        return self.mode == "webhook"
+    
+    async def save_conversation_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сохраняет ticket_data пользователя и продлевает его диалог после обработки обновления"""
+        if update.effective_user is None:
+            return
+        try:
+            await self.ticket_data.save(update.effective_user.id)
+            if update.effective_chat is not None:
+                # Ключ диалога per_chat + per_user - (chat_id, user_id)
+                await self.application.persistence.touch_conversation(
+                    self.conversation_handler.name, (update.effective_chat.id, update.effective_user.id)
+                )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения данных диалога пользователя {update.effective_user.id}: {e}")
+    
+    async def conversation_timed_out(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Очищает данные тикета диалога, завершенного по неактивности"""
+        user_id = update.effective_user.id
+        if user_id in self.ticket_data:
+            del self.ticket_data[user_id]
+        try:
+            await self.ticket_data.save(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка удаления данных диалога пользователя {user_id}: {e}")
+        logger.info(f"Диалог пользователя {user_id} завершен по неактивности")
+    
     async def global_start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Глобальный обработчик команды /start - только для сброса состояния если пользователь не в ConversationHandler"""
         user_id = update.effective_user.id
@@ -951,24 +1049,14 @@ class ZAZABot:
         existing_ticket_id = await self.check_existing_ticket(user.id)
         
         if existing_ticket_id:
-            # Сохраняем сообщение в тикет
-            result = await self.save_ticket_message(existing_ticket_id, user.id, update.message)
-            
-            if result and result["success"]:
-                response_text = f"✅ Ваше сообщение добавлено к тикету #{existing_ticket_id}\n\n"
-                
-                if result["file_download_failed"]:
-                    response_text += "⚠️ Внимание: Файл слишком большой для автоматического сохранения (максимум 20 МБ).\n" \
-                                   
-                
-                response_text += "Администратор получил уведомление и ответит в ближайшее время."
-                
-                await update.message.reply_text(response_text)
-            else:
-                await update.message.reply_text(
-                    f"❌ Произошла ошибка при сохранении сообщения в тикет #{existing_ticket_id}\n\n"
-                    "Попробуйте отправить сообщение еще раз."
+            if update.message.media_group_id:
+                # Альбом: сохраним и ответим один раз, когда придут все его сообщения
+                self.media_groups.add(
+                    update.message,
+                    lambda messages: self.add_ticket_messages(existing_ticket_id, user.id, messages)
                 )
+            else:
+                await self.add_ticket_messages(existing_ticket_id, user.id, [update.message])
         else:
             # Если нет активного тикета, предлагаем создать новый
             await update.message.reply_text(
@@ -976,6 +1064,39 @@ class ZAZABot:
                 "Для создания нового обращения используйте команду /start"
             )
 
+    async def add_ticket_messages(self, ticket_id: int, user_id: int, messages: list):
+        """Сохраняет сообщения в открытый тикет и подтверждает их клиенту одним ответом"""
+        result = await self.save_ticket_messages(ticket_id, user_id, messages)
+        
+        if result and result["success"]:
+            if len(messages) == 1:
+                response_text = f"✅ Ваше сообщение добавлено к тикету #{ticket_id}\n\n"
+            else:
+                response_text = f"✅ Ваши сообщения ({len(messages)}) добавлены к тикету #{ticket_id}\n\n"
+            
+            if result["file_download_failed"]:
+                response_text += "⚠️ Внимание: Файл слишком большой для автоматического сохранения (максимум 20 МБ).\n"
+            
+            response_text += "Администратор получил уведомление и ответит в ближайшее время."
+            
+            await messages[-1].reply_text(response_text)
+        else:
+            await messages[-1].reply_text(
+                f"❌ Произошла ошибка при сохранении сообщения в тикет #{ticket_id}\n\n"
+                "Попробуйте отправить сообщение еще раз."
+            )
+    
+    async def flush_media_groups(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Перед следующим сообщением чата дообрабатываем его собранные альбомы, чтобы не нарушить порядок"""
+        chat = update.effective_chat
+        if chat is None:
+            return
+        message = update.effective_message
+        if message is not None and self.media_groups.is_pending(message.media_group_id):
+            # Очередное сообщение того же альбома
+            return
+        await self.media_groups.flush_chat(chat.id)
+
 # === ФУНКЦИИ ДЛЯ ЗАПУСКА БОТА ===
 
 async def run_bot_with_token(bot_token: str, bot_id: int = None):
@@ -8,14 +8,24 @@ ZAZA Bot Manager - Менеджер запуска ботов
 
 import asyncio
 import logging
+import queue
+import os
 import signal
 import sys
-from typing import Dict, List
-from sqlalchemy import select, create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import select
 
-from database import TelegramBot
+from database import TelegramBot, create_tables
+from client_stats import backfill_client_stats
+from events import PostgresEventListener, BOT_CHANGED
 from bot import ZAZABot
+from conversation_store import conversation_store, STALE_AFTER
+from message_writer import message_writer
+from media_store import media_store, GC_INTERVAL as MEDIA_GC_INTERVAL
+from media_previews import preview_generator
+from ticket_index import active_tickets
+from webhook import create_webhook_app, webhook_dispatcher, webhook_enabled, WEBHOOK_HOST, WEBHOOK_PORT
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,110 +38,150 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Сколько ботов запускается одновременно и сколько ждать запуска одного
+BOT_START_CONCURRENCY = int(os.getenv("BOT_START_CONCURRENCY", "10"))
+BOT_START_TIMEOUT = float(os.getenv("BOT_START_TIMEOUT", "30"))
+# Сверка запущенных ботов с БД на случай пропущенных событий bot.changed
+RECONCILE_INTERVAL = int(os.getenv("BOT_RECONCILE_INTERVAL", "300"))
+
 class BotManager:
-    """Менеджер для управления несколькими ботами"""
+    """Менеджер для управления несколькими ботами
+    
+    В многопроцессном режиме (см. bot_supervisor.py) менеджер воркера запускает
+    только ботов своего шарда (owns_bot), обновления webhook получает
+    от супервизора через очередь inbox, а готовность ботов отправляет
+    супервизору через status_queue (health отдает супервизор).
+    """
     
-    def __init__(self):
+    def __init__(self, owns_bot: Optional[Callable[[int], bool]] = None, inbox=None, status_queue=None):
+        self.owns_bot = owns_bot
+        self.inbox = inbox
+        self.status_queue = status_queue
         self.running_bots: Dict[int, ZAZABot] = {}
-        self.tasks: Dict[int, asyncio.Task] = {}
+        # Готовность ботов: starting / ready / failed, способ получения обновлений, ошибка
+        self.readiness: Dict[int, dict] = {}
+        self.start_semaphore = asyncio.Semaphore(BOT_START_CONCURRENCY)
+        self._bot_locks: Dict[int, asyncio.Lock] = {}
+        # Id ботов, измененных в админке (None - нужна полная сверка)
+        self._bot_events: asyncio.Queue = asyncio.Queue()
+        self._loop = None
+        self.events_listener = PostgresEventListener(self.handle_bus_event, on_connect=self.on_bus_connect)
         self.engine = None
         self.async_session = None
+        self.webhook_server = None
+        self.webhook_task = None
         self.setup_database()
         
     def setup_database(self):
         """Настройка подключения к БД"""
-        # Используем ту же настройку, что и админка
-        from database import engine
-        self.engine = engine
-        self.session_maker = sessionmaker(
-            bind=self.engine, expire_on_commit=False
-        )
+        # Асинхронный пул процесса, общий с ботами (размер - DB_POOL_SIZE)
+        from database import async_engine, AsyncSessionLocal
+        self.engine = async_engine
+        self.session_maker = AsyncSessionLocal
     
-    def load_active_bots(self) -> List[TelegramBot]:
-        """Загружает список активных ботов из БД"""
+    def _bot_columns(self):
+        # Менеджеру нужны только id, имя и токен - без загрузки ORM-объектов
+        return select(TelegramBot.id, TelegramBot.name, TelegramBot.token)
+    
+    async def load_active_bots(self) -> list:
+        """Загружает активных ботов шарда процесса одним запросом"""
         try:
-            with self.session_maker() as session:
-                # Сначала проверим всех ботов
-                all_query = select(TelegramBot)
-                all_result = session.execute(all_query)
-                all_bots = all_result.scalars().all()
-                logger.info(f"Всего ботов в БД: {len(all_bots)}")
-                
-                for bot in all_bots:
-                    try:
-                        bot_name = bot.name.encode('utf-8', errors='replace').decode('utf-8') if bot.name else "Unknown"
-                        logger.info(f"Бот: {bot_name}, Активен: {bot.is_active}, ID: {bot.id}")
-                    except Exception as e:
-                        logger.warning(f"Ошибка отображения имени бота ID {bot.id}: {e}")
-                
-                # Теперь получим только активных
-                query = select(TelegramBot).where(TelegramBot.is_active == True)
-                result = session.execute(query)
-                bots = result.scalars().all()
-                
-                logger.info(f"Найдено {len(bots)} активных ботов в БД")
-                return list(bots)  # Конвертируем в список
-                
+            async with self.session_maker() as session:
+                bots = (await session.execute(
+                    self._bot_columns().where(TelegramBot.is_active == True)
+                )).all()
+            if self.owns_bot is not None:
+                bots = [bot for bot in bots if self.owns_bot(bot.id)]
+            return list(bots)
         except Exception as e:
             logger.error(f"Ошибка загрузки ботов из БД: {e}")
             return []
     
-    async def start_bot_instance(self, bot_data: TelegramBot):
-        """Запускает экземпляр бота"""
-        try:
-            logger.info(f"Запуск бота '{bot_data.name}' (ID: {bot_data.id}, токен: {bot_data.token[:10]}...)")
-            
-            # Создаем экземпляр бота
-            bot_instance = ZAZABot(bot_data.token, bot_data.id)
-            self.running_bots[bot_data.id] = bot_instance
-            
-            # Запускаем бота
-            await bot_instance.start_bot()
-            
-        except Exception as e:
-            logger.error(f"Ошибка запуска бота {bot_data.name}: {e}")
-            if bot_data.id in self.running_bots:
-                del self.running_bots[bot_data.id]
+    async def load_bot(self, bot_id: int):
+        """Активный бот по id или None (бот удален или отключен)"""
+        async with self.session_maker() as session:
+            return (await session.execute(
+                self._bot_columns().where(TelegramBot.id == bot_id, TelegramBot.is_active == True)
+            )).first()
     
-    async def stop_bot_instance(self, bot_id: int):
+    async def start_bot_instance(self, bot_data: TelegramBot) -> bool:
+        """Запускает экземпляр бота и отмечает его готовность
+        
+        Бот готов, когда getMe прошел (initialize) и зарегистрирован
+        способ получения обновлений (polling или webhook).
+        """
+        async with self.start_semaphore:
+            started_at = time.monotonic()
+            self._set_readiness(bot_data.id, {"name": bot_data.name, "status": "starting"})
+            bot_instance = None
+            try:
+                logger.info(f"Запуск бота '{bot_data.name}' (ID: {bot_data.id}, токен: {bot_data.token[:10]}...)")
+                
+                # Создаем экземпляр бота
+                bot_instance = ZAZABot(bot_data.token, bot_data.id)
+                
+                # Запускаем бота
+                await asyncio.wait_for(bot_instance.start_bot(), timeout=BOT_START_TIMEOUT)
+                self.running_bots[bot_data.id] = bot_instance
+                
+                elapsed = time.monotonic() - started_at
+                self._set_readiness(bot_data.id, {
+                    "name": bot_data.name,
+                    "status": "ready",
+                    "username": bot_instance.application.bot.username,
+                    "mode": bot_instance.mode,
+                    "started_in": round(elapsed, 2)
+                })
+                logger.info(f"Бот '{bot_data.name}' (@{bot_instance.application.bot.username}) готов: {bot_instance.mode}, {elapsed:.1f} с")
+                return True
+                
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                logger.error(f"Ошибка запуска бота {bot_data.name}: {error}")
+                self._set_readiness(bot_data.id, {"name": bot_data.name, "status": "failed", "error": error})
+                if bot_instance is not None:
+                    # Освобождаем то, что успело запуститься (соединения, polling)
+                    try:
+                        await bot_instance.stop_bot()
+                    except Exception as stop_error:
+                        logger.warning(f"Ошибка очистки после неудачного запуска бота {bot_data.id}: {stop_error}")
+                return False
+    
+    async def stop_bot_instance(self, bot_id: int, delete_webhook: bool = False):
         """Останавливает экземпляр бота"""
         if bot_id in self.running_bots:
             try:
                 logger.info(f"Остановка бота ID: {bot_id}")
-                await self.running_bots[bot_id].stop_bot()
-                del self.running_bots[bot_id]
-                
-                if bot_id in self.tasks:
-                    self.tasks[bot_id].cancel()
-                    del self.tasks[bot_id]
-                    
+                await self.running_bots[bot_id].stop_bot(delete_webhook=delete_webhook)
             except Exception as e:
                 logger.error(f"Ошибка остановки бота {bot_id}: {e}")
+            finally:
+                self.running_bots.pop(bot_id, None)
+                self._set_readiness(bot_id, None)
+    
+    async def start_bots(self, bots: List[TelegramBot]):
+        """Запускает ботов параллельно (не больше BOT_START_CONCURRENCY одновременно)"""
+        if not bots:
+            return
+        started_at = time.monotonic()
+        # Через apply_bot под блокировкой бота: сверка после подключения LISTEN,
+        # идущая одновременно с первым запуском, не запустит бота второй раз
+        results = await asyncio.gather(*(self.apply_bot(bot_data.id, bot_data) for bot_data in bots))
+        failed = [bot_data.id for bot_data, ok in zip(bots, results) if not ok]
+        logger.info(
+            f"Запущено ботов: {len(bots) - len(failed)} из {len(bots)} за {time.monotonic() - started_at:.1f} с"
+            + (f", не запустились: {failed}" if failed else "")
+        )
     
     async def start_all_bots(self):
         """Запускает всех активных ботов"""
-        active_bots = self.load_active_bots()
+        active_bots = await self.load_active_bots()
         
         if not active_bots:
             logger.warning("Нет активных ботов для запуска!")
             return
         
-        # Запускаем каждого бота в отдельной задаче
-        for bot_data in active_bots:
-            try:
-                task = asyncio.create_task(
-                    self.start_bot_instance(bot_data),
-                    name=f"bot_{bot_data.id}_{bot_data.name}"
-                )
-                self.tasks[bot_data.id] = task
-                
-                # Даем время на запуск
-                await asyncio.sleep(2)
-                
-            except Exception as e:
-                logger.error(f"Ошибка создания задачи для бота {bot_data.name}: {e}")
-        
-        logger.info(f"Запущено {len(self.tasks)} ботов")
+        await self.start_bots(active_bots)
     
     async def stop_all_bots(self):
         """Останавливает всех ботов"""
@@ -145,45 +195,103 @@ class BotManager:
         if stop_tasks:
             await asyncio.gather(*stop_tasks, return_exceptions=True)
         
-        # Отменяем все задачи
-        for task in self.tasks.values():
-            if not task.done():
-                task.cancel()
-        
-        self.tasks.clear()
         self.running_bots.clear()
         
         logger.info("Все боты остановлены")
     
-    async def reload_bots(self):
-        """Перезагружает ботов (останавливает старых, запускает новых активных)"""
-        logger.info("Перезагрузка ботов...")
+    def _bot_lock(self, bot_id: int) -> asyncio.Lock:
+        lock = self._bot_locks.get(bot_id)
+        if lock is None:
+            lock = self._bot_locks[bot_id] = asyncio.Lock()
+        return lock
+    
+    async def apply_bot(self, bot_id: int, bot_data) -> bool:
+        """Приводит бота к состоянию в БД: bot_data - активный бот или None
         
-        # Получаем список активных ботов из БД
-        active_bots = self.load_active_bots()
+        Запускает новый или включенный бот, останавливает отключенный или удаленный,
+        перезапускает бот со сменившимся токеном. Возвращает False, если запуск не удался.
+        """
+        async with self._bot_lock(bot_id):
+            wanted = bot_data is not None and (self.owns_bot is None or self.owns_bot(bot_id))
+            running = self.running_bots.get(bot_id)
+            if running is not None and (not wanted or running.bot_token != bot_data.token):
+                # Бот отключен или сменил токен - снимаем webhook, чтобы Telegram не слал обновления в пустоту
+                await self.stop_bot_instance(bot_id, delete_webhook=True)
+                running = None
+            if not wanted:
+                self._set_readiness(bot_id, None)
+                return True
+            if running is None:
+                return await self.start_bot_instance(bot_data)
+            return True
+    
+    async def reload_bots(self):
+        """Сверяет запущенных ботов с БД (страховка на случай пропущенных событий)"""
+        active_bots = await self.load_active_bots()
         active_bot_ids = {bot.id for bot in active_bots}
-        current_bot_ids = set(self.running_bots.keys())
         
         # Останавливаем ботов, которые больше не активны
-        bots_to_stop = current_bot_ids - active_bot_ids
-        for bot_id in bots_to_stop:
-            await self.stop_bot_instance(bot_id)
+        for bot_id in set(self.running_bots) - active_bot_ids:
+            await self.apply_bot(bot_id, None)
         
-        # Запускаем новых активных ботов
-        bots_to_start = active_bot_ids - current_bot_ids
-        for bot_data in active_bots:
-            if bot_data.id in bots_to_start:
-                try:
-                    task = asyncio.create_task(
-                        self.start_bot_instance(bot_data),
-                        name=f"bot_{bot_data.id}_{bot_data.name}"
-                    )
-                    self.tasks[bot_data.id] = task
-                    await asyncio.sleep(2)
-                except Exception as e:
-                    logger.error(f"Ошибка запуска нового бота {bot_data.name}: {e}")
-        
-        logger.info(f"Перезагрузка завершена. Активных ботов: {len(self.running_bots)}")
+        # Запускаем новых и не запустившихся раньше, перезапускаем сменивших токен
+        changed = [
+            bot for bot in active_bots
+            if bot.id not in self.running_bots or self.running_bots[bot.id].bot_token != bot.token
+        ]
+        if changed:
+            logger.info(f"Сверка с БД: запуск или перезапуск ботов {[bot.id for bot in changed]}")
+            await asyncio.gather(*(self.apply_bot(bot.id, bot) for bot in changed))
+    
+    def handle_bus_event(self, event: dict):
+        """Событие из LISTEN (поток слушателя): изменения ботов и тикетов"""
+        if event.get("type") == BOT_CHANGED:
+            bot_id = event.get("bot_id")
+            if bot_id is not None and self._loop is not None:
+                self._loop.call_soon_threadsafe(self._bot_events.put_nowait, bot_id)
+            return
+        active_tickets.handle_event(event)
+    
+    def on_bus_connect(self):
+        """После (пере)подключения LISTEN: события могли быть пропущены"""
+        active_tickets.warm()
+        if self._loop is not None:
+            # None в очереди - полная сверка с БД
+            self._loop.call_soon_threadsafe(self._bot_events.put_nowait, None)
+    
+    async def consume_bot_events(self):
+        """Применяет изменения ботов из админки сразу, без ожидания сверки"""
+        while True:
+            bot_id = await self._bot_events.get()
+            try:
+                if bot_id is None:
+                    await self.reload_bots()
+                    continue
+                if self.owns_bot is not None and not self.owns_bot(bot_id):
+                    continue
+                bot_data = await self.load_bot(bot_id)
+                logger.info(f"Бот {bot_id} изменен в админке: {'активен' if bot_data else 'отключен или удален'}")
+                await self.apply_bot(bot_id, bot_data)
+            except Exception as e:
+                logger.error(f"Ошибка применения изменений бота {bot_id}: {e}")
+    
+    def status(self) -> dict:
+        """Готовность ботов процесса по id"""
+        return {bot_id: dict(state) for bot_id, state in sorted(self.readiness.items())}
+    
+    def _set_readiness(self, bot_id: int, state: Optional[dict]):
+        """Меняет готовность бота (None - бот не должен работать) и сообщает супервизору"""
+        if state is None:
+            if self.readiness.pop(bot_id, None) is None:
+                return
+        else:
+            self.readiness[bot_id] = state
+        if self.status_queue is not None:
+            try:
+                self.status_queue.put_nowait(self.status())
+            except queue.Full:
+                # Супервизор получит следующий снимок
+                logger.warning("Очередь статуса супервизора переполнена")
     
     async def monitor_bots(self):
         """Мониторинг состояния ботов"""
@@ -192,41 +300,107 @@ class BotManager:
                 # Проверяем каждые 30 секунд
                 await asyncio.sleep(30)
                 
-                # Проверяем статус задач
-                dead_tasks = []
-                for bot_id, task in self.tasks.items():
-                    if task.done():
-                        dead_tasks.append(bot_id)
-                        if task.exception():
-                            logger.error(f"Бот {bot_id} завершился с ошибкой: {task.exception()}")
-                        else:
-                            logger.warning(f"Бот {bot_id} завершился без ошибок")
+                # Бот, у которого остановились Application или polling, перезапускается сразу через apply_bot
+                for bot_id, bot_instance in list(self.running_bots.items()):
+                    if not bot_instance.is_running():
+                        logger.error(f"Бот {bot_id} перестал получать обновления, будет перезапущен")
+                        await self.stop_bot_instance(bot_id)
+                        self._bot_events.put_nowait(bot_id)
                 
-                # Удаляем мертвые задачи
-                for bot_id in dead_tasks:
-                    if bot_id in self.tasks:
-                        del self.tasks[bot_id]
-                    if bot_id in self.running_bots:
-                        del self.running_bots[bot_id]
+                # Диалоги завершает conversation_timeout, здесь удаляются записи, оставшиеся
+                # без таймаута (процесс перезапускался, бот удален или переехал)
+                removed = await conversation_store.evict(STALE_AFTER)
+                if removed:
+                    logger.info(f"Удалено брошенных диалогов из хранилища: {removed}")
                 
-                # Перезагружаем ботов раз в 5 минут
+                # Изменения ботов приходят событиями, сверка с БД - редкая страховка
                 current_time = asyncio.get_event_loop().time()
-                if not hasattr(self, 'last_reload') or (current_time - self.last_reload) > 300:
+                if not hasattr(self, 'last_reload') or (current_time - self.last_reload) > RECONCILE_INTERVAL:
                     await self.reload_bots()
                     self.last_reload = current_time
+                
+                # Удаляем медиафайлы, на которые не осталось ссылок из сообщений
+                if not hasattr(self, 'last_media_gc') or (current_time - self.last_media_gc) > MEDIA_GC_INTERVAL:
+                    self.last_media_gc = current_time
+                    await media_store.collect_garbage()
+                
+                # Доделываем превью, прерванные перезапуском процессов
+                await preview_generator.generate_pending()
                     
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"Ошибка мониторинга: {e}")
     
+    async def start_webhook_server(self):
+        """Запускает HTTP endpoint для обновлений всех ботов (режим webhook)"""
+        import uvicorn
+        
+        config = uvicorn.Config(
+            create_webhook_app(webhook_dispatcher),
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            proxy_headers=True,
+            log_level="warning"
+        )
+        self.webhook_server = uvicorn.Server(config)
+        # Сигналы обрабатывает менеджер, а не uvicorn
+        self.webhook_server.install_signal_handlers = lambda: None
+        self.webhook_task = asyncio.create_task(self.webhook_server.serve(), name="webhook_server")
+        logger.info(f"{'Webhook endpoint' if webhook_enabled() else 'Health endpoint'} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    
+    async def consume_inbox(self):
+        """Передает ботам обновления webhook, принятые супервизором"""
+        while True:
+            try:
+                # Таймаут, чтобы поток не висел в get() после остановки менеджера
+                item = await asyncio.to_thread(self.inbox.get, True, 1.0)
+            except queue.Empty:
+                continue
+            bot_id, data = item
+            try:
+                if not await webhook_dispatcher.deliver(bot_id, data):
+                    logger.warning(f"Обновление для бота {bot_id}, который не запущен в этом процессе, пропущено")
+            except Exception as e:
+                logger.error(f"Ошибка передачи обновления боту {bot_id}: {e}")
+    
+    async def stop_webhook_server(self):
+        """Останавливает HTTP endpoint webhook"""
+        if self.webhook_server is None:
+            return
+        self.webhook_server.should_exit = True
+        try:
+            await self.webhook_task
+        except Exception as e:
+            logger.error(f"Ошибка остановки webhook endpoint: {e}")
+        self.webhook_server = None
+        self.webhook_task = None
+    
     async def run(self):
         """Основной цикл работы менеджера"""
         logger.info("🤖 ZAZA Bot Manager запущен")
+        inbox_task = None
+        events_task = None
+        self._loop = asyncio.get_running_loop()
         
         try:
+            # Одно LISTEN-соединение на процесс: изменения ботов и индекс активных тикетов
+            events_task = asyncio.create_task(self.consume_bot_events(), name="bot_events")
+            active_tickets.start(self.events_listener)
+            self.events_listener.start()
+            
+            # Endpoint поднимается до ботов: setWebhook сразу начинает доставку.
+            # В режиме polling он отдает только health с готовностью ботов.
+            # В воркере супервизора endpoint общий, обновления приходят через inbox
+            if self.inbox is not None:
+                inbox_task = asyncio.create_task(self.consume_inbox(), name="webhook_inbox")
+            if self.status_queue is None:
+                webhook_dispatcher.status_provider = self.status
+                await self.start_webhook_server()
+            
             # Запускаем всех ботов
             await self.start_all_bots()
+            self.last_reload = asyncio.get_event_loop().time()
             
             # Запускаем мониторинг
             monitor_task = asyncio.create_task(self.monitor_bots())
@@ -240,8 +414,17 @@ class BotManager:
             logger.error(f"Критическая ошибка: {e}")
         finally:
             await self.stop_all_bots()
+            # Дописываем сообщения, принятые до остановки ботов
+            await message_writer.close()
+            await preview_generator.close()
+            await self.stop_webhook_server()
+            if inbox_task:
+                inbox_task.cancel()
+            if events_task:
+                events_task.cancel()
+            await asyncio.to_thread(active_tickets.stop)
             if self.engine:
-                self.engine.dispose()
+                await self.engine.dispose()
 
 # Глобальная переменная для менеджера
 bot_manager = None
@@ -253,7 +436,7 @@ def signal_handler(signum, frame):
         asyncio.create_task(bot_manager.stop_all_bots())
     sys.exit(0)
 
-async def main():
+async def main(owns_bot: Optional[Callable[[int], bool]] = None, inbox=None, status_queue=None):
     """Основная функция"""
     global bot_manager
     
@@ -262,7 +445,7 @@ async def main():
     signal.signal(signal.SIGTERM, signal_handler)
     
     try:
-        bot_manager = BotManager()
+        bot_manager = BotManager(owns_bot=owns_bot, inbox=inbox, status_queue=status_queue)
         await bot_manager.run()
     except Exception as e:
         logger.error(f"Ошибка запуска менеджера: {e}")
@@ -272,7 +455,15 @@ if __name__ == "__main__":
     print("📋 Загрузка активных ботов из базы данных...")
     
     try:
-        asyncio.run(main())
+        # Схема и статистика клиентов обновляются один раз до запуска воркеров
+        create_tables()
+        backfill_client_stats()
+        from bot_supervisor import BOT_WORKERS, run_supervisor
+        if BOT_WORKERS > 1:
+            # Боты распределяются по процессам-воркерам
+            run_supervisor(BOT_WORKERS)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n👋 Bot Manager остановлен пользователем")
     except Exception as e:
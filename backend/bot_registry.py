@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Bot Registry - Кэш ботов процесса для исходящих запросов
+По bot_id отдает токен и клиент Bot API без запроса к базе на каждую отправку.
+Сбрасывается эндпоинтами управления ботами (и событием bot.changed из других процессов).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, NamedTuple, Optional
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal, TelegramBot
+from telegram_api import telegram_clients, TelegramBotClient
+
+logger = logging.getLogger(__name__)
+
+class BotEntry(NamedTuple):
+    id: int
+    name: str
+    token: str
+    is_active: bool
+
+    @property
+    def client(self) -> TelegramBotClient:
+        """Keep-alive клиент Bot API этого бота"""
+        return telegram_clients.get(self.token)
+
+class BotRegistry:
+    """Боты по id: все загружаются одним запросом и живут до инвалидации"""
+
+    def __init__(self, ttl: float = 300.0, session_factory=AsyncSessionLocal):
+        # TTL - страховка на случай пропущенной инвалидации из другого процесса
+        self.ttl = ttl
+        self.session_factory = session_factory
+        self._bots: Dict[int, BotEntry] = {}
+        self._loaded_at: Optional[float] = None
+        self._stale = True
+        self._lock: Optional[asyncio.Lock] = None
+
+    def invalidate(self):
+        """Помечает кэш устаревшим (можно вызывать из любого потока)"""
+        self._stale = True
+
+    async def _ensure_loaded(self):
+        if not self._stale and self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._stale and self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            # Сбрасываем до загрузки: инвалидация, пришедшая во время запроса, не потеряется
+            self._stale = False
+            try:
+                async with self.session_factory() as db:
+                    rows = (await db.execute(
+                        select(TelegramBot.id, TelegramBot.name, TelegramBot.token, TelegramBot.is_active)
+                    )).all()
+            except BaseException:
+                # Загрузка не удалась - кэш по-прежнему устаревший
+                self._stale = True
+                raise
+            bots = {row.id: BotEntry(row.id, row.name, row.token, bool(row.is_active)) for row in rows}
+
+            # Закрываем соединения ботов, чей токен сменился или которые удалены
+            tokens = {bot.token for bot in bots.values()}
+            for old in self._bots.values():
+                if old.token not in tokens:
+                    await telegram_clients.discard(old.token)
+
+            self._bots = bots
+            self._loaded_at = time.monotonic()
+
+    async def get(self, bot_id: int) -> Optional[BotEntry]:
+        """Бот по id (в том числе неактивный) или None"""
+        await self._ensure_loaded()
+        return self._bots.get(bot_id)
+
+    async def resolve(self, bot_id: Optional[int]) -> Optional[BotEntry]:
+        """Бот для исходящего запроса по тикету
+
+        Сообщения идут через бота, которому клиент писал (bot_id тикета).
+        Для старых тикетов без bot_id используется первый активный бот.
+        """
+        await self._ensure_loaded()
+        if bot_id is not None:
+            bot = self._bots.get(bot_id)
+            if bot is None:
+                logger.error(f"Бот {bot_id} не найден")
+            return bot
+        active = sorted((bot for bot in self._bots.values() if bot.is_active), key=lambda bot: bot.id)
+        return active[0] if active else None
+
+# Реестр процесса
+bot_registry = BotRegistry()
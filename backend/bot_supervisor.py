@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Bot Supervisor - Запуск ботов в нескольких процессах
+Боты распределяются по BOT_WORKERS процессам-воркерам консистентным хэшированием
+по id бота: каждый воркер - обычный BotManager, который запускает только ботов
+своего шарда и сам подхватывает добавленных/отключенных при перезагрузке.
+Упавший воркер перезапускается с нарастающей паузой, остальные продолжают работу.
+В режиме webhook общий endpoint держит супервизор и передает обновление
+воркеру-владельцу бота через очередь. Воркеры присылают супервизору
+готовность своих ботов, и health супервизора показывает ее в любом режиме.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Dict, Iterable, Optional
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from webhook import (
+    create_webhook_app, webhook_enabled, WebhookDispatcher, WebhookOverloaded,
+    WEBHOOK_HOST, WEBHOOK_PORT
+)
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Виртуальных узлов на воркер: чем больше, тем ровнее распределение ботов
+RING_REPLICAS = 64
+# Обновлений webhook в очереди одного воркера (пока он, например, перезапускается)
+INBOX_SIZE = 10000
+# Снимков готовности ботов в очереди одного воркера
+STATUS_QUEUE_SIZE = 100
+
+CHECK_INTERVAL = 2
+MAX_RESTART_DELAY = 60
+# Воркер, проработавший дольше, считается стабильным - пауза перезапуска сбрасывается
+STABLE_SECONDS = 60
+STOP_TIMEOUT = 20
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """Кольцо консистентного хэширования: бот -> номер воркера
+
+    При изменении числа воркеров переезжает лишь ~1/N ботов.
+    """
+
+    def __init__(self, nodes: Iterable[int], replicas: int = RING_REPLICAS):
+        ring = sorted((_hash(f"worker:{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [key for key, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def node_for(self, bot_id: int) -> int:
+        index = bisect.bisect(self._keys, _hash(f"bot:{bot_id}")) % len(self._keys)
+        return self._nodes[index]
+
+def run_worker(index: int, count: int, inbox, status_queue):
+    """Точка входа процесса-воркера"""
+    # Импорт здесь: в процессе супервизора менеджер ботов не нужен
+    import bot_manager
+
+    ring = HashRing(range(count))
+    logger.info(f"Воркер {index + 1}/{count} запущен (pid {os.getpid()})")
+    asyncio.run(bot_manager.main(
+        owns_bot=lambda bot_id: ring.node_for(bot_id) == index, inbox=inbox, status_queue=status_queue
+    ))
+
+class ShardRouter(WebhookDispatcher):
+    """Webhook супервизора: обновление уходит в очередь воркера-владельца бота"""
+
+    def __init__(self, supervisor: "BotSupervisor"):
+        super().__init__()
+        self.supervisor = supervisor
+
+    async def deliver(self, bot_id: int, data: dict) -> bool:
+        inbox = self.supervisor.inboxes[self.supervisor.ring.node_for(bot_id)]
+        if inbox is None:
+            # Режим polling: endpoint отдает только health
+            return False
+        try:
+            inbox.put_nowait((bot_id, data))
+        except queue.Full:
+            raise WebhookOverloaded("очередь воркера переполнена")
+        return True
+
+    async def health(self, request: Request) -> Response:
+        return JSONResponse({
+            "status": "ok",
+            "workers": self.supervisor.status(),
+            "readiness": self.supervisor.readiness_status()
+        })
+
+class BotSupervisor:
+    """Держит запущенными процессы-воркеры ботов"""
+
+    def __init__(self, workers: int):
+        self.count = workers
+        self.ring = HashRing(range(workers))
+        # spawn: у воркера свои соединения с БД и свой event loop
+        self._context = multiprocessing.get_context("spawn")
+        self.webhook = webhook_enabled()
+        self.inboxes = [self._context.Queue(INBOX_SIZE) if self.webhook else None for _ in range(workers)]
+        self.status_queues = [self._context.Queue(STATUS_QUEUE_SIZE) for _ in range(workers)]
+        # Последний снимок готовности ботов от каждого воркера
+        self.readiness: Dict[int, dict] = {}
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started_at: Dict[int, float] = {}
+        self.restart_delay: Dict[int, float] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.restarts: Dict[int, int] = {}
+        self.webhook_server = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def start_worker(self, index: int):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.count, self.inboxes[index], self.status_queues[index]),
+            name=f"bot-worker-{index}",
+            daemon=False
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Воркер {index} запущен (pid {process.pid})")
+
+    def collect_readiness(self):
+        """Забирает из очередей воркеров последние снимки готовности ботов"""
+        for index, status_queue in enumerate(self.status_queues):
+            while True:
+                try:
+                    self.readiness[index] = status_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+    def readiness_status(self) -> dict:
+        """Готовность ботов всех воркеров по id бота"""
+        return {
+            bot_id: {**state, "worker": index}
+            for index, bots in sorted(self.readiness.items())
+            for bot_id, state in bots.items()
+        }
+
+    def check_workers(self):
+        """Перезапускает упавших воркеров с нарастающей паузой"""
+        self.collect_readiness()
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            # Боты упавшего воркера не работают до его перезапуска
+            self.readiness.pop(index, None)
+
+            if index not in self.restart_at:
+                uptime = now - self.started_at[index]
+                delay = self.restart_delay.get(index, 0)
+                delay = 1 if uptime > STABLE_SECONDS else min(max(delay * 2, 1), MAX_RESTART_DELAY)
+                self.restart_delay[index] = delay
+                self.restart_at[index] = now + delay
+                logger.error(
+                    f"Воркер {index} завершился с кодом {process.exitcode} "
+                    f"через {uptime:.0f} с, перезапуск через {delay} с"
+                )
+
+            if now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.restarts[index] = self.restarts.get(index, 0) + 1
+                self.start_worker(index)
+
+    def status(self) -> list:
+        return [
+            {
+                "worker": index,
+                "pid": process.pid,
+                "alive": process.is_alive(),
+                "restarts": self.restarts.get(index, 0)
+            }
+            for index, process in sorted(self.processes.items())
+        ]
+
+    async def start_webhook_server(self):
+        import uvicorn
+
+        config = uvicorn.Config(
+            create_webhook_app(ShardRouter(self)),
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            proxy_headers=True,
+            log_level="warning"
+        )
+        self.webhook_server = uvicorn.Server(config)
+        # Сигналы обрабатывает супервизор, а не uvicorn
+        self.webhook_server.install_signal_handlers = lambda: None
+        self.webhook_task = asyncio.create_task(self.webhook_server.serve(), name="webhook_server")
+        logger.info(f"{'Webhook endpoint' if self.webhook else 'Health endpoint'} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+    def stop_workers(self):
+        """Останавливает воркеров: SIGTERM, по таймауту - SIGKILL"""
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for index, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Воркер {index} не остановился за {STOP_TIMEOUT} с, принудительное завершение")
+                process.kill()
+                process.join()
+
+    async def run(self):
+        logger.info(f"🤖 ZAZA Bot Supervisor: {self.count} воркеров")
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        try:
+            # Endpoint нужен и в режиме polling - для health с готовностью ботов
+            await self.start_webhook_server()
+            for index in range(self.count):
+                self.start_worker(index)
+
+            while not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    self.check_workers()
+        finally:
+            logger.info("Остановка воркеров...")
+            await asyncio.to_thread(self.stop_workers)
+            if self.webhook_server is not None:
+                self.webhook_server.should_exit = True
+                await self.webhook_task
+            logger.info("Все воркеры остановлены")
+
+def run_supervisor(workers: int = BOT_WORKERS):
+    """Запускает супервизор с заданным числом воркеров"""
+    asyncio.run(BotSupervisor(workers).run())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Client Stats - Учет клиентов и статистики их тикетов
+Клиенты создаются при поступлении тикетов, счетчики обновляются инкрементально,
+чтобы список клиентов строился одним запросом без подсчетов на лету.
+
+Статистика по тикетам, созданным до появления учета, заполняется автоматически
+при старте API и менеджера ботов (backfill_client_stats). Полный пересчет вручную:
+    python client_stats.py
+"""
+
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from database import SessionLocal, ActiveTicket, Client, ClientStats, ClientTicketRollup
+
+logger = logging.getLogger(__name__)
+
+# Поля тикета, по которым ведется разбивка количества тикетов клиента
+ROLLUP_DIMENSIONS = ("status", "category", "resolution")
+# Ключ advisory lock: пересчет при старте выполняет только один процесс
+BACKFILL_LOCK_KEY = 0x5A5A0002
+
+def _upsert_client_statement(telegram_user_id: str, telegram_username: Optional[str] = None,
+                             first_name: Optional[str] = None, last_name: Optional[str] = None):
+    values = {"telegram_user_id": str(telegram_user_id), "is_blocked": False}
+    updates = {"updated_at": datetime.utcnow()}
+    for field, value in (("telegram_username", telegram_username), ("first_name", first_name), ("last_name", last_name)):
+        if value:
+            values[field] = value
+            updates[field] = value
+
+    statement = insert(Client).values(**values, created_at=datetime.utcnow(), updated_at=datetime.utcnow())
+    return statement.on_conflict_do_update(index_elements=[Client.telegram_user_id], set_=updates)
+
+def upsert_client(db, telegram_user_id: str, telegram_username: Optional[str] = None,
+                  first_name: Optional[str] = None, last_name: Optional[str] = None):
+    """Создает клиента или обновляет его имя (без отдельного SELECT)"""
+    db.execute(_upsert_client_statement(telegram_user_id, telegram_username, first_name, last_name))
+
+async def upsert_client_async(db, telegram_user_id: str, telegram_username: Optional[str] = None,
+                              first_name: Optional[str] = None, last_name: Optional[str] = None):
+    """То же, что upsert_client, для AsyncSession"""
+    await db.execute(_upsert_client_statement(telegram_user_id, telegram_username, first_name, last_name))
+
+def _rollup_bump_statement(telegram_user_id: str, dimension: str, value: str, delta: int):
+    statement = insert(ClientTicketRollup).values(
+        telegram_user_id=telegram_user_id,
+        dimension=dimension,
+        value=value,
+        tickets_count=delta
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[ClientTicketRollup.telegram_user_id, ClientTicketRollup.dimension, ClientTicketRollup.value],
+        set_={"tickets_count": ClientTicketRollup.tickets_count + delta}
+    )
+
+def _ticket_created_statements(ticket: ActiveTicket):
+    """Инкременты статистики клиента для нового тикета"""
+    telegram_user_id = str(ticket.telegram_user_id)
+    now = ticket.created_at or datetime.utcnow()
+
+    statement = insert(ClientStats).values(telegram_user_id=telegram_user_id, tickets_count=1, last_activity_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ClientStats.telegram_user_id],
+        set_={
+            "tickets_count": ClientStats.tickets_count + 1,
+            "last_activity_at": func.greatest(ClientStats.last_activity_at, statement.excluded.last_activity_at)
+        }
+    )
+    yield statement
+
+    # Значения по умолчанию колонок еще не применены до flush - учитываем их явно
+    defaults = {"status": "active", "resolution": "in_work"}
+    for dimension in ROLLUP_DIMENSIONS:
+        value = getattr(ticket, dimension) or defaults.get(dimension)
+        if value is not None:
+            yield _rollup_bump_statement(telegram_user_id, dimension, value, 1)
+
+def record_ticket_created(db, ticket: ActiveTicket):
+    """Учитывает новый тикет в статистике клиента (в транзакции создания тикета)"""
+    for statement in _ticket_created_statements(ticket):
+        db.execute(statement)
+
+async def record_ticket_created_async(db, ticket: ActiveTicket):
+    """То же, что record_ticket_created, для AsyncSession"""
+    for statement in _ticket_created_statements(ticket):
+        await db.execute(statement)
+
+def _changed_rollups(telegram_user_id: str, old_values: dict, new_values: dict):
+    """Инкременты сводных таблиц при смене значений измерений тикета"""
+    for dimension in ROLLUP_DIMENSIONS:
+        if dimension not in old_values or dimension not in new_values:
+            continue
+        old_value, new_value = old_values[dimension], new_values[dimension]
+        if old_value == new_value:
+            continue
+        for value, delta in ((old_value, -1), (new_value, 1)):
+            if value is not None:
+                yield _rollup_bump_statement(str(telegram_user_id), dimension, value, delta)
+
+def record_ticket_changed(db, telegram_user_id: str, old_values: dict, new_values: dict):
+    """Переносит тикет между значениями измерений при смене статуса или решения"""
+    for statement in _changed_rollups(telegram_user_id, old_values, new_values):
+        db.execute(statement)
+
+async def record_ticket_changed_async(db, telegram_user_id: str, old_values: dict, new_values: dict):
+    """То же, что record_ticket_changed, для AsyncSession"""
+    for statement in _changed_rollups(telegram_user_id, old_values, new_values):
+        await db.execute(statement)
+
+def _touch_statement(telegram_user_id: str, at: Optional[datetime] = None):
+    return update(ClientStats).where(ClientStats.telegram_user_id == str(telegram_user_id)).values(
+        last_activity_at=at or datetime.utcnow()
+    )
+
+def touch_client_activity(db, telegram_user_id: str, at: Optional[datetime] = None):
+    """Обновляет время последней активности клиента (новое сообщение)"""
+    db.execute(_touch_statement(telegram_user_id, at))
+
+async def touch_client_activity_async(db, telegram_user_id: str, at: Optional[datetime] = None):
+    """То же, что touch_client_activity, для AsyncSession"""
+    await db.execute(_touch_statement(telegram_user_id, at))
+
+def _client_stats_statement(telegram_user_id: str):
+    return select(ClientStats.tickets_count).where(ClientStats.telegram_user_id == telegram_user_id)
+
+def _rollup_statement(telegram_user_id: str):
+    return select(
+        ClientTicketRollup.dimension,
+        ClientTicketRollup.value,
+        ClientTicketRollup.tickets_count
+    ).where(
+        ClientTicketRollup.telegram_user_id == telegram_user_id,
+        ClientTicketRollup.tickets_count > 0
+    )
+
+def _grouped_tickets_statement(telegram_user_id: str):
+    return select(
+        ActiveTicket.category,
+        ActiveTicket.resolution,
+        func.count(ActiveTicket.id)
+    ).where(ActiveTicket.telegram_user_id == telegram_user_id).group_by(ActiveTicket.category, ActiveTicket.resolution)
+
+def _rollup_breakdown(rows, total):
+    breakdown = {dimension: {} for dimension in ROLLUP_DIMENSIONS}
+    for dimension, value, count in rows:
+        breakdown.setdefault(dimension, {})[value] = count
+    return breakdown["category"], breakdown["resolution"], total
+
+def _grouped_breakdown(rows):
+    categories, resolutions, total = {}, {}, 0
+    for category, resolution, count in rows:
+        total += count
+        if category:
+            categories[category] = categories.get(category, 0) + count
+        if resolution:
+            resolutions[resolution] = resolutions.get(resolution, 0) + count
+    return categories, resolutions, total
+
+def get_client_breakdown(db, telegram_user_id: str):
+    """Статистика тикетов клиента по категориям и решениям
+
+    Читается из сводных таблиц; если их еще не пересчитали для клиента,
+    считается одним GROUP BY по тикетам.
+    Возвращает (categories, resolutions, total_tickets).
+    """
+    telegram_user_id = str(telegram_user_id)
+    stats = db.execute(_client_stats_statement(telegram_user_id)).scalar()
+    if stats is not None:
+        return _rollup_breakdown(db.execute(_rollup_statement(telegram_user_id)).all(), stats)
+    return _grouped_breakdown(db.execute(_grouped_tickets_statement(telegram_user_id)).all())
+
+async def get_client_breakdown_async(db, telegram_user_id: str):
+    """То же, что get_client_breakdown, для AsyncSession"""
+    telegram_user_id = str(telegram_user_id)
+    stats = (await db.execute(_client_stats_statement(telegram_user_id))).scalar()
+    if stats is not None:
+        rows = (await db.execute(_rollup_statement(telegram_user_id))).all()
+        return _rollup_breakdown(rows, stats)
+    rows = (await db.execute(_grouped_tickets_statement(telegram_user_id))).all()
+    return _grouped_breakdown(rows)
+
+def rebuild_client_stats(db):
+    """Полностью пересчитывает клиентов и статистику по таблице тикетов"""
+    # Клиенты, которых еще нет в таблице clients
+    clients = db.query(
+        ActiveTicket.telegram_user_id,
+        func.max(ActiveTicket.telegram_username)
+    ).group_by(ActiveTicket.telegram_user_id).all()
+    for telegram_user_id, telegram_username in clients:
+        upsert_client(db, telegram_user_id, telegram_username)
+
+    db.query(ClientStats).delete(synchronize_session=False)
+    db.query(ClientTicketRollup).delete(synchronize_session=False)
+
+    totals = db.query(
+        ActiveTicket.telegram_user_id,
+        func.count(ActiveTicket.id),
+        func.max(ActiveTicket.updated_at)
+    ).group_by(ActiveTicket.telegram_user_id).all()
+    db.bulk_insert_mappings(ClientStats, [
+        {"telegram_user_id": user_id, "tickets_count": count, "last_activity_at": last_activity}
+        for user_id, count, last_activity in totals
+    ])
+
+    for dimension in ROLLUP_DIMENSIONS:
+        column = getattr(ActiveTicket, dimension)
+        rows = db.query(
+            ActiveTicket.telegram_user_id,
+            column,
+            func.count(ActiveTicket.id)
+        ).filter(column.isnot(None)).group_by(ActiveTicket.telegram_user_id, column).all()
+        db.bulk_insert_mappings(ClientTicketRollup, [
+            {"telegram_user_id": user_id, "dimension": dimension, "value": value, "tickets_count": count}
+            for user_id, value, count in rows
+        ])
+
+    db.commit()
+    logger.info(f"Статистика пересчитана для {len(totals)} клиентов")
+    return len(totals)
+
+def backfill_client_stats(session_factory=SessionLocal) -> int:
+    """Пересчитывает статистику, если у каких-то тикетов нет строки в client_stats
+
+    Так бывает на базе, заполненной до появления учета клиентов: без пересчета
+    список клиентов показывал бы нули, а клиенты без строки в clients пропадали бы.
+    Возвращает число пересчитанных клиентов (0 - пересчет не понадобился).
+    """
+    with session_factory() as db:
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": BACKFILL_LOCK_KEY})
+        missing = db.execute(
+            select(ActiveTicket.id).where(
+                ~select(ClientStats.telegram_user_id)
+                .where(ClientStats.telegram_user_id == ActiveTicket.telegram_user_id)
+                .exists()
+            ).limit(1)
+        ).first()
+        if missing is None:
+            return 0
+        logger.info("Есть тикеты без статистики клиента - пересчет")
+        return rebuild_client_stats(db)
+
+if __name__ == "__main__":
+    from database import create_tables
+
+    logging.basicConfig(level=logging.INFO)
+    create_tables()
+    with SessionLocal() as session:
+        count = rebuild_client_stats(session)
+    print(f"✅ Статистика пересчитана для {count} клиентов")
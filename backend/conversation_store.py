@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Conversation Store - Хранение незавершенных диалогов ботов
+Состояние ConversationHandler и данные создаваемого тикета (ticket_data)
+сохраняются в таблицу conversation_states, поэтому перезапуск процесса
+или переезд бота в другой воркер не сбрасывает клиента посреди диалога.
+Диалоги, в которых клиент молчит дольше CONVERSATION_TTL, завершает
+ConversationHandler (conversation_timeout). Таймауты живут в памяти процесса,
+поэтому записи, не обновлявшиеся дольше STALE_AFTER, не восстанавливаются
+и удаляются evict; записи активных диалогов периодически продлеваются (touch),
+даже если значение не менялось.
+Для тестов есть хранилище в памяти с тем же интерфейсом.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Any, Callable, Dict, Iterator, List, MutableMapping, Optional, Tuple, Type
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import AsyncSessionLocal, ConversationState
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд бездействия клиента диалог забывается
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", str(24 * 3600)))
+# Как часто Application сохраняет изменившиеся состояния ConversationHandler
+PERSISTENCE_INTERVAL = 5
+# Не чаще этого записи активных диалогов без изменений получают новое updated_at
+TOUCH_INTERVAL = 600
+# Поэтому запись считается брошенной только после стольких секунд без обновлений
+STALE_AFTER = CONVERSATION_TTL + TOUCH_INTERVAL
+
+# (ключ, значение, время последнего изменения)
+StoredItem = Tuple[str, Any, datetime]
+
+class ConversationStore(ABC):
+    """Интерфейс хранилища: bot_id + namespace -> ключ -> JSON-значение"""
+
+    @abstractmethod
+    async def load(self, bot_id: int, namespace: str) -> List[StoredItem]:
+        """Все записи бота в namespace"""
+
+    @abstractmethod
+    async def save(self, bot_id: int, namespace: str, key: str, value: Any):
+        """Записывает значение и время изменения"""
+
+    @abstractmethod
+    async def delete(self, bot_id: int, namespace: str, key: str):
+        """Удаляет запись, если она есть"""
+
+    @abstractmethod
+    async def touch(self, bot_id: int, namespace: str, key: str):
+        """Обновляет время изменения существующей записи (клиент активен, значение прежнее)"""
+
+    @abstractmethod
+    async def evict(self, idle_seconds: float) -> int:
+        """Удаляет записи без изменений дольше idle_seconds, возвращает их число"""
+
+class MemoryConversationStore(ConversationStore):
+    """Хранилище в памяти процесса (тесты, запуск без базы)"""
+
+    def __init__(self):
+        self._items: Dict[Tuple[int, str], Dict[str, Tuple[str, datetime]]] = {}
+        self._lock = threading.Lock()
+
+    async def load(self, bot_id: int, namespace: str) -> List[StoredItem]:
+        with self._lock:
+            items = dict(self._items.get((bot_id, namespace), {}))
+        return [(key, json.loads(data), updated_at) for key, (data, updated_at) in items.items()]
+
+    async def save(self, bot_id: int, namespace: str, key: str, value: Any):
+        with self._lock:
+            self._items.setdefault((bot_id, namespace), {})[key] = (json.dumps(value), datetime.utcnow())
+
+    async def delete(self, bot_id: int, namespace: str, key: str):
+        with self._lock:
+            self._items.get((bot_id, namespace), {}).pop(key, None)
+
+    async def touch(self, bot_id: int, namespace: str, key: str):
+        with self._lock:
+            items = self._items.get((bot_id, namespace), {})
+            if key in items:
+                items[key] = (items[key][0], datetime.utcnow())
+
+    async def evict(self, idle_seconds: float) -> int:
+        border = datetime.utcnow() - timedelta(seconds=idle_seconds)
+        removed = 0
+        with self._lock:
+            for items in self._items.values():
+                for key in [key for key, (_, updated_at) in items.items() if updated_at < border]:
+                    del items[key]
+                    removed += 1
+        return removed
+
+class DatabaseConversationStore(ConversationStore):
+    """Хранилище в таблице conversation_states"""
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    async def load(self, bot_id: int, namespace: str) -> List[StoredItem]:
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                select(ConversationState.key, ConversationState.data, ConversationState.updated_at).where(
+                    ConversationState.bot_id == bot_id,
+                    ConversationState.namespace == namespace
+                )
+            )).all()
+        return [(row.key, json.loads(row.data), row.updated_at) for row in rows]
+
+    async def save(self, bot_id: int, namespace: str, key: str, value: Any):
+        now = datetime.utcnow()
+        statement = insert(ConversationState).values(
+            bot_id=bot_id, namespace=namespace, key=key, data=json.dumps(value), updated_at=now
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[ConversationState.bot_id, ConversationState.namespace, ConversationState.key],
+            set_={"data": statement.excluded.data, "updated_at": now}
+        )
+        async with self.session_factory() as session:
+            await session.execute(statement)
+            await session.commit()
+
+    async def delete(self, bot_id: int, namespace: str, key: str):
+        async with self.session_factory() as session:
+            await session.execute(delete(ConversationState).where(
+                ConversationState.bot_id == bot_id,
+                ConversationState.namespace == namespace,
+                ConversationState.key == key
+            ))
+            await session.commit()
+
+    async def touch(self, bot_id: int, namespace: str, key: str):
+        async with self.session_factory() as session:
+            await session.execute(update(ConversationState).where(
+                ConversationState.bot_id == bot_id,
+                ConversationState.namespace == namespace,
+                ConversationState.key == key
+            ).values(updated_at=datetime.utcnow()))
+            await session.commit()
+
+    async def evict(self, idle_seconds: float) -> int:
+        border = datetime.utcnow() - timedelta(seconds=idle_seconds)
+        async with self.session_factory() as session:
+            result = await session.execute(delete(ConversationState).where(ConversationState.updated_at < border))
+            await session.commit()
+        return result.rowcount
+
+class ConversationPersistence(BasePersistence):
+    """Persistence для Application: сохраняет только состояния ConversationHandler
+
+    user_data, chat_data и bot_data бот не использует - они не сохраняются.
+    Состояния - члены Enum, в хранилище пишется их имя.
+    """
+
+    def __init__(self, store: ConversationStore, bot_id: Optional[int], state_type: Type[Enum],
+                 update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+        self.bot_id = bot_id or 0
+        self.state_type = state_type
+        # Время последней записи сохраненных диалогов: (name, ключ) -> monotonic
+        self._written: Dict[Tuple[str, str], float] = {}
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        items = await self.store.load(self.bot_id, name)
+        conversations = {}
+        now_wall, now = datetime.utcnow(), time.monotonic()
+        for key, state, updated_at in items:
+            if (now_wall - updated_at).total_seconds() > STALE_AFTER:
+                # Таймаут диалога истек, пока бот не работал
+                continue
+            try:
+                conversations[tuple(int(part) for part in key.split(":"))] = self.state_type[state]
+            except (KeyError, ValueError):
+                logger.warning(f"Пропущено неизвестное состояние диалога {name}/{key}: {state}")
+                continue
+            self._written[(name, key)] = now - (now_wall - updated_at).total_seconds()
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        store_key = ":".join(str(part) for part in key)
+        if new_state is None:
+            await self.store.delete(self.bot_id, name, store_key)
+            self._written.pop((name, store_key), None)
+        else:
+            state = new_state.name if isinstance(new_state, Enum) else str(new_state)
+            await self.store.save(self.bot_id, name, store_key, state)
+            self._written[(name, store_key)] = time.monotonic()
+
+    async def touch_conversation(self, name: str, key: tuple):
+        """Продлевает сохраненный диалог, в котором клиент пишет, не меняя состояния"""
+        store_key = ":".join(str(part) for part in key)
+        written = self._written.get((name, store_key))
+        if written is None or time.monotonic() - written < TOUCH_INTERVAL:
+            return
+        await self.store.touch(self.bot_id, name, store_key)
+        self._written[(name, store_key)] = time.monotonic()
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id: int, data):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+class PersistentMapping(MutableMapping):
+    """Словарь user_id -> dataclass, который сохраняется в хранилище
+
+    Значения меняются на месте (ticket_data[user_id].data[...] = ...),
+    поэтому запись идет не в __setitem__, а в save(user_id) после обработки
+    обновления: пишется только то, что действительно изменилось.
+    """
+
+    def __init__(self, store: ConversationStore, bot_id: Optional[int], namespace: str,
+                 decode: Callable[[dict], Any], encode: Callable[[Any], dict] = asdict):
+        self.store = store
+        self.bot_id = bot_id or 0
+        self.namespace = namespace
+        self.decode = decode
+        self.encode = encode
+        self._items: Dict[int, Any] = {}
+        # Последнее сохраненное представление и время его записи
+        self._saved: Dict[int, str] = {}
+        self._written: Dict[int, float] = {}
+
+    async def load(self):
+        """Загружает незавершенные диалоги бота из хранилища"""
+        items = await self.store.load(self.bot_id, self.namespace)
+        now_wall, now = datetime.utcnow(), time.monotonic()
+        for key, value, updated_at in items:
+            if (now_wall - updated_at).total_seconds() > STALE_AFTER:
+                continue
+            try:
+                user_id = int(key)
+                self._items[user_id] = self.decode(value)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Пропущены данные диалога {self.namespace}/{key}: {e}")
+                continue
+            self._saved[user_id] = json.dumps(value, sort_keys=True)
+            self._written[user_id] = now - (now_wall - updated_at).total_seconds()
+        if items:
+            logger.info(f"Восстановлено незавершенных диалогов: {len(self._items)}")
+
+    def __getitem__(self, user_id: int):
+        return self._items[user_id]
+
+    def __setitem__(self, user_id: int, value):
+        self._items[user_id] = value
+
+    def __delitem__(self, user_id: int):
+        del self._items[user_id]
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._items
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def save(self, user_id: int):
+        """Сохраняет значение пользователя, если оно изменилось (или удалено)
+
+        Неизменившееся значение раз в TOUCH_INTERVAL продлевается, чтобы
+        evict хранилища не удалил диалог, в котором клиент еще пишет.
+        """
+        if user_id in self._items:
+            value = self.encode(self._items[user_id])
+            data = json.dumps(value, sort_keys=True)
+            if self._saved.get(user_id) == data:
+                if time.monotonic() - self._written.get(user_id, 0) >= TOUCH_INTERVAL:
+                    await self.store.touch(self.bot_id, self.namespace, str(user_id))
+                    self._written[user_id] = time.monotonic()
+                return
+            await self.store.save(self.bot_id, self.namespace, str(user_id), value)
+            self._saved[user_id] = data
+            self._written[user_id] = time.monotonic()
+        elif user_id in self._saved:
+            await self.store.delete(self.bot_id, self.namespace, str(user_id))
+            del self._saved[user_id]
+            self._written.pop(user_id, None)
+
+def _default_store() -> ConversationStore:
+    if os.getenv("CONVERSATION_STORE", "database") == "memory":
+        return MemoryConversationStore()
+    return DatabaseConversationStore()
+
+# Хранилище процесса
+conversation_store = _default_store()
@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Boolean, Text, ForeignKey, Index, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -19,6 +20,28 @@ engine = create_engine(
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def to_async_database_url(url: str) -> str:
+    """Переводит URL синхронного драйвера на asyncpg"""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+def make_async_engine(pool_size: int = None, max_overflow: int = None):
+    """Асинхронный движок (asyncpg) с пулом, размер которого задается на процесс"""
+    return create_async_engine(
+        os.getenv("ASYNC_DATABASE_URL") or to_async_database_url(DATABASE_URL),
+        pool_size=pool_size or int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=max_overflow if max_overflow is not None else int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_pre_ping=True,
+        connect_args={"timeout": 10},
+        echo=False
+    )
+
+# Асинхронный движок для FastAPI: запросы не занимают потоки threadpool
+async_engine = make_async_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 class User(Base):
@@ -76,6 +99,15 @@ class ActiveTicket(Base):
     employee = relationship("Employee", foreign_keys=[assigned_to])
     courier = relationship("Employee", foreign_keys=[courier_id])
     bot = relationship("TelegramBot")
+    
+    # Индексы под keyset-пагинацию списков тикетов: (status, sort_key, id)
+    __table_args__ = (
+        Index("ix_active_tickets_status_updated_id", "status", "updated_at", "id"),
+        Index("ix_active_tickets_status_created_id", "status", "created_at", "id"),
+        Index("ix_active_tickets_courier_id", "courier_id"),
+        Index("ix_active_tickets_telegram_user_id_created", "telegram_user_id", "created_at"),
+        Index("ix_active_tickets_telegram_user_id_status", "telegram_user_id", "status"),
+    )
 
 class ArchiveTicket(Base):
     __tablename__ = "archive_tickets"
@@ -126,12 +158,46 @@ class TicketMessage(Base):
     local_file_path = Column(String)  # Локальный путь к сохраненному файлу на сервере
     original_filename = Column(String)  # Оригинальное имя файла
     file_size = Column(Integer)  # Размер файла в байтах
+    file_sha256 = Column(String(64), nullable=True)  # SHA-256 содержимого сохраненного файла
     is_from_admin = Column(Boolean, default=False)  # Сообщение от админа или клиента
     sender_role = Column(String, nullable=True)  # Роль отправителя (admin, operator, courier)
     sender_name = Column(String, nullable=True)  # Имя отправителя
+    delivery_status = Column(String, nullable=True)  # Доставка исходящего сообщения: pending, sent, failed
+    telegram_message_id = Column(BigInteger, nullable=True)  # ID сообщения в чате Telegram после доставки
     created_at = Column(DateTime, default=datetime.utcnow)
     
     ticket = relationship("ActiveTicket")
+    
+    # Индекс под инкрементальную синхронизацию и окна сообщений тикета
+    __table_args__ = (
+        Index("ix_ticket_messages_ticket_id_id", "ticket_id", "id"),
+        Index("ix_ticket_messages_file_sha256", "file_sha256"),
+    )
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox_messages"
+    
+    # Исходящий запрос к Telegram, который отправит фоновый диспетчер
+    id = Column(Integer, primary_key=True, index=True)
+    bot_id = Column(Integer, ForeignKey("telegram_bots.id"), nullable=True)  # Бот тикета (если известен)
+    chat_id = Column(String, nullable=False)
+    method = Column(String, nullable=False, default="sendMessage")  # Метод Bot API
+    payload = Column(Text, nullable=False)  # JSON параметров метода без chat_id
+    ticket_message_id = Column(Integer, ForeignKey("ticket_messages.id"), nullable=True)
+    status = Column(String, nullable=False, default="pending")  # pending, sending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = Column(DateTime, nullable=True)  # Аренда строки диспетчером на время отправки
+    last_error = Column(Text, nullable=True)
+    telegram_message_id = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_outbox_messages_status_next_attempt", "status", "next_attempt_at"),
+        # Проверка, что более раннее сообщение в тот же чат не ждет отправки
+        Index("ix_outbox_messages_bot_chat_id", "bot_id", "chat_id", "id"),
+    )
 
 class Client(Base):
     __tablename__ = "clients"
@@ -145,6 +211,77 @@ class Client(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class ClientStats(Base):
+    __tablename__ = "client_stats"
+    
+    # Сводка по клиенту, поддерживается инкрементально при создании и изменении тикетов
+    telegram_user_id = Column(String, primary_key=True)
+    tickets_count = Column(Integer, nullable=False, default=0)
+    last_activity_at = Column(DateTime, nullable=True)  # Последний тикет или сообщение клиента
+    
+    __table_args__ = (
+        Index("ix_client_stats_tickets_count", "tickets_count"),
+        Index("ix_client_stats_last_activity_at", "last_activity_at"),
+    )
+
+class ClientTicketRollup(Base):
+    __tablename__ = "client_ticket_rollups"
+    
+    # Количество тикетов клиента по измерению: status, category, resolution
+    telegram_user_id = Column(String, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    tickets_count = Column(Integer, nullable=False, default=0)
+
+class ConversationState(Base):
+    __tablename__ = "conversation_states"
+    
+    # Незавершенные диалоги ботов: переживают перезапуск и переезд бота в другой процесс
+    bot_id = Column(Integer, primary_key=True)  # 0 - бот без id (ручной запуск bot.py)
+    namespace = Column(String, primary_key=True)  # Имя ConversationHandler или ticket_data
+    key = Column(String, primary_key=True)
+    data = Column(Text, nullable=False)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_conversation_states_updated_at", "updated_at"),
+    )
+
+class MediaObject(Base):
+    __tablename__ = "media_objects"
+    
+    # Файл в хранилище по содержимому: одинаковые вложения хранятся один раз
+    sha256 = Column(String(64), primary_key=True)
+    local_path = Column(String, nullable=False)  # Путь относительно backend/media/
+    file_size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)  # Сколько сообщений тикетов ссылается на файл
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # Последняя запись или ссылка
+    preview_status = Column(String, nullable=True)  # Превью: None - еще не делалось, ready, none (тип без превью), failed
+    preview_path = Column(String, nullable=True)  # WebP-превью относительно backend/media/
+    
+    __table_args__ = (
+        Index("ix_media_objects_ref_count_last_used_at", "ref_count", "last_used_at"),
+    )
+
+class TelegramMediaFile(Base):
+    __tablename__ = "telegram_media_files"
+    
+    # file_unique_id Telegram -> уже скачанное содержимое (повторное скачивание не нужно)
+    file_unique_id = Column(String, primary_key=True)
+    sha256 = Column(String(64), ForeignKey("media_objects.sha256", ondelete="CASCADE"), nullable=False)
+
+class TelegramFileId(Base):
+    __tablename__ = "telegram_file_ids"
+    
+    # file_id, который Telegram вернул боту после загрузки: то же содержимое отправляется без повторной загрузки.
+    # file_id действует только для своего бота и своего метода отправки
+    bot_id = Column(Integer, ForeignKey("telegram_bots.id", ondelete="CASCADE"), primary_key=True)
+    sha256 = Column(String(64), ForeignKey("media_objects.sha256", ondelete="CASCADE"), primary_key=True)
+    message_type = Column(String, primary_key=True)  # photo, video, document
+    file_id = Column(String, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -152,12 +289,35 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Колонки, добавленные в модели после создания таблиц (create_all их не добавляет)
+SCHEMA_UPGRADES = [
+    "ALTER TABLE ticket_messages ADD COLUMN IF NOT EXISTS delivery_status VARCHAR",
+    "ALTER TABLE ticket_messages ADD COLUMN IF NOT EXISTS telegram_message_id BIGINT",
+    "ALTER TABLE ticket_messages ADD COLUMN IF NOT EXISTS file_sha256 VARCHAR(64)",
+    "ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS preview_status VARCHAR",
+    "ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS preview_path VARCHAR",
+]
+
+# Ключ advisory lock, под которым схему обновляет только один процесс (API, менеджер ботов)
+SCHEMA_LOCK_KEY = 0x5A5A0001
+
 def create_tables():
-    try:
-        Base.metadata.create_all(bind=engine, checkfirst=True)
-    except Exception as e:
-        # Игнорируем ошибки дублирования индексов/таблиц
-        if "уже существует" in str(e) or "already exists" in str(e):
-            print(f"Таблицы/индексы уже существуют: {e}")
-        else:
-            raise e
\ No newline at end of file
+    """Создает таблицы и применяет SCHEMA_UPGRADES и новые индексы
+
+    Вызывается при старте API и менеджера ботов. Все выполняется в одной
+    транзакции под advisory lock: процессы, стартующие одновременно, не мешают
+    друг другу, а ошибка любой команды не пропускается молча.
+    """
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        Base.metadata.create_all(bind=connection, checkfirst=True)
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(text(statement))
+        # create_all не добавляет новые индексы к уже существующим таблицам
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Employee Directory - Кэш имен и ролей сотрудников процесса
+Используется для подписи сообщений тикетов без запроса на каждое сообщение
+"""
+
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+
+from database import Employee
+
+class EmployeeDirectory:
+    """Кэш (id сотрудника -> имя, роль) с пакетной догрузкой и инвалидацией"""
+
+    def __init__(self, ttl: float = 300.0):
+        # TTL - страховка на случай пропущенной инвалидации из другого процесса
+        self.ttl = ttl
+        self._entries: Dict[int, Optional[Tuple[str, str]]] = {}
+        self._loaded_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Сбрасывает кэш (после создания, изменения или удаления сотрудника)"""
+        with self._lock:
+            self._entries = {}
+            self._loaded_at = time.monotonic()
+
+    def _cached(self, employee_ids: set):
+        """Возвращает (найденные в кэше, недостающие id)"""
+        with self._lock:
+            if time.monotonic() - self._loaded_at > self.ttl:
+                self._entries = {}
+                self._loaded_at = time.monotonic()
+            result = {eid: self._entries[eid] for eid in employee_ids if eid in self._entries}
+        return result, employee_ids - result.keys()
+
+    def _store(self, missing: set, rows) -> dict:
+        found = {row.id: (row.name, row.role) for row in rows}
+        # Отсутствующих сотрудников тоже запоминаем, чтобы не искать их повторно
+        loaded = {eid: found.get(eid) for eid in missing}
+        with self._lock:
+            self._entries.update(loaded)
+        return loaded
+
+    @staticmethod
+    def _statement(missing: set):
+        return select(Employee.id, Employee.name, Employee.role).where(Employee.id.in_(missing))
+
+    def resolve_many(self, db, employee_ids: Iterable[int]) -> Dict[int, Optional[Tuple[str, str]]]:
+        """Возвращает (имя, роль) для набора id одним запросом на недостающих"""
+        result, missing = self._cached(set(employee_ids))
+        if missing:
+            result.update(self._store(missing, db.execute(self._statement(missing)).all()))
+        return result
+
+    async def resolve_many_async(self, db, employee_ids: Iterable[int]) -> Dict[int, Optional[Tuple[str, str]]]:
+        """То же, что resolve_many, для AsyncSession"""
+        result, missing = self._cached(set(employee_ids))
+        if missing:
+            rows = (await db.execute(self._statement(missing))).all()
+            result.update(self._store(missing, rows))
+        return result
+
+# Справочник процесса
+employee_directory = EmployeeDirectory()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Events - Шина событий тикетов между процессами
+Боты и админка публикуют события через Postgres NOTIFY,
+API слушает канал через LISTEN и раздает события подписанным браузерам.
+Без Postgres работает локальный брокер внутри процесса.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import threading
+from typing import Callable, List, Optional
+
+from sqlalchemy import text
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Канал Postgres для событий тикетов
+EVENTS_CHANNEL = "zaza_events"
+
+# Типы событий
+TICKET_CREATED = "ticket.created"
+TICKET_UPDATED = "ticket.updated"
+MESSAGE_CREATED = "message.created"
+MESSAGE_DELIVERY = "message.delivery"
+COURIER_INVITED = "ticket.courier_invited"
+# Служебные события для сброса кэшей в других процессах
+EMPLOYEE_CHANGED = "employee.changed"
+BOT_CHANGED = "bot.changed"
+
+def is_postgres() -> bool:
+    """Используется ли Postgres (LISTEN/NOTIFY доступен только в нем)"""
+    return engine.dialect.name == "postgresql"
+
+class EventBroker:
+    """Локальная раздача событий подписчикам внутри процесса"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        """Создает очередь подписчика в текущем event loop"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.append((loop, queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Удаляет очередь подписчика"""
+        with self._lock:
+            self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+
+    def publish(self, event: dict):
+        """Раздает событие всем подписчикам (потокобезопасно)"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, event)
+            except RuntimeError:
+                # Event loop подписчика уже закрыт
+                self.unsubscribe(queue)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Медленный подписчик - пропускаем событие, клиент догонит опросом
+            logger.warning("Очередь подписчика событий переполнена, событие пропущено")
+
+# Брокер процесса: в него попадают события из LISTEN или локальные публикации
+broker = EventBroker()
+
+def _notify_statement(event: dict):
+    return text("SELECT pg_notify(:channel, :payload)").bindparams(
+        channel=EVENTS_CHANNEL,
+        payload=json.dumps(event, default=str)
+    )
+
+def publish_event(db, event_type: str, payload: dict):
+    """Публикует событие в рамках транзакции сессии db
+
+    В Postgres событие уходит через pg_notify и доставляется только после commit.
+    Без Postgres событие сразу раздается локальным подписчикам.
+    """
+    event = {"type": event_type, **payload}
+    if is_postgres():
+        try:
+            db.execute(_notify_statement(event))
+        except Exception as e:
+            logger.error(f"Ошибка публикации события {event_type}: {e}")
+    else:
+        broker.publish(event)
+
+async def publish_event_async(db, event_type: str, payload: dict):
+    """То же, что publish_event, для AsyncSession"""
+    event = {"type": event_type, **payload}
+    if is_postgres():
+        try:
+            await db.execute(_notify_statement(event))
+        except Exception as e:
+            logger.error(f"Ошибка публикации события {event_type}: {e}")
+    else:
+        broker.publish(event)
+
+class PostgresEventListener:
+    """Фоновый поток, слушающий канал событий через LISTEN"""
+
+    def __init__(self, callback: Callable[[dict], None], channel: str = EVENTS_CHANNEL, reconnect_delay: float = 5.0,
+                 on_connect: Optional[Callable[[], None]] = None):
+        self.callback = callback
+        # Вызывается после каждого LISTEN (в том числе после переподключения):
+        # события, пропущенные без соединения, не придут - кэши нужно перечитать
+        self.on_connect = on_connect
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.connected = threading.Event()
+
+    def start(self):
+        """Запускает поток прослушивания"""
+        if not is_postgres():
+            logger.info("База данных не Postgres - LISTEN/NOTIFY отключен, используется локальный брокер")
+            return
+        self._thread = threading.Thread(target=self._run, name="zaza-events-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает поток прослушивания"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                # Отдельное DBAPI-соединение вне пула: LISTEN требует autocommit и держит
+                # соединение все время работы процесса - место в пуле под это не тратится
+                connect_args, connect_params = engine.dialect.create_connect_args(engine.url)
+                connection = dbapi_connection = engine.dialect.connect(*connect_args, **connect_params)
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                if self.on_connect is not None:
+                    self.on_connect()
+                self.connected.set()
+                logger.info(f"Подписка на канал событий {self.channel} установлена")
+
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        try:
+                            self.callback(json.loads(notify.payload))
+                        except Exception as e:
+                            logger.error(f"Ошибка обработки события: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка соединения LISTEN: {e}")
+            finally:
+                self.connected.clear()
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            self._stop.wait(self.reconnect_delay)
@@ -1,22 +1,35 @@
-from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import tuple_, func, or_, select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel, ConfigDict
-from datetime import timedelta
+from datetime import datetime, timedelta
 import uvicorn
-import requests
 import asyncio
 import logging
+import base64
+import json
 import os
-import uuid
-import shutil
 from pathlib import Path
 from typing import Optional
 
-from database import get_db, User, TelegramBot, Employee, ActiveTicket, ArchiveTicket, EmployeeChat, Note, TicketMessage, Client, create_tables
-from auth import verify_password, get_password_hash, create_access_token, verify_token, get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
+from database import get_db, get_async_db, AsyncSessionLocal, User, TelegramBot, Employee, ActiveTicket, ArchiveTicket, EmployeeChat, Note, TicketMessage, Client, ClientStats, MediaObject, create_tables
+from auth import verify_password, get_password_hash, create_access_token, verify_token, get_current_user, get_media_user, set_media_cookie, MEDIA_COOKIE, ACCESS_TOKEN_EXPIRE_MINUTES
+from events import broker as event_broker, publish_event, publish_event_async, PostgresEventListener, TICKET_CREATED, TICKET_UPDATED, MESSAGE_CREATED, COURIER_INVITED, EMPLOYEE_CHANGED, BOT_CHANGED
+from employee_directory import employee_directory
+from telegram_api import telegram_clients, TelegramAPIError
+from bot_registry import bot_registry
+from media_downloader import media_downloader
+from media_store import media_store, reference_media_async, release_media_async
+from media_previews import preview_generator
+from media_serving import resolve_media_path, content_hash, media_response
+from media_upload import receive_file, UploadError
+from telegram_files import file_id_cache, extract_file_id
+from outbox import outbox_dispatcher, enqueue_telegram_message, dispatcher_enabled
+from client_stats import upsert_client, record_ticket_created, record_ticket_changed_async, get_client_breakdown_async, backfill_client_stats
 
 app = FastAPI(title="ZAZA Admin Panel API")
 
@@ -39,163 +52,98 @@ else:
     frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 app.mount("/static", StaticFiles(directory=frontend_path), name="static")
 
-# Media files - попробуем простой подход
+# Media files: прямой маршрут без /api - с той же проверкой доступа и кэшированием
 @app.get("/media/{file_path:path}")
-def serve_media_files(file_path: str):
+async def serve_media_files(file_path: str, request: Request, current_user: dict = Depends(get_media_user)):
     """Прямая отдача медиа файлов"""
-    backend_dir = Path(__file__).parent
-    full_path = backend_dir / "media" / file_path
-    
-    if full_path.exists() and full_path.is_file():
-        return FileResponse(full_path)
-    else:
-        raise HTTPException(status_code=404, detail="File not found")
+    return await get_media_file(file_path, request, current_user)
 
 # Security управляется в auth.py
 
+def handle_bus_event(event: dict):
+    """Обрабатывает событие из LISTEN (бот-процессы и другие воркеры API)"""
+    if event.get("type") == EMPLOYEE_CHANGED:
+        # Служебное событие - сбрасываем справочник сотрудников этого процесса
+        employee_directory.invalidate()
+        return
+    if event.get("type") == BOT_CHANGED:
+        bot_registry.invalidate()
+        return
+    event_broker.publish(event)
+
+def on_bus_connect():
+    """После (пере)подключения LISTEN: инвалидации могли быть пропущены - сбрасываем кэши"""
+    employee_directory.invalidate()
+    bot_registry.invalidate()
+
+events_listener = PostgresEventListener(handle_bus_event, on_connect=on_bus_connect)
+
+@app.on_event("startup")
+async def prepare_database():
+    # Первым из обработчиков старта: остальные уже работают с новыми колонками
+    await asyncio.to_thread(create_tables)
+    await asyncio.to_thread(backfill_client_stats)
+
+@app.on_event("startup")
+async def start_events_listener():
+    events_listener.start()
+
+@app.on_event("shutdown")
+async def stop_events_listener():
+    await asyncio.to_thread(events_listener.stop)
+
+@app.on_event("startup")
+async def start_outbox_dispatcher():
+    if dispatcher_enabled():
+        outbox_dispatcher.start()
+
+@app.on_event("shutdown")
+async def stop_outbox_dispatcher():
+    await outbox_dispatcher.stop()
+
+@app.on_event("shutdown")
+async def stop_preview_generator():
+    await preview_generator.close()
+
+@app.on_event("shutdown")
+async def close_telegram_clients():
+    await telegram_clients.aclose()
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-# Функция для отправки сообщений в Telegram
-def send_telegram_message(user_id: str, message: str, db: Session) -> bool:
-    """Отправляет сообщение пользователю в Telegram через API бота"""
-    try:
-        # Получаем активного бота из БД (берем первого активного)
-        bot = db.query(TelegramBot).filter(TelegramBot.is_active == True).first()
-        if not bot:
-            logger.error("Не найден активный бот для отправки сообщения")
-            return False
-        
-        # URL для Telegram Bot API
-        url = f"https://api.telegram.org/bot{bot.token}/sendMessage"
-        
-        # Данные для отправки
-        data = {
-            "chat_id": user_id,
-            "text": message,
-            "parse_mode": "HTML"  # Поддержка HTML форматирования
-        }
-        
-        # Отправляем запрос к Telegram API
-        response = requests.post(url, json=data, timeout=10)
-        
-        if response.status_code == 200:
-            logger.info(f"Сообщение отправлено пользователю {user_id}")
-            return True
-        else:
-            logger.error(f"Ошибка отправки сообщения: {response.status_code} - {response.text}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Исключение при отправке сообщения: {e}")
-        return False
-
-async def send_file_to_telegram(user_id: str, file_path: Path, message_type: str, caption: str, db: Session) -> bool:
-    """Отправляет файл пользователю в Telegram через API бота"""
+async def send_file_to_telegram(bot_id: Optional[int], user_id: str, file_path: Path, sha256: str, message_type: str,
+                                caption: str, filename: Optional[str] = None,
+                                content_type: str = "application/octet-stream") -> Optional[dict]:
+    """Отправляет файл пользователю в Telegram через бота тикета
+    
+    Файл, который этот бот уже загружал, уходит по file_id без повторной загрузки.
+    Возвращает объект Message из ответа Telegram или None при ошибке.
+    """
+    bot = await bot_registry.resolve(bot_id)
+    if not bot:
+        logger.error("Не найден бот для отправки файла")
+        return None
+    
     try:
-        # Получаем активного бота из БД
-        bot = db.query(TelegramBot).filter(TelegramBot.is_active == True).first()
-        if not bot:
-            logger.error("Не найден активный бот для отправки файла")
-            return False
-
-        # Определяем метод API в зависимости от типа файла
-        if message_type == "photo":
-            api_method = "sendPhoto"
-            file_field = "photo"
-        elif message_type == "video":
-            api_method = "sendVideo"
-            file_field = "video"
-        else:
-            api_method = "sendDocument"
-            file_field = "document"
-
-        # URL для Telegram Bot API
-        url = f"https://api.telegram.org/bot{bot.token}/{api_method}"
-
-        # Подготавливаем данные для отправки
-        data = {
-            "chat_id": user_id,
-            "caption": caption,
-            "parse_mode": "HTML"
-        }
-
-        # Открываем файл и отправляем
-        with open(file_path, "rb") as file_obj:
-            files = {file_field: file_obj}
-            
-            response = requests.post(url, data=data, files=files, timeout=30)
-
-        if response.status_code == 200:
-            logger.info(f"Файл отправлен пользователю {user_id}")
-            return True
-        else:
-            logger.error(f"Ошибка отправки файла: {response.status_code} - {response.text}")
-            return False
-
-    except Exception as e:
-        logger.error(f"Исключение при отправке файла: {e}")
-        return False
+        result = await file_id_cache.send(
+            bot.client, bot.id, user_id, file_path, sha256, message_type, caption,
+            filename=filename, content_type=content_type
+        )
+        logger.info(f"Файл отправлен пользователю {user_id}")
+        return result
+    except (TelegramAPIError, OSError) as e:
+        logger.error(f"Ошибка отправки файла: {e}")
+        return None
 
 # Функции для работы с медиафайлами
-async def download_telegram_file(file_id: str, file_type: str, db: Session) -> Optional[dict]:
-    """Скачивает файл из Telegram и сохраняет на сервере"""
-    try:
-        # Получаем активного бота из БД
-        bot = db.query(TelegramBot).filter(TelegramBot.is_active == True).first()
-        if not bot:
-            logger.error("Не найден активный бот для скачивания файла")
-            return None
-        
-        # Получаем информацию о файле
-        get_file_url = f"https://api.telegram.org/bot{bot.token}/getFile"
-        get_file_response = requests.get(get_file_url, params={"file_id": file_id})
-        
-        if get_file_response.status_code != 200:
-            logger.error(f"Ошибка получения информации о файле: {get_file_response.text}")
-            return None
-        
-        file_info = get_file_response.json()["result"]
-        file_path = file_info["file_path"]
-        file_size = file_info.get("file_size", 0)
-        
-        # Создаем уникальное имя файла
-        file_extension = Path(file_path).suffix
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        
-        # Определяем папку для сохранения
-        media_folder = {
-            "photo": "photos",
-            "video": "videos", 
-            "document": "documents"
-        }.get(file_type, "documents")
-        
-        # Создаем путь для сохранения
-        save_dir = Path("media") / media_folder
-        save_dir.mkdir(parents=True, exist_ok=True)
-        save_path = save_dir / unique_filename
-        
-        # Скачиваем файл
-        download_url = f"https://api.telegram.org/file/bot{bot.token}/{file_path}"
-        download_response = requests.get(download_url, stream=True)
-        
-        if download_response.status_code != 200:
-            logger.error(f"Ошибка скачивания файла: {download_response.text}")
-            return None
-        
-        # Сохраняем файл
-        with open(save_path, "wb") as f:
-            shutil.copyfileobj(download_response.raw, f)
-        
-        return {
-            "local_path": f"{media_folder}/{unique_filename}",  # Относительный путь от media/
-            "original_filename": Path(file_path).name,
-            "file_size": file_size
-        }
-        
-    except Exception as e:
-        logger.error(f"Исключение при скачивании файла: {e}")
+async def download_telegram_file(bot_id: Optional[int], file_id: str, file_unique_id: Optional[str] = None) -> Optional[dict]:
+    """Скачивает файл из Telegram через бота, получившего его, и сохраняет на сервере"""
+    bot = await bot_registry.resolve(bot_id)
+    if not bot:
+        logger.error("Не найден бот для скачивания файла")
         return None
+    return await media_downloader.download(bot.token, file_id, bot_key=bot.id, file_unique_id=file_unique_id)
 
 def get_media_url(local_file_path: str) -> str:
     """Генерирует URL для доступа к медиафайлу"""
@@ -278,7 +226,7 @@ async def static_profile():
     return FileResponse(os.path.join(frontend_path, "profile.html"))
 
 @app.post("/api/login", response_model=Token)
-def login(user_data: UserLogin, db: Session = Depends(get_db)):
+def login(user_data: UserLogin, request: Request, response: Response, db: Session = Depends(get_db)):
     # Сначала ищем среди User (админов)
     user = db.query(User).filter(User.username == user_data.username).first()
     if user and verify_password(user_data.password, user.hashed_password):
@@ -287,6 +235,7 @@ def login(user_data: UserLogin, db: Session = Depends(get_db)):
             data={"sub": user.username, "type": "user", "id": user.id}, 
             expires_delta=access_token_expires
         )
+        set_media_cookie(response, access_token, secure=request.url.scheme == "https")
         return {"access_token": access_token, "token_type": "bearer"}
     
     # Если не найден среди User, ищем среди Employee (сотрудников)
@@ -297,6 +246,7 @@ def login(user_data: UserLogin, db: Session = Depends(get_db)):
             data={"sub": employee.login, "type": "employee", "id": employee.id, "role": employee.role}, 
             expires_delta=access_token_expires
         )
+        set_media_cookie(response, access_token, secure=request.url.scheme == "https")
         return {"access_token": access_token, "token_type": "bearer"}
     
     # Если никого не найдено
@@ -308,8 +258,17 @@ def login(user_data: UserLogin, db: Session = Depends(get_db)):
 
 # Убираем эндпоинт регистрации - создаем пользователей только через админа
 
+@app.post("/api/logout")
+def logout(response: Response):
+    """Удаляет cookie медиафайлов (сам токен хранится на клиенте)"""
+    response.delete_cookie(MEDIA_COOKIE)
+    return {"message": "ok"}
+
 @app.get("/api/me")
-def read_users_me(current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+def read_users_me(request: Request, response: Response, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Страницы проверяют токен при загрузке - заодно обновляем cookie для медиафайлов
+    # (сессии, начатые до появления cookie, получают его здесь)
+    set_media_cookie(response, request.headers["authorization"].partition(" ")[2], secure=request.url.scheme == "https")
     if current_user["type"] == "user":
         user = db.query(User).filter(User.username == current_user["username"]).first()
         if not user:
@@ -415,8 +374,11 @@ def create_bot(bot: TelegramBotCreate, current_user: dict = Depends(get_current_
         token=bot.token
     )
     db.add(db_bot)
+    db.flush()
+    publish_event(db, BOT_CHANGED, {"bot_id": db_bot.id, "action": "created"})
     db.commit()
     db.refresh(db_bot)
+    bot_registry.invalidate()
     return {
         "id": db_bot.id,
         "name": db_bot.name,
@@ -436,8 +398,10 @@ def update_bot(bot_id: int, bot: TelegramBotUpdate, current_user: dict = Depends
     db_bot.name = bot.name
     db_bot.telegram_name = bot.telegram_name
     db_bot.token = bot.token
+    publish_event(db, BOT_CHANGED, {"bot_id": bot_id, "action": "updated"})
     db.commit()
     db.refresh(db_bot)
+    bot_registry.invalidate()
     
     return {
         "id": db_bot.id,
@@ -456,7 +420,9 @@ def delete_bot(bot_id: int, current_user: dict = Depends(get_current_user), db:
         raise HTTPException(status_code=404, detail="Бот не найден")
     
     db.delete(db_bot)
+    publish_event(db, BOT_CHANGED, {"bot_id": bot_id, "action": "deleted"})
     db.commit()
+    bot_registry.invalidate()
     return {"message": "Бот успешно удален"}
 
 @app.patch("/api/bots/{bot_id}/status")
@@ -467,8 +433,10 @@ def toggle_bot_status(bot_id: int, current_user: dict = Depends(get_current_user
     
     # Переключаем статус
     db_bot.is_active = not db_bot.is_active
+    publish_event(db, BOT_CHANGED, {"bot_id": bot_id, "action": "status", "is_active": db_bot.is_active})
     db.commit()
     db.refresh(db_bot)
+    bot_registry.invalidate()
     
     return {
         "id": db_bot.id,
@@ -480,69 +448,233 @@ def toggle_bot_status(bot_id: int, current_user: dict = Depends(get_current_user
         "updated_at": db_bot.updated_at.isoformat() if db_bot.updated_at else None
     }
 
-# === ENDPOINTS ДЛЯ ТИКЕТОВ ===
+# === ПОТОК СОБЫТИЙ (SSE) ===
 
-@app.get("/api/tickets")
-def get_active_tickets(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Получить список активных тикетов"""
-    query = db.query(ActiveTicket).filter(ActiveTicket.status != "archive")
-    
-    # Если пользователь - курьер, показываем только те тикеты, куда он приглашен
-    if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-        if employee and employee.role == "courier":
-            query = query.filter(ActiveTicket.courier_id == employee.id)
+SSE_KEEPALIVE_SECONDS = 15
+
+async def is_courier_of_ticket(courier_id: int, ticket_id: int) -> bool:
+    """Проверяет, приглашен ли курьер в тикет"""
+    async with AsyncSessionLocal() as db:
+        ticket_courier_id = await db.scalar(select(ActiveTicket.courier_id).where(ActiveTicket.id == ticket_id))
+        return ticket_courier_id == courier_id
+
+async def get_courier_id(db: AsyncSession, current_user: dict) -> Optional[int]:
+    """ID сотрудника, если текущий пользователь - курьер, иначе None"""
+    if current_user["type"] != "employee":
+        return None
+    employee = (await db.execute(
+        select(Employee.id, Employee.role).where(Employee.login == current_user["username"])
+    )).first()
+    if employee and employee.role == "courier":
+        return employee.id
+    return None
+
+@app.get("/api/events")
+async def stream_events(request: Request, ticket_id: Optional[int] = None,
+                        current_user: dict = Depends(get_media_user)):
+    """Поток событий тикетов (Server-Sent Events) вместо периодического опроса
+    
+    EventSource не умеет передавать заголовки, а токен в query попал бы в логи
+    nginx и uvicorn - поэтому авторизация по HttpOnly cookie, как у медиафайлов.
+    ticket_id - подписка только на события одного тикета.
+    """
+    
+    # Курьер получает события только по тикетам, куда он приглашен:
+    # доступ к конкретному тикету проверяем один раз при подписке,
+    # в общем потоке фильтруем по courier_id события
+    courier_id = None
+    if current_user["type"] == "employee" and current_user.get("role") == "courier":
+        if ticket_id is not None:
+            if not await is_courier_of_ticket(current_user["id"], ticket_id):
+                raise HTTPException(status_code=403, detail="Доступ запрещен. Вы не приглашены к этому тикету")
+        else:
+            courier_id = current_user["id"]
     
-    tickets = query.all()
+    queue = event_broker.subscribe()
     
-    result = []
-    for ticket in tickets:
-        result.append({
-            "id": ticket.id,
-            "subject": ticket.subject,
-            "category": ticket.category,
-            "telegram_username": ticket.telegram_username,
-            "telegram_user_id": ticket.telegram_user_id,
-            "status": ticket.status,
-            "resolution": ticket.resolution,
-            "note": ticket.note,
-            "priority": ticket.priority,
-            "created_at": ticket.created_at.isoformat() if ticket.created_at else None,
-            "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None
-        })
-    
-    return result
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                
+                if ticket_id is not None and event.get("ticket_id") != ticket_id:
+                    continue
+                if courier_id is not None and event.get("courier_id") != courier_id:
+                    continue
+                
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            event_broker.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-@app.get("/api/tickets/archive")
-def get_archive_tickets(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Получить список архивных тикетов"""
-    query = db.query(ActiveTicket).filter(ActiveTicket.status == "archive")
-    
+# === ENDPOINTS ДЛЯ ТИКЕТОВ ===
+
+# === ПАГИНАЦИЯ СПИСКОВ ТИКЕТОВ ===
+
+TICKET_SORT_COLUMNS = {
+    "updated_at": ActiveTicket.updated_at,
+    "created_at": ActiveTicket.created_at,
+}
+
+class TicketListParams:
+    """Параметры фильтрации и keyset-пагинации списка тикетов"""
+    
+    def __init__(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = Query(50, ge=1, le=200),
+        sort: str = Query("updated_at", pattern="^(updated_at|created_at)$"),
+        order: str = Query("desc", pattern="^(asc|desc)$"),
+        status: Optional[str] = None,
+        category: Optional[str] = None,
+        priority: Optional[str] = None,
+        bot_id: Optional[int] = None,
+        courier_id: Optional[int] = None,
+        created_from: Optional[datetime] = None,
+        created_to: Optional[datetime] = None,
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.sort = sort
+        self.order = order
+        self.status = status
+        self.category = category
+        self.priority = priority
+        self.bot_id = bot_id
+        self.courier_id = courier_id
+        self.created_from = created_from
+        self.created_to = created_to
+
+def encode_ticket_cursor(sort_value: datetime, ticket_id: int) -> str:
+    """Кодирует позицию (значение сортировки, id) в непрозрачный курсор"""
+    payload = json.dumps({"v": sort_value.isoformat() if sort_value else None, "id": ticket_id})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_ticket_cursor(cursor: str):
+    """Декодирует курсор обратно в (значение сортировки, id)"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        sort_value = datetime.fromisoformat(payload["v"]) if payload.get("v") else None
+        return sort_value, int(payload["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор пагинации")
+
+async def estimate_query_count(db: AsyncSession, statement) -> Optional[int]:
+    """Приблизительное количество строк по оценке планировщика Postgres (без COUNT(*))"""
+    try:
+        # Точка сохранения: ошибка EXPLAIN не должна прерывать транзакцию запроса страницы
+        async with db.begin_nested():
+            connection = await db.connection()
+            compiled = statement.compile(dialect=connection.dialect)
+            params = compiled.params
+            if compiled.positional:
+                # asyncpg использует позиционные параметры ($1, $2, ...)
+                params = tuple(params[name] for name in compiled.positiontup)
+            result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", params)
+            plan = result.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        logger.warning(f"Не удалось оценить количество строк: {e}")
+        return None
+
+def serialize_ticket(ticket: ActiveTicket) -> dict:
+    """Краткое представление тикета для списков"""
+    return {
+        "id": ticket.id,
+        "subject": ticket.subject,
+        "category": ticket.category,
+        "telegram_username": ticket.telegram_username,
+        "telegram_user_id": ticket.telegram_user_id,
+        "status": ticket.status,
+        "resolution": ticket.resolution,
+        "note": ticket.note,
+        "priority": ticket.priority,
+        "bot_id": ticket.bot_id,
+        "courier_id": ticket.courier_id,
+        "created_at": ticket.created_at.isoformat() if ticket.created_at else None,
+        "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None
+    }
+
+async def paginate_tickets(statement, params: TicketListParams, db: AsyncSession, current_user: dict) -> dict:
+    """Применяет фильтры и keyset-пагинацию по (sort, id) к запросу тикетов"""
     # Если пользователь - курьер, показываем только те тикеты, куда он приглашен
-    if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-        if employee and employee.role == "courier":
-            query = query.filter(ActiveTicket.courier_id == employee.id)
+    courier_id = await get_courier_id(db, current_user)
+    if courier_id is not None:
+        statement = statement.where(ActiveTicket.courier_id == courier_id)
+    
+    if params.status:
+        statement = statement.where(ActiveTicket.status == params.status)
+    if params.category:
+        statement = statement.where(ActiveTicket.category == params.category)
+    if params.priority:
+        statement = statement.where(ActiveTicket.priority == params.priority)
+    if params.bot_id is not None:
+        statement = statement.where(ActiveTicket.bot_id == params.bot_id)
+    if params.courier_id is not None:
+        statement = statement.where(ActiveTicket.courier_id == params.courier_id)
+    if params.created_from:
+        statement = statement.where(ActiveTicket.created_at >= params.created_from)
+    if params.created_to:
+        statement = statement.where(ActiveTicket.created_at < params.created_to)
+    
+    # Оценку считаем до применения курсора - это размер всей выборки
+    approx_total = await estimate_query_count(db, statement)
+    
+    sort_column = TICKET_SORT_COLUMNS[params.sort]
+    if params.cursor:
+        cursor_value, cursor_id = decode_ticket_cursor(params.cursor)
+        if params.order == "desc":
+            statement = statement.where(tuple_(sort_column, ActiveTicket.id) < tuple_(cursor_value, cursor_id))
+        else:
+            statement = statement.where(tuple_(sort_column, ActiveTicket.id) > tuple_(cursor_value, cursor_id))
     
-    tickets = query.all()
+    if params.order == "desc":
+        statement = statement.order_by(sort_column.desc(), ActiveTicket.id.desc())
+    else:
+        statement = statement.order_by(sort_column.asc(), ActiveTicket.id.asc())
     
-    result = []
-    for ticket in tickets:
-        result.append({
-            "id": ticket.id,
-            "subject": ticket.subject,
-            "category": ticket.category,
-            "telegram_username": ticket.telegram_username,
-            "telegram_user_id": ticket.telegram_user_id,
-            "status": ticket.status,
-            "resolution": ticket.resolution,
-            "note": ticket.note,
-            "priority": ticket.priority,
-            "created_at": ticket.created_at.isoformat() if ticket.created_at else None,
-            "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None
-        })
+    # Берем на одну строку больше, чтобы понять, есть ли следующая страница
+    tickets = (await db.scalars(statement.limit(params.limit + 1))).all()
+    has_more = len(tickets) > params.limit
+    tickets = tickets[:params.limit]
     
-    return result
+    next_cursor = None
+    if has_more:
+        last = tickets[-1]
+        next_cursor = encode_ticket_cursor(getattr(last, params.sort), last.id)
+    
+    return {
+        "tickets": [serialize_ticket(ticket) for ticket in tickets],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+        "approx_total": approx_total
+    }
+
+@app.get("/api/tickets")
+async def get_active_tickets(params: TicketListParams = Depends(), db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """Получить страницу активных тикетов"""
+    statement = select(ActiveTicket).where(ActiveTicket.status != "archive")
+    return await paginate_tickets(statement, params, db, current_user)
+
+@app.get("/api/tickets/archive")
+async def get_archive_tickets(params: TicketListParams = Depends(), db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """Получить страницу архивных тикетов"""
+    statement = select(ActiveTicket).where(ActiveTicket.status == "archive")
+    return await paginate_tickets(statement, params, db, current_user)
 
 @app.get("/api/tickets/test")
 def get_tickets_test(db: Session = Depends(get_db)):
@@ -583,6 +715,16 @@ def create_ticket(ticket_data: dict, db: Session = Depends(get_db)):
         )
         
         db.add(ticket)
+        db.flush()
+        upsert_client(db, ticket.telegram_user_id, ticket.telegram_username)
+        record_ticket_created(db, ticket)
+        publish_event(db, TICKET_CREATED, {
+            "ticket_id": ticket.id,
+            "status": ticket.status,
+            "bot_id": ticket.bot_id,
+            "telegram_user_id": ticket.telegram_user_id,
+            "courier_id": ticket.courier_id
+        })
         db.commit()
         db.refresh(ticket)
         
@@ -603,63 +745,8 @@ def create_ticket(ticket_data: dict, db: Session = Depends(get_db)):
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Ошибка создания тикета: {str(e)}")
 
-@app.get("/api/tickets/{ticket_id}")
-def get_ticket_details(ticket_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Получить детали тикета с сообщениями"""
-    ticket = db.query(ActiveTicket).filter(ActiveTicket.id == ticket_id).first()
-    if not ticket:
-        raise HTTPException(status_code=404, detail="Тикет не найден")
-    
-    # Если пользователь - курьер, проверяем доступ к тикету
-    if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-        if employee and employee.role == "courier":
-            if ticket.courier_id != employee.id:
-                raise HTTPException(status_code=403, detail="Доступ запрещен. Вы не приглашены к этому тикету")
-    
-    # Получаем сообщения тикета
-    messages = db.query(TicketMessage).filter(TicketMessage.ticket_id == ticket_id).order_by(TicketMessage.created_at).all()
-    
-    messages_data = []
-    for msg in messages:
-        # Определяем имя отправителя и роль
-        sender_name = "Клиент"
-        sender_role = "client"
-        
-        if msg.is_from_admin:
-            if msg.telegram_user_id == "admin":
-                sender_name = "Админ"
-                sender_role = "admin"
-            elif msg.telegram_user_id.startswith("employee_"):
-                # Извлекаем ID сотрудника и получаем его имя и роль
-                employee_id = msg.telegram_user_id.replace("employee_", "")
-                try:
-                    employee = db.query(Employee).filter(Employee.id == int(employee_id)).first()
-                    if employee:
-                        sender_name = employee.name
-                        sender_role = employee.role  # admin, operator, courier
-                    else:
-                        sender_name = "Сотрудник"
-                        sender_role = "employee"
-                except:
-                    sender_name = "Сотрудник" 
-                    sender_role = "employee"
-        
-        messages_data.append({
-            "id": msg.id,
-            "telegram_user_id": msg.telegram_user_id,
-            "message_type": msg.message_type,
-            "content": msg.content,
-            "file_id": msg.file_id,
-            "local_file_path": msg.local_file_path,
-            "original_filename": msg.original_filename,
-            "file_size": msg.file_size,
-            "is_from_admin": msg.is_from_admin,
-            "sender_name": sender_name,
-            "sender_role": sender_role,
-            "created_at": msg.created_at.isoformat() if msg.created_at else None
-        })
-    
+def serialize_ticket_header(ticket: ActiveTicket) -> dict:
+    """Шапка тикета без сообщений"""
     return {
         "id": ticket.id,
         "subject": ticket.subject,
@@ -672,46 +759,183 @@ def get_ticket_details(ticket_id: int, db: Session = Depends(get_db), current_us
         "note": ticket.note,
         "priority": ticket.priority,
         "created_at": ticket.created_at.isoformat() if ticket.created_at else None,
-        "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None,
-        "messages": messages_data
+        "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None
     }
 
-class UpdateTicketRequest(BaseModel):
-    note: str = None
-    status: str = None
-    resolution: str = None
+def parse_employee_sender_id(telegram_user_id: str) -> Optional[int]:
+    """Извлекает ID сотрудника из отправителя вида employee_<id>"""
+    if not telegram_user_id or not telegram_user_id.startswith("employee_"):
+        return None
+    try:
+        return int(telegram_user_id.replace("employee_", ""))
+    except ValueError:
+        return None
 
-@app.put("/api/tickets/{ticket_id}")
-def update_ticket(ticket_id: int, request: UpdateTicketRequest, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Обновить тикет (заметка, статус, решение)"""
-    ticket = db.query(ActiveTicket).filter(ActiveTicket.id == ticket_id).first()
+async def resolve_message_senders(messages, db: AsyncSession) -> dict:
+    """Одним запросом находит имена и роли сотрудников для сообщений без сохраненного отправителя"""
+    employee_ids = {
+        parse_employee_sender_id(msg.telegram_user_id)
+        for msg in messages
+        if msg.is_from_admin and not (msg.sender_name and msg.sender_role)
+    }
+    employee_ids.discard(None)
+    if not employee_ids:
+        return {}
+    return await employee_directory.resolve_many_async(db, employee_ids)
+
+async def resolve_message_previews(messages, db: AsyncSession) -> dict:
+    """Одним запросом находит готовые превью вложений: sha256 -> путь превью"""
+    hashes = {msg.file_sha256 for msg in messages if msg.file_sha256}
+    if not hashes:
+        return {}
+    return dict((await db.execute(
+        select(MediaObject.sha256, MediaObject.preview_path).where(
+            MediaObject.sha256.in_(hashes),
+            MediaObject.preview_path.is_not(None)
+        )
+    )).all())
+
+def serialize_ticket_message(msg: TicketMessage, senders: dict, previews: Optional[dict] = None) -> dict:
+    """Сообщение тикета с именем и ролью отправителя
+    
+    senders - результат resolve_message_senders для пачки сообщений,
+    previews - результат resolve_message_previews.
+    """
+    sender_name = "Клиент"
+    sender_role = "client"
+    
+    if msg.is_from_admin:
+        if msg.sender_name and msg.sender_role:
+            # Новые сообщения хранят отправителя прямо в строке
+            sender_name = msg.sender_name
+            sender_role = msg.sender_role
+        elif msg.telegram_user_id == "admin":
+            sender_name = "Админ"
+            sender_role = "admin"
+        else:
+            employee = senders.get(parse_employee_sender_id(msg.telegram_user_id))
+            if employee:
+                sender_name, sender_role = employee  # admin, operator, courier
+            else:
+                sender_name = "Сотрудник"
+                sender_role = "employee"
+    
+    return {
+        "id": msg.id,
+        "telegram_user_id": msg.telegram_user_id,
+        "message_type": msg.message_type,
+        "content": msg.content,
+        "file_id": msg.file_id,
+        "local_file_path": msg.local_file_path,
+        # Уменьшенное WebP-превью (фото, кадр видео, первая страница PDF), пока не готово - None
+        "preview_url": get_media_url((previews or {}).get(msg.file_sha256)) or None,
+        "original_filename": msg.original_filename,
+        "file_size": msg.file_size,
+        "is_from_admin": msg.is_from_admin,
+        "sender_name": sender_name,
+        "sender_role": sender_role,
+        "delivery_status": msg.delivery_status,
+        "telegram_message_id": msg.telegram_message_id,
+        "created_at": msg.created_at.isoformat() if msg.created_at else None
+    }
+
+async def get_ticket_for_user(ticket_id: int, db: AsyncSession, current_user: dict) -> ActiveTicket:
+    """Загружает тикет и проверяет, что курьер приглашен к нему"""
+    ticket = await db.get(ActiveTicket, ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="Тикет не найден")
     
-    # Если пользователь - курьер, запрещаем обновление тикета
-    if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-        if employee and employee.role == "courier":
-            raise HTTPException(status_code=403, detail="Доступ запрещен. Курьеры не могут изменять тикеты")
-    
-    # Сохраняем старый статус для проверки изменений
-    old_status = ticket.status
-    
-    if request.note is not None:
-        ticket.note = request.note
-    if request.status is not None:
-        ticket.status = request.status
-    if request.resolution is not None:
-        ticket.resolution = request.resolution
+    # Если пользователь - курьер, проверяем доступ к тикету
+    courier_id = await get_courier_id(db, current_user)
+    if courier_id is not None and ticket.courier_id != courier_id:
+        raise HTTPException(status_code=403, detail="Доступ запрещен. Вы не приглашены к этому тикету")
+    return ticket
+
+@app.get("/api/tickets/{ticket_id}")
+async def get_ticket_details(ticket_id: int, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """Получить детали тикета с сообщениями"""
+    ticket = await get_ticket_for_user(ticket_id, db, current_user)
     
-    db.commit()
-    db.refresh(ticket)
+    # Получаем сообщения тикета
+    messages = (await db.scalars(
+        select(TicketMessage).where(TicketMessage.ticket_id == ticket_id).order_by(TicketMessage.created_at)
+    )).all()
+    
+    result = serialize_ticket_header(ticket)
+    senders = await resolve_message_senders(messages, db)
+    previews = await resolve_message_previews(messages, db)
+    result["messages"] = [serialize_ticket_message(msg, senders, previews) for msg in messages]
+    return result
+
+# Сообщения пишут несколько процессов (API, буфер записи ботов), поэтому меньший id
+# может зафиксироваться позже большего. Синхронизация по after_id повторно отдает
+# сообщения за последние SYNC_OVERLAP_SECONDS, клиент отбрасывает уже известные id
+SYNC_OVERLAP_SECONDS = 30
+SYNC_OVERLAP_LIMIT = 200
+
+@app.get("/api/tickets/{ticket_id}/messages")
+async def get_ticket_messages(
+    ticket_id: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    ticket_updated_at: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Инкрементальная синхронизация сообщений тикета
+    
+    after_id - только новые сообщения после указанного (для опроса чата), плюс
+    недавние сообщения с меньшим id, которые могли зафиксироваться позже;
+    before_id - окно более старых сообщений (для прокрутки вверх);
+    без них - последние limit сообщений.
+    Шапка тикета возвращается только если её updated_at отличается от ticket_updated_at.
+    """
+    ticket = await get_ticket_for_user(ticket_id, db, current_user)
+    
+    if after_id is not None and before_id is not None:
+        raise HTTPException(status_code=400, detail="Нельзя указывать after_id и before_id одновременно")
+    
+    statement = select(TicketMessage).where(TicketMessage.ticket_id == ticket_id)
+    
+    if after_id is not None:
+        # Новые сообщения - по возрастанию id, ограничиваем пачку сверху
+        messages = (await db.scalars(
+            statement.where(TicketMessage.id > after_id).order_by(TicketMessage.id.asc()).limit(limit + 1)
+        )).all()
+        has_more = len(messages) > limit
+        # Окно перекрытия не влияет на has_more: иначе опрос мог бы не продвигаться
+        late_messages = (await db.scalars(
+            statement.where(
+                TicketMessage.id <= after_id,
+                TicketMessage.created_at >= datetime.utcnow() - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+            ).order_by(TicketMessage.id.asc()).limit(SYNC_OVERLAP_LIMIT)
+        )).all()
+        messages = list(late_messages) + list(messages[:limit])
+    else:
+        # Последнее окно или окно перед before_id - выбираем с конца и разворачиваем
+        if before_id is not None:
+            statement = statement.where(TicketMessage.id < before_id)
+        messages = (await db.scalars(statement.order_by(TicketMessage.id.desc()).limit(limit + 1))).all()
+        has_more = len(messages) > limit
+        messages = list(reversed(messages[:limit]))
+    
+    senders = await resolve_message_senders(messages, db)
+    previews = await resolve_message_previews(messages, db)
+    updated_at = ticket.updated_at.isoformat() if ticket.updated_at else None
+    header = serialize_ticket_header(ticket) if updated_at != ticket_updated_at else None
     
-    # Если тикет был закрыт (изменен на archive), отправляем уведомление клиенту
-    if old_status != "archive" and ticket.status == "archive":
-        # Определяем текст уведомления в зависимости от решения
-        if ticket.resolution == "refuse":
-            notification_message = f"""
+    return {
+        "ticket": header,
+        "ticket_updated_at": updated_at,
+        "messages": [serialize_ticket_message(msg, senders, previews) for msg in messages],
+        "has_more": has_more
+    }
+
+def build_closure_notification(ticket: ActiveTicket) -> str:
+    """Текст уведомления клиенту о закрытии тикета в зависимости от решения"""
+    if ticket.resolution == "refuse":
+        return f"""
 ❌ **Тикет #{ticket.id} закрыт**
 
 Решение: **Отказ**
@@ -722,8 +946,8 @@ def update_ticket(ticket_id: int, request: UpdateTicketRequest, db: Session = De
 
 🤖 С уважением, служба поддержки ZAZA
 """
-        elif ticket.resolution == "refund":
-            notification_message = f"""
+    elif ticket.resolution == "refund":
+        return f"""
 💰 **Тикет #{ticket.id} закрыт**
 
 Решение: **Возврат**
@@ -734,9 +958,9 @@ def update_ticket(ticket_id: int, request: UpdateTicketRequest, db: Session = De
 
 🤖 С уважением, служба поддержки ZAZA
 """
-        else:
-            resolution_text = ticket.resolution or "Тикет закрыт, решение принято"
-            notification_message = f"""
+    else:
+        resolution_text = ticket.resolution or "Тикет закрыт, решение принято"
+        return f"""
 ✅ **Тикет #{ticket.id} закрыт**
 
 {resolution_text}
@@ -745,9 +969,57 @@ def update_ticket(ticket_id: int, request: UpdateTicketRequest, db: Session = De
 
 🤖 С уважением, служба поддержки ZAZA
 """
-        
-        # Отправляем уведомление пользователю
-        send_telegram_message(ticket.telegram_user_id, notification_message, db)
+
+class UpdateTicketRequest(BaseModel):
+    note: str = None
+    status: str = None
+    resolution: str = None
+
+@app.put("/api/tickets/{ticket_id}")
+async def update_ticket(ticket_id: int, request: UpdateTicketRequest, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """Обновить тикет (заметка, статус, решение)"""
+    ticket = await db.get(ActiveTicket, ticket_id)
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Тикет не найден")
+    
+    # Если пользователь - курьер, запрещаем обновление тикета
+    if await get_courier_id(db, current_user) is not None:
+        raise HTTPException(status_code=403, detail="Доступ запрещен. Курьеры не могут изменять тикеты")
+    
+    # Сохраняем старый статус для проверки изменений
+    old_status = ticket.status
+    old_resolution = ticket.resolution
+    
+    if request.note is not None:
+        ticket.note = request.note
+    if request.status is not None:
+        ticket.status = request.status
+    if request.resolution is not None:
+        ticket.resolution = request.resolution
+    
+    await record_ticket_changed_async(
+        db,
+        ticket.telegram_user_id,
+        {"status": old_status, "resolution": old_resolution},
+        {"status": ticket.status, "resolution": ticket.resolution}
+    )
+    await publish_event_async(db, TICKET_UPDATED, {
+        "ticket_id": ticket.id,
+        "status": ticket.status,
+        "old_status": old_status,
+        "resolution": ticket.resolution,
+        "telegram_user_id": ticket.telegram_user_id,
+        "courier_id": ticket.courier_id
+    })
+    
+    # Если тикет был закрыт (изменен на archive), уведомление клиенту
+    # ставится в outbox в той же транзакции, что и смена статуса
+    if old_status != "archive" and ticket.status == "archive":
+        enqueue_telegram_message(db, ticket.telegram_user_id, build_closure_notification(ticket), bot_id=ticket.bot_id)
+    
+    await db.commit()
+    await db.refresh(ticket)
+    outbox_dispatcher.wake()
     
     return {"message": "Тикет обновлен успешно"}
 
@@ -756,18 +1028,9 @@ class SendMessageRequest(BaseModel):
     message_type: str = "text"
     
 @app.post("/api/tickets/{ticket_id}/messages")
-def send_message_to_ticket(ticket_id: int, request: SendMessageRequest, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+async def send_message_to_ticket(ticket_id: int, request: SendMessageRequest, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
     """Отправить сообщение в тикет от админа или сотрудника"""
-    ticket = db.query(ActiveTicket).filter(ActiveTicket.id == ticket_id).first()
-    if not ticket:
-        raise HTTPException(status_code=404, detail="Тикет не найден")
-    
-    # Если пользователь - курьер, проверяем доступ к тикету
-    if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-        if employee and employee.role == "courier":
-            if ticket.courier_id != employee.id:
-                raise HTTPException(status_code=403, detail="Доступ запрещен. Вы не приглашены к этому тикету")
+    ticket = await get_ticket_for_user(ticket_id, db, current_user)
     
     # Определяем отправителя сообщения и роль
     sender_role = None
@@ -781,7 +1044,7 @@ def send_message_to_ticket(ticket_id: int, request: SendMessageRequest, db: Sess
         is_from_admin = True
     else:
         # Сообщение от сотрудника
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
+        employee = await db.scalar(select(Employee).where(Employee.login == current_user["username"]))
         if employee:
             sender_id = f"employee_{employee.id}"
             sender_role = employee.role
@@ -810,33 +1073,49 @@ def send_message_to_ticket(ticket_id: int, request: SendMessageRequest, db: Sess
         content=request.content,
         is_from_admin=is_from_admin,
         sender_role=sender_role,
-        sender_name=sender_name
+        sender_name=sender_name,
+        delivery_status="pending"
     )
     
     db.add(message)
-    db.commit()
+    await db.flush()
+    # Отправку в Telegram выполнит диспетчер outbox - ответ не ждет Telegram
+    enqueue_telegram_message(db, ticket.telegram_user_id, formatted_message, bot_id=ticket.bot_id, ticket_message_id=message.id)
+    await publish_event_async(db, MESSAGE_CREATED, {
+        "ticket_id": ticket_id,
+        "message_id": message.id,
+        "is_from_admin": True,
+        "courier_id": ticket.courier_id
+    })
+    await db.commit()
+    outbox_dispatcher.wake()
     
-    # Отправляем форматированное сообщение пользователю через Telegram Bot API
-    success = send_telegram_message(ticket.telegram_user_id, formatted_message, db)
-    
-    if success:
-        return {"message": "Сообщение отправлено"}
-    else:
-        raise HTTPException(status_code=500, detail="Ошибка отправки сообщения в Telegram")
+    return {
+        "message": "Сообщение поставлено в очередь на отправку",
+        "message_id": message.id,
+        "delivery_status": message.delivery_status
+    }
 
 @app.post("/api/tickets/{ticket_id}/send-file")
 async def send_file_to_ticket(
     ticket_id: int, 
-    file: UploadFile = File(...), 
-    db: Session = Depends(get_db), 
+    request: Request,
+    db: AsyncSession = Depends(get_async_db), 
     current_user: dict = Depends(get_current_user)
 ):
-    """Отправляет файл клиенту в Telegram и сохраняет в БД"""
+    """Отправляет файл клиенту в Telegram и сохраняет в БД
+    
+    Файл (поле file multipart-запроса) принимается потоком с ограничением
+    размера MAX_UPLOAD_SIZE_MB, а не через UploadFile целиком.
+    """
     
     # Проверяем существование тикета
-    ticket = db.query(ActiveTicket).filter(ActiveTicket.id == ticket_id).first()
+    ticket = await db.get(ActiveTicket, ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="Тикет не найден")
+    bot_id, telegram_user_id, courier_id = ticket.bot_id, ticket.telegram_user_id, ticket.courier_id
+    # Не держим соединение пула, пока файл загружается
+    await db.rollback()
     
     # Определяем отправителя
     sender_id = str(current_user.get('id', 'unknown'))
@@ -845,153 +1124,190 @@ async def send_file_to_ticket(
     sender_name = current_user.get('name', 'Админ')
     
     try:
-        # Создаем папку для файлов, если её нет
-        backend_dir = Path(__file__).parent
-        media_dir = backend_dir / "media"
-        media_dir.mkdir(exist_ok=True)
-        
-        # Генерируем уникальное имя файла
-        file_extension = Path(file.filename).suffix if file.filename else ""
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = media_dir / unique_filename
-        
-        # Сохраняем файл
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Определяем тип сообщения по расширению файла
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
-        video_extensions = {'.mp4', '.avi', '.mov', '.mkv'}
+        # Запись на диск, SHA-256 и тип по содержимому - в одном проходе по мере приема
+        received = await receive_file(request)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    
+    try:
+        # Одинаковый файл, отправленный повторно, хранится один раз
+        stored = await media_store.put(received.temp_path, received.sha256, received.size, received.extension)
+        preview_generator.schedule_stored(stored)
+        file_path = media_store.media_root / stored["local_path"]
         
-        if file_extension.lower() in image_extensions:
-            message_type = "photo"
-        elif file_extension.lower() in video_extensions:
-            message_type = "video"
-        else:
-            message_type = "document"
+        # Тип сообщения - по содержимому файла, а не по расширению
+        message_type = received.message_type
         
         # Создаем сообщение в БД
         message = TicketMessage(
             ticket_id=ticket_id,
             telegram_user_id=sender_id,
             message_type=message_type,
-            content=f"Файл: {file.filename}",
-            file_id="",  # Будет заполнено после отправки в Telegram
-            local_file_path=str(file_path.relative_to(backend_dir)),
-            original_filename=file.filename,
-            file_size=file_path.stat().st_size,
+            content=f"Файл: {received.filename}",
+            file_id="",  # Заполняется ответом Telegram после отправки
+            local_file_path=stored["local_path"],
+            original_filename=received.filename,
+            file_size=received.size,
+            file_sha256=received.sha256,
             is_from_admin=is_from_admin,
             sender_role=sender_role,
             sender_name=sender_name
         )
         
         db.add(message)
-        db.commit()
+        await db.flush()
+        await reference_media_async(db, [received.sha256])
+        await publish_event_async(db, MESSAGE_CREATED, {
+            "ticket_id": ticket_id,
+            "message_id": message.id,
+            "is_from_admin": True,
+            "courier_id": courier_id
+        })
+        await db.commit()
         
-        # Отправляем файл в Telegram
-        success = await send_file_to_telegram(
-            user_id=ticket.telegram_user_id,
+        # Отправляем файл в Telegram: тело запроса читается с диска потоком
+        sent = await send_file_to_telegram(
+            bot_id=bot_id,
+            user_id=telegram_user_id,
             file_path=file_path,
+            sha256=received.sha256,
             message_type=message_type,
-            caption=f"{sender_role.capitalize()}:\n\n📎 {file.filename}",
-            db=db
+            caption=f"{sender_role.capitalize()}:\n\n📎 {received.filename}",
+            # На диске файл назван хэшем содержимого - клиент получает исходное имя
+            filename=received.filename,
+            content_type=received.content_type or "application/octet-stream"
         )
         
-        if success:
+        if sent is not None:
+            # file_id нужен для повторной отправки и пересылки без загрузки
+            message.file_id = extract_file_id(sent, message_type) or ""
+            message.telegram_message_id = sent.get("message_id")
+            await db.commit()
             return {"message": "Файл отправлен"}
         else:
-            # Удаляем сообщение из БД если не удалось отправить в Telegram
-            db.delete(message)
-            db.commit()
-            # Удаляем файл
-            if file_path.exists():
-                file_path.unlink()
+            # Удаляем сообщение из БД если не удалось отправить в Telegram.
+            # Файл может быть общим с другими сообщениями - его удалит сборка мусора без ссылок
+            await db.delete(message)
+            await release_media_async(db, [received.sha256])
+            await db.commit()
             raise HTTPException(status_code=500, detail="Ошибка отправки файла в Telegram")
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при отправке файла: {e}")
-        # Очищаем файл при ошибке
-        if 'file_path' in locals() and file_path.exists():
-            file_path.unlink()
+        # Временный файл остается, только если до хранилища дело не дошло
+        received.temp_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Ошибка при отправке файла: {str(e)}")
 
+async def courier_can_access_media(courier_id: int, file_path: str) -> bool:
+    """Есть ли файл в сообщениях тикетов, куда приглашен курьер"""
+    sha256 = content_hash(file_path)
+    if sha256:
+        # Файл хранилища или его превью - по хэшу содержимого
+        condition = TicketMessage.file_sha256 == sha256
+    else:
+        condition = TicketMessage.local_file_path == file_path
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(
+            select(TicketMessage.id).join(ActiveTicket, ActiveTicket.id == TicketMessage.ticket_id)
+            .where(condition, ActiveTicket.courier_id == courier_id).limit(1)
+        ) is not None
+
 @app.get("/api/media/{file_path:path}")
-def get_media_file(file_path: str):
-    """Отдает медиафайлы (фото, видео, документы)"""
-    try:
-        # Безопасно формируем путь к файлу в backend/media/
-        backend_dir = Path(__file__).parent
-        file_full_path = backend_dir / "media" / file_path
-        media_dir = backend_dir / "media"
-        
-        # Проверяем, что файл существует и находится в папке media
-        if not file_full_path.exists() or not str(file_full_path.resolve()).startswith(str(media_dir.resolve())):
+async def get_media_file(file_path: str, request: Request, current_user: dict = Depends(get_media_user)):
+    """Отдает медиафайлы (фото, видео, документы)
+    
+    Доступ проверяется здесь, а байты в production отдает nginx (MEDIA_ACCEL_REDIRECT).
+    """
+    # Безопасно формируем путь к файлу в backend/media/
+    full_path = await asyncio.to_thread(resolve_media_path, media_store.media_root, file_path)
+    if full_path is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    # Курьер видит только вложения тикетов, куда он приглашен
+    if current_user["type"] == "employee" and current_user.get("role") == "courier":
+        if not await courier_can_access_media(current_user["id"], file_path):
             raise HTTPException(status_code=404, detail="Файл не найден")
-        
-        # Определяем MIME-type
-        mime_types = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg', 
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.mp4': 'video/mp4',
-            '.avi': 'video/avi',
-            '.mov': 'video/quicktime',
-            '.pdf': 'application/pdf',
-            '.doc': 'application/msword',
-            '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        }
-        
-        file_extension = file_full_path.suffix.lower()
-        media_type = mime_types.get(file_extension, 'application/octet-stream')
-        
-        return FileResponse(
-            path=str(file_full_path),
-            media_type=media_type,
-            filename=file_full_path.name
-        )
-        
-    except Exception as e:
-        logger.error(f"Ошибка при отдаче медиафайла {file_path}: {e}")
-        raise HTTPException(status_code=500, detail="Ошибка сервера")
+    
+    return await media_response(request, full_path, file_path)
 
 @app.get("/backend/media/{file_path:path}")
-def get_backend_media_file(file_path: str):
+async def get_backend_media_file(file_path: str, request: Request, current_user: dict = Depends(get_media_user)):
     """Альтернативный маршрут для медиафайлов через /backend/media/"""
-    return get_media_file(file_path)
+    return await get_media_file(file_path, request, current_user)
 
 # === КЛИЕНТЫ ===
 
+CLIENT_SORT_COLUMNS = {
+    "last_activity": ClientStats.last_activity_at,
+    "tickets_count": ClientStats.tickets_count,
+    "created_at": Client.created_at,
+    "username": Client.telegram_username,
+}
+
+# Точное количество клиентов считается не дальше этого числа, больше - оценка планировщика
+CLIENT_COUNT_CAP = 10000
+
 @app.get("/api/clients")
-def get_clients(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Получить список всех клиентов с количеством тикетов"""
+async def get_clients(
+    page: int = Query(1, ge=1),
+    limit: int = Query(50, ge=1, le=200),
+    search: Optional[str] = None,
+    sort: str = Query("last_activity", pattern="^(last_activity|tickets_count|created_at|username)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    is_blocked: Optional[bool] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Получить страницу клиентов с количеством тикетов
+    
+    Страница выбирается по индексам client_stats (сортировка по активности
+    и числу тикетов) и останавливается на limit строках. Общее количество -
+    отдельный запрос с ограничением CLIENT_COUNT_CAP; если клиентов больше,
+    отдается оценка планировщика (total_is_estimate).
+    """
+    
+    # Строка client_stats есть у каждого клиента (ведется при записи тикетов, старые
+    # данные заполняет backfill_client_stats) - внутреннее соединение позволяет идти по ее индексам
+    filters = []
+    if search and search.strip():
+        term = search.strip().lstrip("@")
+        filters.append(or_(
+            Client.telegram_username.icontains(term, autoescape=True),
+            Client.first_name.icontains(term, autoescape=True),
+            Client.last_name.icontains(term, autoescape=True),
+            Client.telegram_user_id.startswith(term, autoescape=True)
+        ))
+    if is_blocked is not None:
+        filters.append(Client.is_blocked == is_blocked)
+    
+    statement = select(
+        Client,
+        ClientStats.tickets_count,
+        ClientStats.last_activity_at
+    ).join(ClientStats, ClientStats.telegram_user_id == Client.telegram_user_id).where(*filters)
+    
+    sort_column = CLIENT_SORT_COLUMNS[sort]
+    if sort_column.class_ is ClientStats:
+        # Порядок NULL как у индекса (обратный проход для desc) - сортировка идет по индексу
+        sort_key = sort_column.desc() if order == "desc" else sort_column.asc()
+    else:
+        sort_key = sort_column.desc().nullslast() if order == "desc" else sort_column.asc().nullsfirst()
+    statement = statement.order_by(sort_key, Client.id.desc() if order == "desc" else Client.id.asc())
     
-    # Получаем всех уникальных клиентов из тикетов
-    clients_from_tickets = db.query(
-        ActiveTicket.telegram_user_id,
-        ActiveTicket.telegram_username
-    ).distinct().all()
+    rows = (await db.execute(statement.offset((page - 1) * limit).limit(limit))).all()
     
-    clients_data = []
+    matching = select(Client.id).join(
+        ClientStats, ClientStats.telegram_user_id == Client.telegram_user_id
+    ).where(*filters)
+    total = await db.scalar(select(func.count()).select_from(matching.limit(CLIENT_COUNT_CAP).subquery()))
+    total_is_estimate = total >= CLIENT_COUNT_CAP
+    if total_is_estimate:
+        total = max(await estimate_query_count(db, matching) or 0, CLIENT_COUNT_CAP)
     
-    for client_ticket in clients_from_tickets:
-        # Проверяем есть ли клиент в таблице clients
-        client = db.query(Client).filter(Client.telegram_user_id == client_ticket.telegram_user_id).first()
-        
-        # Если нет - создаем
-        if not client:
-            client = Client(
-                telegram_user_id=client_ticket.telegram_user_id,
-                telegram_username=client_ticket.telegram_username,
-                is_blocked=False
-            )
-            db.add(client)
-            db.commit()
-            db.refresh(client)
-        
-        # Считаем количество тикетов клиента
-        tickets_count = db.query(ActiveTicket).filter(ActiveTicket.telegram_user_id == client.telegram_user_id).count()
-        
+    clients_data = []
+    for client, tickets_count, last_activity_at in rows:
         clients_data.append({
             "id": client.id,
             "telegram_user_id": client.telegram_user_id,
@@ -1000,62 +1316,78 @@ def get_clients(db: Session = Depends(get_db), current_user: dict = Depends(get_
             "last_name": client.last_name,
             "is_blocked": client.is_blocked,
             "tickets_count": tickets_count,
+            "last_activity_at": last_activity_at.isoformat() if last_activity_at else None,
             "created_at": client.created_at.isoformat() if client.created_at else None,
             "updated_at": client.updated_at.isoformat() if client.updated_at else None
         })
     
-    return {"clients": clients_data}
+    return {
+        "clients": clients_data,
+        "pagination": {
+            "page": page,
+            "limit": limit,
+            "total": total,
+            "total_is_estimate": total_is_estimate,
+            "pages": (total + limit - 1) // limit
+        }
+    }
+
+MESSAGE_PREVIEW_LENGTH = 200
 
 @app.get("/api/clients/{client_id}")
-def get_client_details(client_id: int, page: int = 1, limit: int = 10, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    """Получить детали клиента с его тикетами"""
+async def get_client_details(client_id: int, page: int = Query(1, ge=1), limit: int = Query(10, ge=1, le=100), db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
+    """Получить детали клиента со страницей его тикетов
     
-    client = db.query(Client).filter(Client.id == client_id).first()
+    Сообщения не встраиваются: для каждого тикета отдаются количество и последнее сообщение,
+    сама переписка загружается отдельно через /api/tickets/{id}/messages.
+    """
+    
+    client = await db.get(Client, client_id)
     if not client:
         raise HTTPException(status_code=404, detail="Клиент не найден")
     
-    # Получаем общее количество тикетов
-    total_tickets = db.query(ActiveTicket).filter(ActiveTicket.telegram_user_id == client.telegram_user_id).count()
+    # Статистика по категориям и решениям из сводных таблиц
+    category_stats, resolution_stats, total_tickets = await get_client_breakdown_async(db, client.telegram_user_id)
     
     # Получаем тикеты с пагинацией
     offset = (page - 1) * limit
-    tickets = db.query(ActiveTicket).filter(ActiveTicket.telegram_user_id == client.telegram_user_id).order_by(ActiveTicket.created_at.desc()).offset(offset).limit(limit).all()
-    
-    # Подсчитываем статистику по всем тикетам клиента
-    all_tickets = db.query(ActiveTicket).filter(ActiveTicket.telegram_user_id == client.telegram_user_id).all()
-    
-    # Статистика по категориям
-    category_stats = {}
-    resolution_stats = {}
-    
-    for t in all_tickets:
-        # Статистика категорий
-        if t.category:
-            category_stats[t.category] = category_stats.get(t.category, 0) + 1
+    tickets = (await db.scalars(select(ActiveTicket).where(
+        ActiveTicket.telegram_user_id == client.telegram_user_id
+    ).order_by(ActiveTicket.created_at.desc(), ActiveTicket.id.desc()).offset(offset).limit(limit))).all()
+    
+    ticket_ids = [ticket.id for ticket in tickets]
+    messages_counts = {}
+    last_messages = {}
+    if ticket_ids:
+        # Количество сообщений по тикетам страницы - один GROUP BY
+        messages_counts = dict((await db.execute(select(
+            TicketMessage.ticket_id,
+            func.count(TicketMessage.id)
+        ).where(TicketMessage.ticket_id.in_(ticket_ids)).group_by(TicketMessage.ticket_id))).all())
         
-        # Статистика резолюций
-        if t.resolution:
-            resolution_stats[t.resolution] = resolution_stats.get(t.resolution, 0) + 1
+        # Последнее сообщение каждого тикета - один DISTINCT ON
+        last_messages = {
+            msg.ticket_id: msg
+            for msg in (await db.scalars(select(TicketMessage).where(
+                TicketMessage.ticket_id.in_(ticket_ids)
+            ).distinct(TicketMessage.ticket_id).order_by(TicketMessage.ticket_id, TicketMessage.id.desc()))).all()
+        }
     
     tickets_data = []
     for ticket in tickets:
-        # Получаем сообщения для каждого тикета
-        messages = db.query(TicketMessage).filter(TicketMessage.ticket_id == ticket.id).order_by(TicketMessage.created_at).all()
-        
-        messages_data = []
-        for msg in messages:
-            messages_data.append({
-                "id": msg.id,
-                "telegram_user_id": msg.telegram_user_id,
-                "message_type": msg.message_type,
-                "content": msg.content,
-                "file_id": msg.file_id,
-                "local_file_path": msg.local_file_path,
-                "original_filename": msg.original_filename,
-                "file_size": msg.file_size,
-                "is_from_admin": msg.is_from_admin,
-                "created_at": msg.created_at.isoformat() if msg.created_at else None
-            })
+        last_message = last_messages.get(ticket.id)
+        last_message_data = None
+        if last_message:
+            content = last_message.content or ""
+            last_message_data = {
+                "id": last_message.id,
+                "message_type": last_message.message_type,
+                "content": content[:MESSAGE_PREVIEW_LENGTH],
+                "is_truncated": len(content) > MESSAGE_PREVIEW_LENGTH,
+                "original_filename": last_message.original_filename,
+                "is_from_admin": last_message.is_from_admin,
+                "created_at": last_message.created_at.isoformat() if last_message.created_at else None
+            }
         
         tickets_data.append({
             "id": ticket.id,
@@ -1068,7 +1400,8 @@ def get_client_details(client_id: int, page: int = 1, limit: int = 10, db: Sessi
             "note": ticket.note,
             "created_at": ticket.created_at.isoformat() if ticket.created_at else None,
             "updated_at": ticket.updated_at.isoformat() if ticket.updated_at else None,
-            "messages": messages_data
+            "messages_count": messages_counts.get(ticket.id, 0),
+            "last_message": last_message_data
         })
     
     return {
@@ -1097,16 +1430,16 @@ def get_client_details(client_id: int, page: int = 1, limit: int = 10, db: Sessi
     }
 
 @app.put("/api/clients/{client_id}/block")
-def toggle_client_block(client_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+async def toggle_client_block(client_id: int, db: AsyncSession = Depends(get_async_db), current_user: dict = Depends(get_current_user)):
     """Заблокировать/разблокировать клиента"""
     
-    client = db.query(Client).filter(Client.id == client_id).first()
+    client = await db.get(Client, client_id)
     if not client:
         raise HTTPException(status_code=404, detail="Клиент не найден")
     
     # Переключаем статус блокировки
     client.is_blocked = not client.is_blocked
-    db.commit()
+    await db.commit()
     
     action = "заблокирован" if client.is_blocked else "разблокирован"
     
@@ -1293,8 +1626,11 @@ def create_employee(employee_data: EmployeeCreate, db: Session = Depends(get_db)
     )
     
     db.add(employee)
+    db.flush()
+    publish_event(db, EMPLOYEE_CHANGED, {"employee_id": employee.id})
     db.commit()
     db.refresh(employee)
+    employee_directory.invalidate()
     
     return {
         "message": "Сотрудник создан успешно",
@@ -1353,8 +1689,10 @@ def update_employee(employee_id: int, employee_data: EmployeeUpdate, db: Session
     if employee_data.password:
         employee.hashed_password = get_password_hash(employee_data.password)
     
+    publish_event(db, EMPLOYEE_CHANGED, {"employee_id": employee.id})
     db.commit()
     db.refresh(employee)
+    employee_directory.invalidate()
     
     return {
         "message": "Данные сотрудника обновлены успешно",
@@ -1407,7 +1745,9 @@ def delete_employee(employee_id: int, db: Session = Depends(get_db), current_use
     
     # Удаляем сотрудника
     db.delete(employee)
+    publish_event(db, EMPLOYEE_CHANGED, {"employee_id": employee_id})
     db.commit()
+    employee_directory.invalidate()
     
     return {"message": "Сотрудник удален успешно"}
 
@@ -1431,61 +1771,56 @@ def get_active_couriers(db: Session = Depends(get_db), current_user: dict = Depe
     return {"couriers": couriers_data}
 
 @app.post("/api/tickets/{ticket_id}/invite-courier")
-def invite_courier_to_ticket(
+async def invite_courier_to_ticket(
     ticket_id: int, 
     courier_data: dict,
-    db: Session = Depends(get_db), 
+    db: AsyncSession = Depends(get_async_db), 
     current_user: dict = Depends(get_current_user)
 ):
     """Пригласить курьера в тикет (только для операторов и админов)"""
     
     # Проверяем, что пользователь не курьер
+    employee = None
     if current_user["type"] == "employee":
-        employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
+        employee = await db.scalar(select(Employee).where(Employee.login == current_user["username"]))
         if employee and employee.role == "courier":
             raise HTTPException(status_code=403, detail="Доступ запрещен. Курьеры не могут приглашать других курьеров")
     
     # Находим тикет
-    ticket = db.query(ActiveTicket).filter(ActiveTicket.id == ticket_id).first()
+    ticket = await db.get(ActiveTicket, ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="Тикет не найден")
     
     # Проверяем курьера
     courier_id = courier_data.get("courier_id")
-    courier = db.query(Employee).filter(
+    courier = await db.scalar(select(Employee).where(
         Employee.id == courier_id,
         Employee.role == "courier",
         Employee.is_active == True
-    ).first()
+    ))
     
     if not courier:
         raise HTTPException(status_code=404, detail="Курьер не найден или неактивен")
     
     # Приглашаем курьера
     ticket.courier_id = courier_id
-    db.commit()
+    await publish_event_async(db, COURIER_INVITED, {
+        "ticket_id": ticket_id,
+        "courier_id": courier_id
+    })
+    
+    # Определяем кто назначает курьера для правильного отображения роли
+    if employee and employee.role == "operator":
+        role_display = "Оператор"
+    else:
+        role_display = "Админ"
     
-    # Отправляем уведомление клиенту о назначении курьера
-    try:
-        # Определяем кто назначает курьера для правильного отображения роли
-        if current_user["type"] == "user":
-            role_display = "Админ"
-        else:
-            employee = db.query(Employee).filter(Employee.login == current_user["username"]).first()
-            if employee and employee.role == "operator":
-                role_display = "Оператор"
-            else:
-                role_display = "Админ"
-        
-        notification_message = f"{role_display}:\n\n📦 К вашему тикету #{ticket_id} был назначен курьер для решения проблемы.\n\nКурьер свяжется с вами в ближайшее время."
-        
-        send_telegram_message(
-            user_id=ticket.telegram_user_id,
-            message=notification_message,
-            db=db
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки уведомления клиенту о назначении курьера: {e}")
+    notification_message = f"{role_display}:\n\n📦 К вашему тикету #{ticket_id} был назначен курьер для решения проблемы.\n\nКурьер свяжется с вами в ближайшее время."
+    
+    # Уведомление клиенту о назначении курьера уходит через outbox
+    enqueue_telegram_message(db, ticket.telegram_user_id, notification_message, bot_id=ticket.bot_id)
+    await db.commit()
+    outbox_dispatcher.wake()
     
     return {
         "message": f"Курьер {courier.name} приглашен в тикет #{ticket_id}",
@@ -1496,5 +1831,4 @@ def invite_courier_to_ticket(
     }
 
 if __name__ == "__main__":
-    create_tables()
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
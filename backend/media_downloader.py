@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Downloader - Асинхронное скачивание медиа клиентов из Telegram
+Файл скачивается потоком кусками, запись на диск и SHA-256 считаются
+в том же проходе вне event loop, готовый файл попадает в хранилище по
+содержимому. Файл, уже скачанный раньше (тот же file_unique_id), повторно
+не скачивается. Число одновременных скачиваний ограничено на процесс
+и на бота, каждое скачивание ограничено по времени.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import httpx
+
+from telegram_api import telegram_clients, TelegramAPIError
+from media_store import media_store, MediaStore
+from media_previews import preview_generator
+
+logger = logging.getLogger(__name__)
+
+# Telegram Bot API отдает ботам файлы до 20 МБ
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+
+DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "120"))
+GLOBAL_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_CONCURRENCY", "8"))
+PER_BOT_CONCURRENCY = int(os.getenv("MEDIA_DOWNLOAD_PER_BOT", "3"))
+
+class FileTooLarge(Exception):
+    """Файл больше, чем Telegram разрешает скачать боту"""
+
+class MediaDownloader:
+    """Скачивание файлов Telegram с ограничением параллельности"""
+
+    def __init__(self, store: MediaStore = media_store, global_limit: int = GLOBAL_CONCURRENCY,
+                 per_bot_limit: int = PER_BOT_CONCURRENCY, timeout: float = DOWNLOAD_TIMEOUT):
+        self.store = store
+        self.per_bot_limit = per_bot_limit
+        self.timeout = timeout
+        self._global = asyncio.Semaphore(global_limit)
+        self._per_bot: Dict[object, asyncio.Semaphore] = {}
+
+    def _bot_semaphore(self, bot_key) -> asyncio.Semaphore:
+        semaphore = self._per_bot.get(bot_key)
+        if semaphore is None:
+            semaphore = self._per_bot[bot_key] = asyncio.Semaphore(self.per_bot_limit)
+        return semaphore
+
+    async def download(self, token: str, file_id: str, bot_key=None,
+                       file_unique_id: Optional[str] = None) -> Optional[dict]:
+        """Скачивает файл и возвращает local_path, original_filename, file_size, sha256
+
+        None, если файл слишком большой, не скачался за отведенное время
+        или Telegram вернул ошибку. Для уже сохраненного file_unique_id
+        original_filename - None: имя файла на серверах Telegram без getFile неизвестно.
+        """
+        if file_unique_id:
+            try:
+                stored = await self.store.find_telegram_file(file_unique_id)
+            except Exception as e:
+                logger.warning(f"Ошибка поиска файла {file_unique_id} в хранилище: {e}")
+                stored = None
+            if stored:
+                return {**stored, "original_filename": None}
+
+        # Сначала слот бота, потом общий: очередь одного бота не занимает общие слоты
+        async with self._bot_semaphore(bot_key if bot_key is not None else token):
+            async with self._global:
+                try:
+                    return await asyncio.wait_for(self._download(token, file_id, file_unique_id), timeout=self.timeout)
+                except FileTooLarge as e:
+                    logger.warning(f"Файл слишком большой для скачивания: {e}")
+                except asyncio.TimeoutError:
+                    logger.error(f"Скачивание файла {file_id} не уложилось в {self.timeout} с")
+                except (TelegramAPIError, httpx.HTTPError, OSError) as e:
+                    logger.error(f"Ошибка скачивания файла {file_id}: {e}")
+                return None
+
+    async def _download(self, token: str, file_id: str, file_unique_id: Optional[str]) -> dict:
+        client = telegram_clients.get(token)
+        file_info = await client.get_file(file_id)
+        file_path = file_info["file_path"]
+        if (file_info.get("file_size") or 0) > MAX_DOWNLOAD_SIZE:
+            raise FileTooLarge(f"{file_info['file_size'] / (1024 * 1024):.1f} МБ (максимум {MAX_DOWNLOAD_SIZE // (1024 * 1024)} МБ)")
+
+        # Недокачанный файл не должен быть виден под итоговым именем
+        temp_path = await asyncio.to_thread(self.store.temp_path)
+
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            async with client.stream_file(file_path) as response:
+                with open(temp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > MAX_DOWNLOAD_SIZE:
+                            raise FileTooLarge(f"больше {MAX_DOWNLOAD_SIZE // (1024 * 1024)} МБ")
+                        await asyncio.to_thread(_write_chunk, f, hasher, chunk)
+            stored = await self.store.put(
+                temp_path, hasher.hexdigest(), size, Path(file_path).suffix, file_unique_id=file_unique_id
+            )
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        preview_generator.schedule_stored(stored)
+        # local_path - относительный путь от media/
+        return {**stored, "original_filename": Path(file_path).name}
+
+def _write_chunk(f, hasher, chunk: bytes):
+    # hashlib и запись в файл отпускают GIL - выполняем в пуле потоков
+    hasher.update(chunk)
+    f.write(chunk)
+
+# Загрузчик процесса (общий для всех ботов менеджера)
+media_downloader = MediaDownloader()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Groups - Сборка альбомов клиента в одну пачку
+Telegram присылает каждое фото альбома отдельным обновлением с общим
+media_group_id. Сообщения альбома копятся, пока новые не перестанут
+приходить MEDIA_GROUP_DELAY секунд, и обрабатываются одним вызовом:
+параллельное скачивание, одна запись в базу и один ответ клиенту.
+"""
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Message
+
+logger = logging.getLogger(__name__)
+
+# Пауза после последнего сообщения альбома, после которой он считается полным
+MEDIA_GROUP_DELAY = float(os.getenv("MEDIA_GROUP_DELAY", "1.0"))
+
+OnComplete = Callable[[List[Message]], Awaitable[None]]
+
+@dataclass
+class PendingGroup:
+    chat_id: int
+    on_complete: OnComplete
+    messages: List[Message] = field(default_factory=list)
+    timer: Optional[asyncio.Task] = None
+
+class MediaGroupCollector:
+    """Альбомы, которые еще собираются, и альбомы в обработке"""
+
+    def __init__(self, delay: float = MEDIA_GROUP_DELAY):
+        self.delay = delay
+        self._groups: Dict[str, PendingGroup] = {}
+        self._flushing: Dict[int, Set[asyncio.Task]] = {}
+
+    def is_pending(self, media_group_id: Optional[str]) -> bool:
+        return media_group_id is not None and media_group_id in self._groups
+
+    def add(self, message: Message, on_complete: OnComplete):
+        """Добавляет сообщение в альбом; on_complete получит все сообщения альбома
+
+        on_complete первого сообщения альбома используется для всего альбома.
+        """
+        group_id = message.media_group_id
+        group = self._groups.get(group_id)
+        if group is None:
+            group = self._groups[group_id] = PendingGroup(message.chat_id, on_complete)
+        group.messages.append(message)
+        if group.timer is not None:
+            group.timer.cancel()
+        group.timer = asyncio.create_task(self._flush_later(group_id))
+
+    async def _flush_later(self, group_id: str):
+        await asyncio.sleep(self.delay)
+        self._start_flush(group_id)
+
+    def _start_flush(self, group_id: str):
+        group = self._groups.pop(group_id, None)
+        if group is None:
+            return
+        messages = sorted(group.messages, key=lambda message: message.message_id)
+        task = asyncio.create_task(self._complete(group, messages))
+        tasks = self._flushing.setdefault(group.chat_id, set())
+        tasks.add(task)
+
+        def _done(_task):
+            tasks.discard(_task)
+            if not tasks and self._flushing.get(group.chat_id) is tasks:
+                del self._flushing[group.chat_id]
+
+        task.add_done_callback(_done)
+
+    async def _complete(self, group: PendingGroup, messages: List[Message]):
+        try:
+            await group.on_complete(messages)
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома из {len(messages)} сообщений в чате {group.chat_id}: {e}")
+
+    async def flush_chat(self, chat_id: int):
+        """Дообрабатывает альбомы чата (перед следующим сообщением того же чата)"""
+        for group_id, group in list(self._groups.items()):
+            if group.chat_id == chat_id:
+                group.timer.cancel()
+                self._start_flush(group_id)
+        tasks = self._flushing.get(chat_id)
+        if tasks:
+            await asyncio.gather(*list(tasks))
+
+    async def flush_all(self):
+        """Дообрабатывает все альбомы (остановка бота)"""
+        for chat_id in {group.chat_id for group in self._groups.values()} | set(self._flushing):
+            await self.flush_chat(chat_id)
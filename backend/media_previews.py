@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Previews - Фоновые превью вложений тикетов
+После сохранения файла в хранилище для него в фоне делается уменьшенное
+WebP-превью: для фото - сама картинка, для видео - кадр (ffmpeg),
+для PDF - первая страница (pdftoppm). Чат показывает превью, а полный файл
+загружается только по клику. Превью лежит в previews/ab/cd/<sha256>.webp
+и общее для всех сообщений с одинаковым содержимым.
+Файлы, превью которых не успели сделать (перезапуск процесса), подбирает
+generate_pending.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Optional
+
+from sqlalchemy import select, update
+
+from database import AsyncSessionLocal, MediaObject
+from media_store import media_store, MediaStore
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow нужен только для превью
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+PREVIEWS_DIR = "previews"
+# Наибольшая сторона превью в пикселях
+PREVIEW_SIZE = int(os.getenv("MEDIA_PREVIEW_SIZE", "480"))
+PREVIEW_QUALITY = 75
+PREVIEW_CONCURRENCY = int(os.getenv("MEDIA_PREVIEW_CONCURRENCY", "2"))
+# Ограничение времени ffmpeg / pdftoppm на один файл
+TOOL_TIMEOUT = 60
+# Pillow не открывает картинки больше этого числа пикселей (защита от "бомб")
+MAX_IMAGE_PIXELS = 50_000_000
+
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v"}
+PDF_EXTENSIONS = {".pdf"}
+
+# Статусы превью в media_objects.preview_status
+PREVIEW_READY = "ready"
+PREVIEW_NONE = "none"
+PREVIEW_FAILED = "failed"
+
+class PreviewError(Exception):
+    """Превью не удалось сделать"""
+
+def preview_path(sha256: str) -> str:
+    """Путь превью содержимого относительно media/"""
+    return f"{PREVIEWS_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}.webp"
+
+def preview_kind(local_path: str) -> Optional[str]:
+    """photo, video, pdf или None, если превью для такого файла не делается"""
+    extension = Path(local_path).suffix.lower()
+    if extension in PHOTO_EXTENSIONS:
+        return "photo"
+    if extension in VIDEO_EXTENSIONS:
+        return "video"
+    if extension in PDF_EXTENSIONS:
+        return "pdf"
+    return None
+
+def _save_webp(source: Path, target: Path):
+    """Уменьшает картинку и сохраняет WebP (атомарно, через временный файл)"""
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    with Image.open(source) as image:
+        image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))  # JPEG декодируется сразу в уменьшенном размере
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = target.with_name(f".{target.name}.part")
+        try:
+            image.save(temp_path, "WEBP", quality=PREVIEW_QUALITY, method=4)
+            os.replace(temp_path, target)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+async def _run_tool(*args: str):
+    """Запускает внешнюю программу без блокировки event loop"""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=TOOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise PreviewError(f"{args[0]} не уложился в {TOOL_TIMEOUT} с")
+    if process.returncode != 0:
+        raise PreviewError(f"{args[0]} завершился с кодом {process.returncode}: {stderr.decode(errors='replace')[-300:]}")
+
+class PreviewGenerator:
+    """Очередь превью процесса с ограниченной параллельностью"""
+
+    def __init__(self, store: MediaStore = media_store, session_factory=AsyncSessionLocal,
+                 concurrency: int = PREVIEW_CONCURRENCY):
+        self.store = store
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._missing_tools = set()
+
+    def schedule(self, sha256: str, local_path: str):
+        """Ставит превью файла в очередь (повторная постановка того же файла игнорируется)"""
+        if sha256 in self._tasks:
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        task = asyncio.create_task(self._process(sha256, local_path), name=f"preview:{sha256[:12]}")
+        self._tasks[sha256] = task
+        task.add_done_callback(lambda _task: self._tasks.pop(sha256, None))
+
+    def schedule_stored(self, stored: dict):
+        """Ставит в очередь файл, только что записанный в хранилище, если превью еще нет"""
+        if stored.get("preview_status") is None:
+            self.schedule(stored["sha256"], stored["local_path"])
+
+    async def _process(self, sha256: str, local_path: str):
+        async with self._semaphore:
+            kind = preview_kind(local_path)
+            path = None
+            try:
+                if kind is None:
+                    status = PREVIEW_NONE
+                else:
+                    path = preview_path(sha256)
+                    await self._render(kind, self.store.media_root / local_path, self.store.media_root / path)
+                    status = PREVIEW_READY
+            except Exception as e:
+                logger.warning(f"Не удалось сделать превью {local_path}: {e}")
+                status, path = PREVIEW_FAILED, None
+            try:
+                async with self.session_factory() as session:
+                    await session.execute(
+                        update(MediaObject).where(MediaObject.sha256 == sha256)
+                        .values(preview_status=status, preview_path=path)
+                    )
+                    await session.commit()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения превью {local_path}: {e}")
+
+    def _require(self, tool: str):
+        if tool == "Pillow":
+            available = Image is not None
+        else:
+            available = shutil.which(tool) is not None
+        if not available:
+            if tool not in self._missing_tools:
+                self._missing_tools.add(tool)
+                logger.warning(f"{tool} не установлен - превью такого типа не делаются")
+            raise PreviewError(f"нет {tool}")
+
+    async def _render(self, kind: str, source: Path, target: Path):
+        self._require("Pillow")
+        if kind == "photo":
+            await asyncio.to_thread(_save_webp, source, target)
+            return
+
+        # Видео и PDF: кадр или страница во временный PNG, затем то же уменьшение
+        with tempfile.TemporaryDirectory(dir=self.store.temp_dir()) as temp_dir:
+            frame = Path(temp_dir) / "frame.png"
+            if kind == "video":
+                self._require("ffmpeg")
+                # thumbnail выбирает характерный кадр среди первых, а не черный первый
+                await _run_tool(
+                    "ffmpeg", "-v", "error", "-nostdin", "-y", "-i", str(source),
+                    "-vf", f"thumbnail,scale='min({PREVIEW_SIZE},iw)':-2", "-frames:v", "1", str(frame)
+                )
+            else:
+                self._require("pdftoppm")
+                await _run_tool(
+                    "pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-png",
+                    "-scale-to", str(PREVIEW_SIZE), str(source), str(frame.with_suffix(""))
+                )
+            await asyncio.to_thread(_save_webp, frame, target)
+
+    async def generate_pending(self, limit: int = 100, min_age: float = 60) -> int:
+        """Ставит в очередь файлы без превью (после перезапуска или сбоя), возвращает их число
+
+        Файлы моложе min_age секунд пропускаются - их превью, скорее всего, уже делается.
+        """
+        border = datetime.utcnow() - timedelta(seconds=min_age)
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                select(MediaObject.sha256, MediaObject.local_path)
+                .where(MediaObject.preview_status.is_(None), MediaObject.created_at < border)
+                .limit(limit)
+            )).all()
+        for row in rows:
+            self.schedule(row.sha256, row.local_path)
+        return len(rows)
+
+    async def close(self):
+        """Прерывает незавершенные превью - их доделает generate_pending"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Очередь превью процесса
+preview_generator = PreviewGenerator()
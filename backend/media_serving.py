@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Serving - HTTP-ответы с медиафайлами тикетов
+Файлы хранилища названы хэшем содержимого и никогда не меняются, поэтому
+отдаются с долгим Cache-Control immutable и ETag: повторная отрисовка чата
+не скачивает вложения заново. Поддерживаются If-None-Match и Range
+(перемотка видео). В режиме MEDIA_ACCEL_REDIRECT доступ проверяет FastAPI,
+а сами байты отдает nginx из internal location (X-Accel-Redirect) - только
+для запросов, пришедших через nginx (заголовок X-Media-Accel). Прямой запрос
+к uvicorn получает файл от Python.
+"""
+
+import asyncio
+import mimetypes
+import os
+import re
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+# Префикс internal location nginx (например /_media/); пусто - файлы отдает Python
+ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+# Заголовок, который nginx ставит проксируемым запросам: только он обработает X-Accel-Redirect
+ACCEL_REQUEST_HEADER = "x-media-accel"
+
+# Путь в хранилище не меняет содержимого - кэшируем в браузере на год
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+CHUNK_SIZE = 256 * 1024
+
+MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".mp4": "video/mp4",
+    ".avi": "video/avi",
+    ".mov": "video/quicktime",
+    ".pdf": "application/pdf",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+}
+
+_SHA256_NAME = re.compile(r"^[0-9a-f]{64}$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RangeNotSatisfiable(Exception):
+    """Запрошенный диапазон за пределами файла"""
+
+def resolve_media_path(media_root: Path, file_path: str) -> Optional[Path]:
+    """Полный путь файла внутри media_root или None (выход за пределы, нет файла)"""
+    root = media_root.resolve()
+    full_path = (root / file_path).resolve()
+    if not full_path.is_relative_to(root) or not full_path.is_file():
+        return None
+    return full_path
+
+def content_hash(file_path: str) -> Optional[str]:
+    """SHA-256 из имени файла хранилища (objects/.., previews/..) или None для старых файлов"""
+    stem = Path(file_path).name.split(".", 1)[0]
+    return stem if _SHA256_NAME.match(stem) else None
+
+def media_type_for(path: Path) -> str:
+    extension = path.suffix.lower()
+    return MIME_TYPES.get(extension) or mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Диапазон из заголовка Range: (начало, конец включительно)
+
+    None - заголовок не поддерживается (несколько диапазонов и т.п.), отдается весь файл.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # bytes=-N - последние N байт
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+async def _read_range(path: Path, start: int, end: int):
+    with open(path, "rb") as f:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+async def media_response(request: Request, full_path: Path, file_path: str) -> Response:
+    """Ответ с файлом: кэширующие заголовки, 304, Range или X-Accel-Redirect"""
+    media_type = media_type_for(full_path)
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Content-Disposition": f"inline; filename*=utf-8''{quote(full_path.name)}"
+    }
+
+    if ACCEL_REDIRECT_PREFIX and request.headers.get(ACCEL_REQUEST_HEADER) == "on":
+        # Байты, ETag, 304 и Range обрабатывает nginx
+        headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(file_path.lstrip("/"))
+        return Response(status_code=200, headers=headers, media_type=media_type)
+
+    stat = await asyncio.to_thread(full_path.stat)
+    sha256 = content_hash(file_path)
+    # Для старых файлов (имя uuid) содержимое тоже не меняется - достаточно размера и mtime
+    etag = f'"{sha256}"' if sha256 else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers["ETag"] = etag
+    headers["Accept-Ranges"] = "bytes"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(_read_range(full_path, start, end), status_code=206,
+                                     headers=headers, media_type=media_type)
+
+    return FileResponse(full_path, headers=headers, media_type=media_type, stat_result=stat)
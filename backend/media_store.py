@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Store - Хранилище медиа по содержимому (SHA-256)
+Файл пишется во временный файл и атомарно переименовывается в
+objects/ab/cd/<sha256><расширение>: одинаковое вложение в пяти тикетах
+хранится один раз. Сообщения тикетов ссылаются на файл через file_sha256,
+счетчик ссылок ведется в той же транзакции, что и запись сообщения.
+Файлы без ссылок удаляются сборкой мусора после MEDIA_GC_GRACE секунд.
+По file_unique_id Telegram уже скачанный файл находится без скачивания.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+
+from database import AsyncSessionLocal, MediaObject, TelegramMediaFile
+
+logger = logging.getLogger(__name__)
+
+MEDIA_ROOT = Path(__file__).parent / "media"
+OBJECTS_DIR = "objects"
+# Временные файлы лежат в media/ - переименование остается в пределах одной файловой системы
+TEMP_DIR = ".tmp"
+
+# Сколько хранится файл без ссылок (запись сообщения могла еще не завершиться)
+GC_GRACE = int(os.getenv("MEDIA_GC_GRACE", "3600"))
+GC_INTERVAL = int(os.getenv("MEDIA_GC_INTERVAL", "3600"))
+
+def _lock_object(sha256: str):
+    """Блокировка содержимого до конца транзакции: запись файла и сборка мусора
+    для одного SHA-256 не пересекаются (иначе сборка могла удалить файл,
+    который put только что заново зарегистрировал)"""
+    return text("SELECT pg_advisory_xact_lock(hashtextextended(:sha256, 0))").bindparams(sha256=sha256)
+
+def object_path(sha256: str, extension: str = "") -> str:
+    """Путь файла с данным содержимым относительно media/"""
+    return f"{OBJECTS_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension.lower()}"
+
+class MediaStore:
+    """Файлы медиа по SHA-256 со счетчиком ссылок из ticket_messages"""
+
+    def __init__(self, media_root: Path = MEDIA_ROOT, session_factory=AsyncSessionLocal):
+        self.media_root = media_root
+        self.session_factory = session_factory
+
+    def temp_dir(self) -> Path:
+        """Каталог временных файлов (создается при первом обращении)"""
+        temp_dir = self.media_root / TEMP_DIR
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        return temp_dir
+
+    def temp_path(self) -> Path:
+        """Новый временный файл для записи"""
+        return self.temp_dir() / f"{uuid.uuid4()}.part"
+
+    def _publish(self, temp_path: Path, local_path: str):
+        target = self.media_root / local_path
+        if target.exists():
+            # Такое содержимое уже есть - копия не нужна
+            temp_path.unlink(missing_ok=True)
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, target)
+
+    async def put(self, temp_path: Path, sha256: str, file_size: int, extension: str = "",
+                  file_unique_id: Optional[str] = None) -> dict:
+        """Переносит временный файл в хранилище и регистрирует его
+
+        Возвращает local_path, file_size, sha256 и preview_status (None - превью
+        еще не делалось). Ссылку на файл добавляет запись сообщения (reference_media_async).
+        """
+        now = datetime.utcnow()
+        statement = insert(MediaObject).values(
+            sha256=sha256, local_path=object_path(sha256, extension), file_size=file_size,
+            ref_count=0, created_at=now, last_used_at=now
+        )
+        # Повторная запись продлевает жизнь файла, чтобы сборка мусора не удалила его до ссылки
+        statement = statement.on_conflict_do_update(
+            index_elements=[MediaObject.sha256],
+            set_={"last_used_at": now}
+        ).returning(MediaObject.local_path, MediaObject.preview_status)
+
+        async with self.session_factory() as session:
+            await session.execute(_lock_object(sha256))
+            local_path, preview_status = (await session.execute(statement)).one()
+            if file_unique_id:
+                await session.execute(
+                    insert(TelegramMediaFile).values(file_unique_id=file_unique_id, sha256=sha256)
+                    .on_conflict_do_nothing(index_elements=[TelegramMediaFile.file_unique_id])
+                )
+            # Файл появляется на диске до commit: зарегистрированный объект всегда есть на диске
+            await asyncio.to_thread(self._publish, temp_path, local_path)
+            await session.commit()
+        return {"local_path": local_path, "file_size": file_size, "sha256": sha256, "preview_status": preview_status}
+
+    async def find_telegram_file(self, file_unique_id: str) -> Optional[dict]:
+        """Уже сохраненный файл Telegram по file_unique_id или None"""
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            row = (await session.execute(
+                update(MediaObject)
+                .where(MediaObject.sha256 == select(TelegramMediaFile.sha256).where(
+                    TelegramMediaFile.file_unique_id == file_unique_id
+                ).scalar_subquery())
+                .values(last_used_at=now)
+                .returning(MediaObject.sha256, MediaObject.local_path, MediaObject.file_size)
+            )).first()
+            await session.commit()
+        if row is None:
+            return None
+        if not await asyncio.to_thread((self.media_root / row.local_path).is_file):
+            logger.warning(f"Файл {row.local_path} отсутствует на диске, скачиваем заново")
+            return None
+        return {"local_path": row.local_path, "file_size": row.file_size, "sha256": row.sha256}
+
+    async def collect_garbage(self, grace: float = GC_GRACE) -> int:
+        """Удаляет файлы без ссылок, не использовавшиеся дольше grace секунд
+
+        Каждый файл удаляется в своей транзакции под блокировкой его SHA-256:
+        строка и файл исчезают вместе, а put того же содержимого ждет окончания.
+        """
+        border = datetime.utcnow() - timedelta(seconds=grace)
+        conditions = (MediaObject.ref_count <= 0, MediaObject.last_used_at < border)
+        async with self.session_factory() as session:
+            candidates = (await session.scalars(select(MediaObject.sha256).where(*conditions))).all()
+
+        removed = 0
+        for sha256 in candidates:
+            async with self.session_factory() as session:
+                await session.execute(_lock_object(sha256))
+                # Условия проверяются заново: файл могли записать или сослаться на него
+                row = (await session.execute(
+                    delete(MediaObject)
+                    .where(MediaObject.sha256 == sha256, *conditions)
+                    .returning(MediaObject.local_path, MediaObject.preview_path)
+                )).first()
+                if row is not None:
+                    await asyncio.to_thread(self._unlink, row.local_path, row.preview_path)
+                    removed += 1
+                await session.commit()
+
+        await asyncio.to_thread(self._remove_stale_temp_files, border)
+        if removed:
+            logger.info(f"Удалено медиафайлов без ссылок: {removed}")
+        return removed
+
+    def _unlink(self, *local_paths: Optional[str]):
+        for local_path in local_paths:
+            if local_path:
+                (self.media_root / local_path).unlink(missing_ok=True)
+
+    def _remove_stale_temp_files(self, border: datetime):
+        # Временные файлы, брошенные упавшим процессом
+        temp_dir = self.media_root / TEMP_DIR
+        if temp_dir.is_dir():
+            for temp_file in temp_dir.iterdir():
+                if temp_file.is_file() and datetime.utcfromtimestamp(temp_file.stat().st_mtime) < border:
+                    temp_file.unlink(missing_ok=True)
+
+def _reference_statements(hashes: Iterable[Optional[str]], delta: int):
+    now = datetime.utcnow()
+    for sha256, count in Counter(sha256 for sha256 in hashes if sha256).items():
+        yield update(MediaObject).where(MediaObject.sha256 == sha256).values(
+            ref_count=MediaObject.ref_count + delta * count,
+            last_used_at=now
+        )
+
+async def reference_media_async(db, hashes: Iterable[Optional[str]]):
+    """Добавляет ссылки сообщений на файлы (в транзакции записи сообщений)"""
+    for statement in _reference_statements(hashes, 1):
+        await db.execute(statement)
+
+async def release_media_async(db, hashes: Iterable[Optional[str]]):
+    """Убирает ссылки удаленных сообщений на файлы"""
+    for statement in _reference_statements(hashes, -1):
+        await db.execute(statement)
+
+# Хранилище процесса
+media_store = MediaStore()
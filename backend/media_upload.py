@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Media Upload - Потоковый прием файлов, загружаемых сотрудниками
+Тело multipart-запроса разбирается по мере поступления: байты файла сразу
+пишутся во временный файл хранилища вне event loop, в том же проходе
+считаются размер и SHA-256 и определяется тип по первым байтам.
+Файл больше MAX_UPLOAD_SIZE отклоняется, как только это становится известно,
+не дожидаясь конца загрузки.
+"""
+
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from starlette.requests import Request
+
+from media_store import media_store, MediaStore
+
+# Telegram Bot API принимает от ботов файлы до 50 МБ
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE_MB", "50")) * 1024 * 1024
+# Сколько первых байт нужно для определения типа
+SNIFF_SIZE = 64
+
+# Сигнатуры форматов: (смещение, байты, MIME-тип, расширение)
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (0, b"GIF87a", "image/gif", ".gif"),
+    (0, b"GIF89a", "image/gif", ".gif"),
+    (0, b"%PDF-", "application/pdf", ".pdf"),
+    (0, b"\x1a\x45\xdf\xa3", "video/x-matroska", ".mkv"),
+]
+RIFF_TYPES = {
+    b"WEBP": ("image/webp", ".webp"),
+    b"AVI ": ("video/x-msvideo", ".avi"),
+}
+# ISO-BMFF (ftyp) по основному бренду: в этот же контейнер упакованы HEIC, AVIF и M4A,
+# которые Telegram не примет как видео - их отправляем документом
+FTYP_BRANDS = {
+    b"isom": ("video/mp4", ".mp4"),
+    b"iso2": ("video/mp4", ".mp4"),
+    b"mp41": ("video/mp4", ".mp4"),
+    b"mp42": ("video/mp4", ".mp4"),
+    b"avc1": ("video/mp4", ".mp4"),
+    b"M4V ": ("video/mp4", ".mp4"),
+    b"qt  ": ("video/quicktime", ".mov"),
+}
+
+# Тип сообщения Telegram по MIME-типу содержимого
+PHOTO_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+VIDEO_TYPES = {"video/mp4", "video/quicktime", "video/x-msvideo", "video/x-matroska"}
+
+class UploadError(Exception):
+    """Некорректный запрос загрузки"""
+
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+@dataclass
+class ReceivedFile:
+    """Файл, принятый во временный файл хранилища"""
+    temp_path: Path
+    filename: str
+    size: int
+    sha256: str
+    content_type: Optional[str]  # Определенный по содержимому MIME-тип, None - неизвестен
+
+    @property
+    def extension(self) -> str:
+        """Расширение по содержимому, для неизвестных типов - из имени файла"""
+        for _, _, content_type, extension in SIGNATURES:
+            if content_type == self.content_type:
+                return extension
+        for content_type, extension in [*RIFF_TYPES.values(), *FTYP_BRANDS.values()]:
+            if content_type == self.content_type:
+                return extension
+        return Path(self.filename).suffix.lower()
+
+    @property
+    def message_type(self) -> str:
+        """photo, video или document"""
+        if self.content_type in PHOTO_TYPES:
+            return "photo"
+        if self.content_type in VIDEO_TYPES:
+            return "video"
+        return "document"
+
+def sniff_content_type(head: bytes) -> Optional[str]:
+    """MIME-тип по первым байтам файла или None"""
+    if head[:4] == b"RIFF":
+        riff = RIFF_TYPES.get(head[8:12])
+        return riff[0] if riff else None
+    if head[4:8] == b"ftyp":
+        brand = FTYP_BRANDS.get(head[8:12])
+        return brand[0] if brand else None
+    for offset, signature, content_type, _ in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type
+    return None
+
+class _FileSink:
+    """Запись частей файла: хэш, размер и первые байты в одном проходе"""
+
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.file = open(path, "wb")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    def write(self, chunks: List[bytes]):
+        # Выполняется в пуле потоков: hashlib и запись в файл отпускают GIL
+        for chunk in chunks:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise UploadError(f"Файл больше {self.max_size // (1024 * 1024)} МБ", status_code=413)
+            if len(self.head) < SNIFF_SIZE:
+                self.head += chunk[:SNIFF_SIZE - len(self.head)]
+            self.hasher.update(chunk)
+            self.file.write(chunk)
+
+    def close(self):
+        self.file.close()
+
+async def receive_file(request: Request, field: str = "file", max_size: int = MAX_UPLOAD_SIZE,
+                       store: MediaStore = media_store) -> ReceivedFile:
+    """Принимает файл из поля field multipart-запроса во временный файл хранилища
+
+    Временный файл переносится в хранилище вызывающим (store.put) или удаляется им.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Ожидается multipart/form-data")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size + 64 * 1024:
+        # Заведомо слишком большой запрос отклоняем до чтения тела
+        raise UploadError(f"Файл больше {max_size // (1024 * 1024)} МБ", status_code=413)
+
+    state = {"headers": {}, "header_field": b"", "header_value": b"", "in_file": False, "filename": None, "done": False}
+    pending: List[bytes] = []
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data: bytes, start: int, end: int):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = state["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", errors="replace")
+        # Берем первое поле с файлом, остальные части пропускаются
+        state["in_file"] = name == field and b"filename" in options and state["filename"] is None
+        if state["in_file"]:
+            state["filename"] = options[b"filename"].decode("utf-8", errors="replace")
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if state["in_file"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        if state["in_file"]:
+            state["in_file"] = False
+            state["done"] = True
+
+    parser = multipart.MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    temp_path = await asyncio.to_thread(store.temp_path)
+    sink = await asyncio.to_thread(_FileSink, temp_path, max_size)
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if pending:
+                    chunks = pending[:]
+                    pending.clear()
+                    await asyncio.to_thread(sink.write, chunks)
+            parser.finalize()
+        except MultipartParseError as e:
+            raise UploadError(f"Некорректное тело multipart: {e}")
+        await asyncio.to_thread(sink.close)
+        if not state["done"]:
+            raise UploadError(f"В запросе нет файла в поле {field}")
+        if sink.size == 0:
+            raise UploadError("Файл пустой")
+    except BaseException:
+        await asyncio.to_thread(sink.close)
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    return ReceivedFile(
+        temp_path=temp_path,
+        filename=Path(state["filename"]).name or "file",
+        size=sink.size,
+        sha256=sink.hasher.hexdigest(),
+        content_type=sniff_content_type(sink.head)
+    )
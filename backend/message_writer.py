@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Message Writer - Групповая запись входящих сообщений тикетов
+Сообщения клиентов копятся несколько миллисекунд (или до MAX_BATCH штук)
+и записываются одной транзакцией. Запись идет строго в порядке поступления,
+поэтому порядок сообщений внутри тикета сохраняется. write() возвращает
+id сообщения только после commit - клиенту отвечают, когда сообщение уже в базе.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal, ActiveTicket, TicketMessage
+from events import publish_event_async, MESSAGE_CREATED
+from client_stats import touch_client_activity_async
+from media_store import reference_media_async
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+# Сколько ждать следующих сообщений перед записью пачки
+MAX_DELAY = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "5")) / 1000
+# Сколько последних записей учитывается в метриках
+METRICS_WINDOW = 1024
+METRICS_LOG_INTERVAL = 60
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percent), len(ordered) - 1)]
+
+class MessageWriteBuffer:
+    """Буфер записи сообщений тикетов с групповым commit"""
+
+    def __init__(self, session_factory=AsyncSessionLocal, max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop = None
+
+        # Метрики: задержка от write() до commit и размер пачки
+        self.batches = 0
+        self.messages = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=METRICS_WINDOW)
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self._metrics_logged_at = time.monotonic()
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run(), name="message_writer")
+
+    async def write(self, **fields) -> int:
+        """Ставит сообщение (поля TicketMessage) в очередь и ждет commit, возвращает id"""
+        self._ensure_started()
+        future = self._loop.create_future()
+        self._queue.put_nowait((fields, future, time.monotonic()))
+        return await future
+
+    async def write_many(self, records: List[dict]) -> List[int]:
+        """Ставит несколько сообщений подряд - они пишутся одной пачкой и в этом порядке"""
+        self._ensure_started()
+        futures = []
+        now = time.monotonic()
+        for fields in records:
+            future = self._loop.create_future()
+            self._queue.put_nowait((fields, future, now))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    async def close(self):
+        """Записывает накопленное и останавливает буфер"""
+        if self._task is None or self._task.done():
+            return
+        # Метка конца очереди: все, что поставлено раньше, будет записано
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def _drain(self, batch: list) -> bool:
+        """Добирает пачку из очереди без ожидания, True - встречена метка конца"""
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            closing = self._drain(batch)
+            if not closing and len(batch) < self.max_batch and self.max_delay > 0:
+                # Даем соседним сообщениям (альбом, всплеск) попасть в тот же commit
+                await asyncio.sleep(self.max_delay)
+                closing = self._drain(batch)
+            await self._flush(batch)
+            if closing:
+                return
+
+    async def _flush(self, batch: list):
+        try:
+            ids = await self._commit([fields for fields, _, _ in batch])
+            results = [(item, message_id, None) for item, message_id in zip(batch, ids)]
+        except Exception as e:
+            # Одна плохая строка не должна терять всю пачку - пишем по одной
+            logger.error(f"Ошибка записи пачки из {len(batch)} сообщений, запись по одному: {e}")
+            results = []
+            for item in batch:
+                try:
+                    message_id = (await self._commit([item[0]]))[0]
+                    results.append((item, message_id, None))
+                except Exception as error:
+                    results.append((item, None, error))
+
+        now = time.monotonic()
+        self.batches += 1
+        self._batch_sizes.append(len(batch))
+        for (fields, future, enqueued_at), message_id, error in results:
+            self._latencies.append(now - enqueued_at)
+            if error is not None:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                self.messages += 1
+                if not future.done():
+                    future.set_result(message_id)
+
+        if now - self._metrics_logged_at >= METRICS_LOG_INTERVAL:
+            self._metrics_logged_at = now
+            logger.info(f"Запись сообщений: {self.snapshot()}")
+
+    async def _commit(self, records: List[dict]) -> List[int]:
+        async with self.session_factory() as session:
+            messages = [TicketMessage(**record) for record in records]
+            session.add_all(messages)
+            await session.flush()
+            for telegram_user_id in {record["telegram_user_id"] for record in records}:
+                await touch_client_activity_async(session, telegram_user_id)
+            await reference_media_async(session, [record.get("file_sha256") for record in records])
+            # courier_id нужен общему потоку событий: курьер видит только свои тикеты
+            couriers = dict((await session.execute(
+                select(ActiveTicket.id, ActiveTicket.courier_id)
+                .where(ActiveTicket.id.in_({message.ticket_id for message in messages}))
+            )).all())
+            for message in messages:
+                await publish_event_async(session, MESSAGE_CREATED, {
+                    "ticket_id": message.ticket_id,
+                    "message_id": message.id,
+                    "is_from_admin": False,
+                    "courier_id": couriers.get(message.ticket_id)
+                })
+            await session.commit()
+            return [message.id for message in messages]
+
+    def snapshot(self) -> dict:
+        """Метрики буфера: пачки, сообщения, размер пачки и задержка до commit (мс)"""
+        latencies = list(self._latencies)
+        sizes = list(self._batch_sizes)
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "failed": self.failed,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size_avg": round(sum(sizes) / len(sizes), 2) if sizes else 0,
+            "batch_size_max": max(sizes, default=0),
+            "flush_latency_ms_p50": round(_percentile(latencies, 0.5) * 1000, 1),
+            "flush_latency_ms_p95": round(_percentile(latencies, 0.95) * 1000, 1),
+            "flush_latency_ms_max": round(max(latencies, default=0) * 1000, 1)
+        }
+
+# Буфер процесса (общий для всех ботов менеджера)
+message_writer = MessageWriteBuffer()
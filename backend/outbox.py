@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Outbox - Надежная очередь исходящих сообщений в Telegram
+API сохраняет сообщение в outbox в той же транзакции, что и сообщение тикета,
+и сразу отвечает. Фоновый диспетчер отправляет очередь с лимитами Telegram
+(на бота и на чат), учитывает retry_after и записывает статус доставки.
+
+Диспетчер запускается внутри API. Лимиты считаются в памяти процесса,
+поэтому при нескольких воркерах диспетчер включают только в одном
+(OUTBOX_DISPATCHER=0 в остальных) или запускают отдельно:
+    python outbox.py
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Optional, Tuple
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import aliased
+
+from bot_registry import bot_registry, BotRegistry
+from database import AsyncSessionLocal, ActiveTicket, OutboxMessage, TicketMessage
+from events import publish_event_async, MESSAGE_DELIVERY
+from telegram_api import telegram_clients, TelegramAPIError
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+BOT_RATE = float(os.getenv("OUTBOX_BOT_RATE", "30"))
+CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+
+BATCH_SIZE = 100
+# Сколько забранных сообщений может ждать отправки в очередях чатов
+MAX_IN_FLIGHT = 1000
+POLL_INTERVAL = 1.0
+# Аренда: в один чат забирается не больше BATCH_SIZE сообщений, при 1/с это укладывается с запасом
+LEASE_SECONDS = 300
+# Попытки при сетевых ошибках и 5xx, затем сообщение помечается failed
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 300
+# Сколько корзин чатов держать в памяти
+MAX_CHAT_BUCKETS = 10000
+
+# Статусы outbox и доставки сообщений тикета
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+class TokenBucket:
+    """Корзина токенов: не больше rate запросов в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        """Ждет свободный токен и забирает его"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (Telegram вернул 429 с retry_after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+def enqueue_telegram_message(db, chat_id: str, text: str, bot_id: Optional[int] = None,
+                             ticket_message_id: Optional[int] = None, parse_mode: Optional[str] = "HTML") -> OutboxMessage:
+    """Добавляет текстовое сообщение в outbox в транзакции сессии db
+
+    Отправка начнется после commit; чтобы не ждать опроса, после commit
+    вызывают outbox_dispatcher.wake().
+    """
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    row = OutboxMessage(
+        bot_id=bot_id,
+        chat_id=str(chat_id),
+        method="sendMessage",
+        payload=json.dumps(payload, ensure_ascii=False),
+        ticket_message_id=ticket_message_id,
+        status=STATUS_PENDING,
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.add(row)
+    return row
+
+class OutboxDispatcher:
+    """Фоновая отправка outbox с лимитами на бота и на чат
+
+    У каждого чата свой обработчик с очередью: медленный чат (1 сообщение
+    в секунду) не задерживает остальные, а новые сообщения забираются
+    из outbox, не дожидаясь, пока освободятся все чаты.
+    """
+
+    def __init__(self, registry: BotRegistry = bot_registry, session_factory=AsyncSessionLocal):
+        self.registry = registry
+        self.session_factory = session_factory
+        self._bot_buckets: Dict[int, TokenBucket] = {}
+        self._chat_buckets: "OrderedDict[Tuple[int, str], TokenBucket]" = OrderedDict()
+        self._chat_queues: Dict[Tuple[Optional[int], str], Deque] = {}
+        self._chat_workers: Dict[Tuple[Optional[int], str], asyncio.Task] = {}
+        self._in_flight = 0  # Забранные из outbox, но еще не обработанные сообщения
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запускает диспетчер в текущем event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox_dispatcher")
+
+    async def stop(self):
+        """Останавливает диспетчер; неотправленное останется в outbox"""
+        tasks = list(self._chat_workers.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        # Забранные сообщения вернутся в очередь после истечения аренды
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def wake(self):
+        """Сообщает о новых сообщениях в outbox, не дожидаясь опроса"""
+        self._wakeup.set()
+
+    def _bot_bucket(self, bot_id: int) -> TokenBucket:
+        bucket = self._bot_buckets.get(bot_id)
+        if bucket is None:
+            bucket = self._bot_buckets[bot_id] = TokenBucket(BOT_RATE, capacity=BOT_RATE)
+        return bucket
+
+    def _chat_bucket(self, bot_id: int, chat_id: str) -> TokenBucket:
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            bucket = self._chat_buckets[key] = TokenBucket(CHAT_RATE)
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(key)
+        return bucket
+
+    async def _run(self):
+        logger.info("Диспетчер outbox запущен")
+        while True:
+            try:
+                if self._in_flight < MAX_IN_FLIGHT:
+                    rows = await self._claim(min(BATCH_SIZE, MAX_IN_FLIGHT - self._in_flight))
+                    if rows:
+                        self._dispatch(rows)
+                        continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _claim(self, limit: int = BATCH_SIZE):
+        """Забирает пачку готовых к отправке сообщений (SKIP LOCKED - безопасно для нескольких процессов)
+
+        Сообщение не забирается, пока более раннее сообщение в тот же чат
+        отложено до повтора или еще отправляется: порядок в чате сохраняется.
+        """
+        now = datetime.utcnow()
+        earlier = aliased(OutboxMessage)
+        blocked = select(earlier.id).where(
+            earlier.bot_id.is_not_distinct_from(OutboxMessage.bot_id),
+            earlier.chat_id == OutboxMessage.chat_id,
+            earlier.id < OutboxMessage.id,
+            or_(
+                and_(earlier.status == STATUS_PENDING, earlier.next_attempt_at > now),
+                and_(earlier.status == STATUS_SENDING, earlier.locked_until >= now)
+            )
+        )
+        ready = select(OutboxMessage.id).where(
+            or_(
+                and_(OutboxMessage.status == STATUS_PENDING, OutboxMessage.next_attempt_at <= now),
+                # Аренда истекла - процесс, забравший сообщение, упал
+                and_(OutboxMessage.status == STATUS_SENDING, OutboxMessage.locked_until < now)
+            ),
+            ~blocked.exists()
+        ).order_by(OutboxMessage.id).limit(limit).with_for_update(skip_locked=True)
+
+        async with self.session_factory() as db:
+            result = await db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(ready.scalar_subquery()))
+                .values(status=STATUS_SENDING, locked_until=now + timedelta(seconds=LEASE_SECONDS))
+                .returning(
+                    OutboxMessage.id,
+                    OutboxMessage.bot_id,
+                    OutboxMessage.chat_id,
+                    OutboxMessage.method,
+                    OutboxMessage.payload,
+                    OutboxMessage.ticket_message_id,
+                    OutboxMessage.attempts
+                )
+                .execution_options(synchronize_session=False)
+            )
+            rows = sorted(result.all(), key=lambda row: row.id)
+            await db.commit()
+            return rows
+
+    def _dispatch(self, rows):
+        """Раскладывает пачку по очередям чатов и запускает обработчики свободных чатов"""
+        for row in rows:
+            key = (row.bot_id, row.chat_id)
+            queue = self._chat_queues.get(key)
+            if queue is None:
+                queue = self._chat_queues[key] = deque()
+                self._chat_workers[key] = asyncio.create_task(self._send_chat(key, queue), name=f"outbox_chat:{row.chat_id}")
+            queue.append(row)
+            self._in_flight += 1
+
+    async def _send_chat(self, key, queue: Deque):
+        """Отправляет сообщения одного чата по порядку, пока очередь не опустеет"""
+        try:
+            while queue:
+                row = queue.popleft()
+                try:
+                    retry_at = await self._send(row)
+                finally:
+                    self._in_flight -= 1
+                if retry_at is not None:
+                    # Сообщение отложено - следующие в этот чат ждут его, чтобы не нарушить порядок
+                    later = list(queue)
+                    queue.clear()
+                    self._in_flight -= len(later)
+                    await self._release([row.id for row in later], retry_at)
+        except Exception as e:
+            # Оставшиеся сообщения чата вернутся после истечения аренды вместе с текущим, по порядку
+            logger.error(f"Ошибка отправки outbox в чат {key[1]}: {e}")
+            self._in_flight -= len(queue)
+            queue.clear()
+        finally:
+            del self._chat_queues[key]
+            del self._chat_workers[key]
+            # Чат освободился - его следующие сообщения можно забирать
+            self._wakeup.set()
+
+    async def _send(self, row) -> Optional[datetime]:
+        """Отправляет одно сообщение; возвращает время повтора, если оно отложено"""
+        # Сообщение уходит через бота тикета - клиент писал именно ему
+        bot = await self.registry.resolve(row.bot_id)
+        if bot is None:
+            await self._finish(row, STATUS_FAILED, error="Нет бота для отправки")
+            return None
+
+        bot_bucket = self._bot_bucket(bot.id)
+        chat_bucket = self._chat_bucket(bot.id, row.chat_id)
+        await chat_bucket.acquire()
+        await bot_bucket.acquire()
+
+        try:
+            params = {"chat_id": row.chat_id, **json.loads(row.payload)}
+            result = await bot.client.call(row.method, params, max_attempts=1)
+        except TelegramAPIError as e:
+            if e.retry_after is not None:
+                # 429: ждем сколько просит Telegram, попытка не засчитывается
+                chat_bucket.pause(e.retry_after)
+                bot_bucket.pause(e.retry_after)
+                retry_at = datetime.utcnow() + timedelta(seconds=e.retry_after)
+                await self._retry(row, retry_at, row.attempts, e.description)
+                return retry_at
+            if e.error_code is None or e.error_code >= 500:
+                attempts = row.attempts + 1
+                if attempts < MAX_ATTEMPTS:
+                    retry_at = datetime.utcnow() + timedelta(seconds=min(2 ** attempts, MAX_BACKOFF_SECONDS))
+                    await self._retry(row, retry_at, attempts, e.description)
+                    return retry_at
+            # 400/403 (чат не найден, бот заблокирован) - повтор не поможет
+            logger.error(f"Сообщение outbox {row.id} не доставлено: {e.description}")
+            await self._finish(row, STATUS_FAILED, error=e.description)
+            return None
+
+        await self._finish(row, STATUS_SENT, telegram_message_id=(result or {}).get("message_id"))
+        return None
+
+    async def _retry(self, row, retry_at: datetime, attempts: int, error: str):
+        async with self.session_factory() as db:
+            await db.execute(
+                update(OutboxMessage).where(OutboxMessage.id == row.id).values(
+                    status=STATUS_PENDING,
+                    attempts=attempts,
+                    next_attempt_at=retry_at,
+                    locked_until=None,
+                    last_error=error
+                )
+            )
+            await db.commit()
+
+    async def _release(self, ids, retry_at: datetime):
+        if not ids:
+            return
+        async with self.session_factory() as db:
+            await db.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(ids)).values(
+                    status=STATUS_PENDING,
+                    next_attempt_at=retry_at,
+                    locked_until=None
+                )
+            )
+            await db.commit()
+
+    async def _finish(self, row, status: str, telegram_message_id: Optional[int] = None, error: Optional[str] = None):
+        """Фиксирует итог отправки в outbox и в сообщении тикета"""
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            await db.execute(
+                update(OutboxMessage).where(OutboxMessage.id == row.id).values(
+                    status=status,
+                    attempts=row.attempts + 1,
+                    locked_until=None,
+                    last_error=error,
+                    telegram_message_id=telegram_message_id,
+                    sent_at=now if status == STATUS_SENT else None
+                )
+            )
+            if row.ticket_message_id is not None:
+                ticket_id = (await db.execute(
+                    update(TicketMessage).where(TicketMessage.id == row.ticket_message_id).values(
+                        delivery_status=status,
+                        telegram_message_id=telegram_message_id
+                    ).returning(TicketMessage.ticket_id)
+                )).scalar()
+                if ticket_id is not None:
+                    courier_id = await db.scalar(select(ActiveTicket.courier_id).where(ActiveTicket.id == ticket_id))
+                    await publish_event_async(db, MESSAGE_DELIVERY, {
+                        "ticket_id": ticket_id,
+                        "message_id": row.ticket_message_id,
+                        "delivery_status": status,
+                        "courier_id": courier_id
+                    })
+            await db.commit()
+
+# Диспетчер процесса
+outbox_dispatcher = OutboxDispatcher()
+
+def dispatcher_enabled() -> bool:
+    """Запускать ли диспетчер в процессе API"""
+    return os.getenv("OUTBOX_DISPATCHER", "1") not in ("0", "false", "no")
+
+async def run_dispatcher():
+    """Запуск диспетчера отдельным процессом"""
+    outbox_dispatcher.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await outbox_dispatcher.stop()
+        await telegram_clients.aclose()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run_dispatcher())
+    except KeyboardInterrupt:
+        print("\n👋 Диспетчер outbox остановлен")
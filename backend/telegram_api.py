@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Telegram API - Асинхронный клиент Telegram Bot API для исходящих запросов админки
+Один keep-alive клиент (HTTP/2) на токен бота с ограниченным пулом соединений,
+таймаутами и повторами при сетевых ошибках, 5xx и 429.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Таймауты: загрузка файлов дольше обычных запросов
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0, pool=5.0)
+UPLOAD_TIMEOUT = httpx.Timeout(60.0, connect=5.0, pool=5.0)
+
+# Пул соединений одного бота
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0)
+
+# Повторы: сколько всего попыток и предел ожидания retry_after, который готовы выждать
+MAX_ATTEMPTS = 3
+MAX_RETRY_AFTER = 30.0
+
+# Методы отправки файлов по типу сообщения
+FILE_METHODS = {
+    "photo": ("sendPhoto", "photo"),
+    "video": ("sendVideo", "video"),
+}
+DEFAULT_FILE_METHOD = ("sendDocument", "document")
+
+# Кусок файла, читаемый с диска при отправке
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+class TelegramAPIError(Exception):
+    """Ошибка, которую вернул Telegram (ok = false) или транспорт"""
+
+    def __init__(self, description: str, error_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+def _quote_filename(filename: str) -> str:
+    # Кавычки и переводы строк в имени сломали бы заголовок части
+    return filename.replace("\\", "\\\\").replace('"', '\\"').replace("\r", " ").replace("\n", " ")
+
+class FileUpload:
+    """Файл для multipart-запроса: тело читается с диска кусками во время отправки
+
+    Файл не загружается в память целиком, чтение идет в пуле потоков
+    и не блокирует event loop.
+    """
+
+    def __init__(self, field: str, path: Path, filename: Optional[str] = None,
+                 content_type: str = "application/octet-stream"):
+        self.field = field
+        self.path = Path(path)
+        self.filename = filename or self.path.name
+        self.content_type = content_type
+
+    async def encode(self, data: dict) -> Tuple[dict, AsyncIterator[bytes]]:
+        """Заголовки и потоковое тело multipart/form-data с полями data и файлом"""
+        boundary = uuid.uuid4().hex
+        head = b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            for name, value in data.items() if value is not None
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{self.field}"; '
+            f'filename="{_quote_filename(self.filename)}"\r\nContent-Type: {self.content_type}\r\n\r\n'
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        size = (await asyncio.to_thread(self.path.stat)).st_size
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + size + len(tail))
+        }
+
+        async def body():
+            yield head
+            f = await asyncio.to_thread(open, self.path, "rb")
+            try:
+                while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE):
+                    yield chunk
+            finally:
+                await asyncio.to_thread(f.close)
+            yield tail
+
+        return headers, body()
+
+class TelegramBotClient:
+    """Клиент Bot API одного бота поверх общего keep-alive соединения"""
+
+    def __init__(self, token: str, http: httpx.AsyncClient):
+        self.token = token
+        self.http = http
+
+    async def call(self, method: str, data: Optional[dict] = None, upload: Optional[FileUpload] = None,
+                   timeout: Optional[httpx.Timeout] = None, max_attempts: int = MAX_ATTEMPTS) -> dict:
+        """Вызывает метод Bot API и возвращает поле result
+
+        Повторяет запрос, если соединение не установилось, Telegram ответил 5xx
+        или 429 (с ожиданием retry_after). Ошибки чтения ответа не повторяются -
+        сообщение могло уже уйти клиенту. max_attempts=1 отключает повторы
+        (их берет на себя вызывающий, например диспетчер outbox).
+        """
+        url = f"/bot{self.token}/{method}"
+        for attempt in range(1, max_attempts + 1):
+            delay = 0.5 * 2 ** (attempt - 1)
+            try:
+                if upload is not None:
+                    # Тело строится заново при каждой попытке - файл перечитывается с начала
+                    headers, content = await upload.encode(data or {})
+                    response = await self.http.post(url, content=content, headers=headers, timeout=timeout or UPLOAD_TIMEOUT)
+                else:
+                    response = await self.http.post(url, json=data or {}, timeout=timeout or DEFAULT_TIMEOUT)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                if attempt == max_attempts:
+                    raise TelegramAPIError(f"Нет соединения с Telegram: {e}")
+                logger.warning(f"{method}: нет соединения с Telegram ({e}), повтор через {delay} с")
+                await asyncio.sleep(delay)
+                continue
+            except httpx.HTTPError as e:
+                raise TelegramAPIError(f"Ошибка запроса к Telegram: {e}")
+
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {"ok": False, "description": response.text}
+
+            if payload.get("ok"):
+                return payload.get("result")
+
+            error = TelegramAPIError(
+                payload.get("description", f"HTTP {response.status_code}"),
+                error_code=payload.get("error_code", response.status_code),
+                retry_after=(payload.get("parameters") or {}).get("retry_after")
+            )
+            if response.status_code == 429 and error.retry_after is not None:
+                if attempt == max_attempts or error.retry_after > MAX_RETRY_AFTER:
+                    raise error
+                logger.warning(f"{method}: лимит Telegram, повтор через {error.retry_after} с")
+                await asyncio.sleep(error.retry_after)
+                continue
+            if response.status_code >= 500 and attempt < max_attempts:
+                logger.warning(f"{method}: Telegram ответил {response.status_code}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                continue
+            raise error
+
+    async def send_message(self, chat_id: str, text: str, parse_mode: Optional[str] = "HTML") -> dict:
+        """Отправляет текстовое сообщение"""
+        data = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return await self.call("sendMessage", data)
+
+    async def send_file(self, chat_id: str, file_path: Path, message_type: str, caption: str = "",
+                        parse_mode: Optional[str] = "HTML", filename: Optional[str] = None,
+                        content_type: str = "application/octet-stream") -> dict:
+        """Отправляет файл методом, соответствующим типу сообщения (photo, video, document)
+
+        filename - имя файла у получателя (по умолчанию имя файла на диске).
+        Тело запроса читается с диска потоком.
+        """
+        method, field = FILE_METHODS.get(message_type, DEFAULT_FILE_METHOD)
+        data = {"chat_id": chat_id, "caption": caption}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return await self.call(method, data, upload=FileUpload(field, file_path, filename, content_type))
+
+    async def send_file_id(self, chat_id: str, file_id: str, message_type: str, caption: str = "",
+                           parse_mode: Optional[str] = "HTML") -> dict:
+        """Отправляет уже загруженный этим ботом файл по file_id (без передачи байтов)"""
+        method, field = FILE_METHODS.get(message_type, DEFAULT_FILE_METHOD)
+        data = {"chat_id": chat_id, "caption": caption, field: file_id}
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        return await self.call(method, data)
+
+    async def get_file(self, file_id: str) -> dict:
+        """Информация о файле (file_path для скачивания)"""
+        return await self.call("getFile", {"file_id": file_id})
+
+    @asynccontextmanager
+    async def stream_file(self, file_path: str, timeout: Optional[httpx.Timeout] = None) -> AsyncIterator[httpx.Response]:
+        """Открывает поток скачивания файла по file_path из getFile"""
+        async with self.http.stream("GET", f"/file/bot{self.token}/{file_path}", timeout=timeout or UPLOAD_TIMEOUT) as response:
+            if response.status_code != 200:
+                raise TelegramAPIError(f"Ошибка скачивания файла: HTTP {response.status_code}", response.status_code)
+            yield response
+
+    async def download_file(self, file_path: str, destination: Path, chunk_size: int = 64 * 1024) -> int:
+        """Скачивает файл по file_path из getFile потоком, возвращает размер"""
+        size = 0
+        async with self.stream_file(file_path) as response:
+            with open(destination, "wb") as f:
+                async for chunk in response.aiter_bytes(chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+        return size
+
+class TelegramClientPool:
+    """Клиенты Bot API процесса: по одному keep-alive HTTP/2 соединению на токен"""
+
+    def __init__(self, base_url: str = TELEGRAM_API_URL, limits: httpx.Limits = POOL_LIMITS):
+        self.base_url = base_url
+        self.limits = limits
+        self._clients: Dict[str, TelegramBotClient] = {}
+
+    def get(self, token: str) -> TelegramBotClient:
+        """Возвращает клиент бота, создавая соединение при первом обращении"""
+        client = self._clients.get(token)
+        if client is None:
+            http = httpx.AsyncClient(base_url=self.base_url, http2=True, limits=self.limits, timeout=DEFAULT_TIMEOUT)
+            client = TelegramBotClient(token, http)
+            self._clients[token] = client
+        return client
+
+    async def discard(self, token: str):
+        """Закрывает клиент бота (токен сменился или бот удален)"""
+        client = self._clients.pop(token, None)
+        if client is not None:
+            await client.http.aclose()
+
+    async def aclose(self):
+        """Закрывает все соединения (при остановке приложения)"""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.http.aclose()
+
+# Клиенты процесса
+telegram_clients = TelegramClientPool()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Telegram Files - Повторное использование file_id при отправке файлов
+После загрузки файла Telegram возвращает file_id. Он запоминается
+для пары (бот, SHA-256 содержимого), и следующая отправка того же файла
+тем же ботом идет по file_id: без загрузки байтов и почти мгновенно.
+Если Telegram отклоняет file_id, файл загружается заново, а file_id обновляется.
+"""
+
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from database import AsyncSessionLocal, TelegramFileId
+from telegram_api import TelegramAPIError, TelegramBotClient, FILE_METHODS, DEFAULT_FILE_METHOD
+
+logger = logging.getLogger(__name__)
+
+# Поля ответа, в которых Telegram может вернуть отправленный файл
+# (видео без нужных метаданных приходит как document или animation)
+RESULT_FILE_FIELDS = ("photo", "video", "document", "animation")
+
+def extract_file_id(message: dict, message_type: str) -> Optional[str]:
+    """file_id отправленного файла из объекта Message или None"""
+    _, field = FILE_METHODS.get(message_type, DEFAULT_FILE_METHOD)
+    for name in (field,) + RESULT_FILE_FIELDS:
+        value = message.get(name)
+        if isinstance(value, list) and value:
+            # Фото приходит набором размеров - берем самый большой (оригинал)
+            value = value[-1]
+        if isinstance(value, dict) and value.get("file_id"):
+            return value["file_id"]
+    return None
+
+class FileIdCache:
+    """file_id по (бот, содержимое, тип сообщения) в таблице telegram_file_ids"""
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    async def get(self, bot_id: int, sha256: str, message_type: str) -> Optional[str]:
+        async with self.session_factory() as session:
+            return await session.scalar(select(TelegramFileId.file_id).where(
+                TelegramFileId.bot_id == bot_id,
+                TelegramFileId.sha256 == sha256,
+                TelegramFileId.message_type == message_type
+            ))
+
+    async def remember(self, bot_id: int, sha256: str, message_type: str, file_id: str):
+        now = datetime.utcnow()
+        statement = insert(TelegramFileId).values(
+            bot_id=bot_id, sha256=sha256, message_type=message_type, file_id=file_id, updated_at=now
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[TelegramFileId.bot_id, TelegramFileId.sha256, TelegramFileId.message_type],
+            set_={"file_id": file_id, "updated_at": now}
+        )
+        async with self.session_factory() as session:
+            await session.execute(statement)
+            await session.commit()
+
+    async def forget(self, bot_id: int, sha256: str, message_type: str):
+        async with self.session_factory() as session:
+            await session.execute(delete(TelegramFileId).where(
+                TelegramFileId.bot_id == bot_id,
+                TelegramFileId.sha256 == sha256,
+                TelegramFileId.message_type == message_type
+            ))
+            await session.commit()
+
+    async def send(self, client: TelegramBotClient, bot_id: int, chat_id: str, file_path: Path, sha256: str,
+                   message_type: str, caption: str = "", filename: Optional[str] = None,
+                   content_type: str = "application/octet-stream") -> dict:
+        """Отправляет файл по сохраненному file_id, а без него (или при отказе) - загрузкой
+
+        Возвращает объект Message из ответа Telegram.
+        """
+        file_id = None
+        try:
+            file_id = await self.get(bot_id, sha256, message_type)
+        except Exception as e:
+            # Кэш - только ускорение: без него файл просто загружается
+            logger.warning(f"Ошибка чтения file_id бота {bot_id}: {e}")
+
+        if file_id:
+            try:
+                return await client.send_file_id(chat_id, file_id, message_type, caption)
+            except TelegramAPIError as e:
+                if e.error_code != 400:
+                    raise
+                # file_id устарел или не подходит этому боту - загружаем файл заново
+                logger.warning(f"Telegram отклонил file_id бота {bot_id} ({e.description}), загрузка файла")
+                try:
+                    await self.forget(bot_id, sha256, message_type)
+                except Exception as error:
+                    logger.warning(f"Ошибка удаления file_id бота {bot_id}: {error}")
+
+        message = await client.send_file(chat_id, file_path, message_type, caption,
+                                         filename=filename, content_type=content_type)
+        new_file_id = extract_file_id(message, message_type)
+        if new_file_id:
+            try:
+                await self.remember(bot_id, sha256, message_type, new_file_id)
+            except Exception as e:
+                logger.warning(f"Ошибка сохранения file_id бота {bot_id}: {e}")
+        return message
+
+# Кэш file_id процесса
+file_id_cache = FileIdCache()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""Хранилище диалогов: сохранение, восстановление, продление и evict"""
+
+import asyncio
+from datetime import timedelta
+from enum import Enum
+
+import pytest
+
+import conversation_store
+from conversation_store import (
+    ConversationPersistence, ConversationStore, MemoryConversationStore, PersistentMapping, STALE_AFTER
+)
+
+class State(Enum):
+    FIRST = 1
+    SECOND = 2
+
+class CountingStore(MemoryConversationStore):
+    """Хранилище в памяти, которое считает записи"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def save(self, bot_id, namespace, key, value):
+        self.calls.append(("save", key))
+        await super().save(bot_id, namespace, key, value)
+
+    async def touch(self, bot_id, namespace, key):
+        self.calls.append(("touch", key))
+        await super().touch(bot_id, namespace, key)
+
+def age(store: MemoryConversationStore, bot_id: int, namespace: str, key: str, seconds: float):
+    """Сдвигает время изменения записи в прошлое"""
+    data, updated_at = store._items[(bot_id, namespace)][key]
+    store._items[(bot_id, namespace)][key] = (data, updated_at - timedelta(seconds=seconds))
+
+def test_store_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+def test_memory_store_roundtrip():
+    store = MemoryConversationStore()
+
+    async def scenario():
+        await store.save(1, "ticket_data", "10", {"category": "general"})
+        await store.save(2, "ticket_data", "10", {"category": "dispute"})
+        items = await store.load(1, "ticket_data")
+        await store.delete(1, "ticket_data", "10")
+        return items, await store.load(1, "ticket_data"), await store.load(2, "ticket_data")
+
+    items, after_delete, other_bot = asyncio.run(scenario())
+    assert [(key, value) for key, value, _ in items] == [("10", {"category": "general"})]
+    assert after_delete == []
+    assert [key for key, _, _ in other_bot] == ["10"]
+
+def test_evict_removes_only_idle_records():
+    store = MemoryConversationStore()
+
+    async def scenario():
+        await store.save(1, "ticket_data", "10", {})
+        await store.save(1, "ticket_data", "11", {})
+        age(store, 1, "ticket_data", "10", 7200)
+        removed = await store.evict(3600)
+        return removed, await store.load(1, "ticket_data")
+
+    removed, items = asyncio.run(scenario())
+    assert removed == 1
+    assert [key for key, _, _ in items] == ["11"]
+
+def test_touch_spares_unchanged_active_record():
+    store = MemoryConversationStore()
+
+    async def scenario():
+        await store.save(1, "ticket_flow", "10:10", "FIRST")
+        age(store, 1, "ticket_flow", "10:10", 7200)
+        await store.touch(1, "ticket_flow", "10:10")
+        # Отсутствующая запись не создается
+        await store.touch(1, "ticket_flow", "11:11")
+        removed = await store.evict(3600)
+        return removed, await store.load(1, "ticket_flow")
+
+    removed, items = asyncio.run(scenario())
+    assert removed == 0
+    assert [(key, value) for key, value, _ in items] == [("10:10", "FIRST")]
+
+def test_persistent_mapping_saves_only_changes(monkeypatch):
+    store = CountingStore()
+    mapping = PersistentMapping(store, 1, "ticket_data", decode=dict, encode=dict)
+
+    async def scenario():
+        mapping[10] = {"category": "general"}
+        await mapping.save(10)
+        await mapping.save(10)
+        mapping[10]["order"] = "A-1"
+        await mapping.save(10)
+        # Значение не менялось, но клиент активен дольше TOUCH_INTERVAL
+        monkeypatch.setattr(conversation_store, "TOUCH_INTERVAL", 0)
+        await mapping.save(10)
+        del mapping[10]
+        await mapping.save(10)
+        await mapping.save(10)
+
+    asyncio.run(scenario())
+    assert store.calls == [("save", "10"), ("save", "10"), ("touch", "10")]
+    assert store._items[(1, "ticket_data")] == {}
+
+def test_persistent_mapping_restores_and_skips_stale():
+    store = MemoryConversationStore()
+
+    async def scenario():
+        await store.save(1, "ticket_data", "10", {"category": "general"})
+        await store.save(1, "ticket_data", "11", {"category": "dispute"})
+        await store.save(1, "ticket_data", "bad", {})
+        age(store, 1, "ticket_data", "11", STALE_AFTER + 60)
+        mapping = PersistentMapping(store, 1, "ticket_data", decode=dict)
+        await mapping.load()
+        return mapping
+
+    mapping = asyncio.run(scenario())
+    assert dict(mapping) == {10: {"category": "general"}}
+
+def test_conversation_persistence_roundtrip():
+    store = MemoryConversationStore()
+    persistence = ConversationPersistence(store, 1, State)
+
+    async def scenario():
+        await persistence.update_conversation("ticket_flow", (10, 10), State.SECOND)
+        await persistence.update_conversation("ticket_flow", (11, 11), State.FIRST)
+        await persistence.update_conversation("ticket_flow", (11, 11), None)
+        await store.save(1, "ticket_flow", "12:12", "REMOVED_STATE")
+        await store.save(1, "ticket_flow", "13:13", "FIRST")
+        age(store, 1, "ticket_flow", "13:13", STALE_AFTER + 60)
+        # Восстановление в новом процессе
+        return await ConversationPersistence(store, 1, State).get_conversations("ticket_flow")
+
+    assert asyncio.run(scenario()) == {(10, 10): State.SECOND}
+
+def test_conversation_persistence_touch_is_throttled(monkeypatch):
+    store = CountingStore()
+    persistence = ConversationPersistence(store, 1, State)
+
+    async def scenario():
+        await persistence.update_conversation("ticket_flow", (10, 10), State.FIRST)
+        await persistence.touch_conversation("ticket_flow", (10, 10))
+        monkeypatch.setattr(conversation_store, "TOUCH_INTERVAL", 0)
+        await persistence.touch_conversation("ticket_flow", (10, 10))
+        # Диалога без сохраненного состояния нет в хранилище - продлевать нечего
+        await persistence.touch_conversation("ticket_flow", (11, 11))
+
+    asyncio.run(scenario())
+    assert store.calls == [("save", "10:10"), ("touch", "10:10")]
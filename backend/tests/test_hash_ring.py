@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""Консистентное хэширование ботов по воркерам"""
+
+from collections import Counter
+
+from bot_supervisor import HashRing
+
+BOT_IDS = range(1, 2001)
+
+def test_assignment_is_stable():
+    first, second = HashRing(range(4)), HashRing(range(4))
+    assert [first.node_for(bot_id) for bot_id in BOT_IDS] == [second.node_for(bot_id) for bot_id in BOT_IDS]
+
+def test_all_workers_get_bots():
+    counts = Counter(HashRing(range(4)).node_for(bot_id) for bot_id in BOT_IDS)
+    assert set(counts) == {0, 1, 2, 3}
+    # Виртуальные узлы сглаживают распределение: ни один воркер не берет больше половины
+    assert max(counts.values()) < len(BOT_IDS) / 2
+
+def test_adding_worker_moves_only_its_share():
+    before, after = HashRing(range(4)), HashRing(range(5))
+    moved = [bot_id for bot_id in BOT_IDS if before.node_for(bot_id) != after.node_for(bot_id)]
+    # Переезжают только боты, доставшиеся новому воркеру, - около 1/5
+    assert all(after.node_for(bot_id) == 4 for bot_id in moved)
+    assert 0 < len(moved) < len(BOT_IDS) * 0.35
+
+def test_single_worker_owns_everything():
+    ring = HashRing([0])
+    assert {ring.node_for(bot_id) for bot_id in BOT_IDS} == {0}
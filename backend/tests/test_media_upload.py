@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Потоковый прием загрузок: определение типа по сигнатуре и лимит размера"""
+
+import asyncio
+import hashlib
+
+import pytest
+from starlette.requests import Request
+
+from media_store import MediaStore
+from media_upload import UploadError, _FileSink, receive_file, sniff_content_type
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+BOUNDARY = "zazaboundary"
+
+@pytest.mark.parametrize("head, expected", [
+    (b"\xff\xd8\xff\xe0" + b"\x00" * 16, "image/jpeg"),
+    (PNG, "image/png"),
+    (b"GIF89a" + b"\x00" * 8, "image/gif"),
+    (b"%PDF-1.7\n", "application/pdf"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"RIFF\x00\x00\x00\x00AVI LIST", "video/x-msvideo"),
+    (b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00", "video/mp4"),
+    (b"\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00", "video/quicktime"),
+    # HEIC в контейнере ISO-BMFF - не видео
+    (b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", None),
+    (b"RIFF\x00\x00\x00\x00WAVEfmt ", None),
+    (b"plain text", None),
+    (b"", None),
+])
+def test_sniff_content_type(head, expected):
+    assert sniff_content_type(head) == expected
+
+def test_file_sink_rejects_oversized_file(tmp_path):
+    sink = _FileSink(tmp_path / "upload.part", max_size=10)
+    try:
+        sink.write([b"12345", b"67890"])
+        with pytest.raises(UploadError) as error:
+            sink.write([b"1"])
+    finally:
+        sink.close()
+    assert error.value.status_code == 413
+    assert sink.head == b"1234567890"
+
+def multipart_request(parts, content_length=None) -> Request:
+    body = b""
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + data + b"\r\n"
+    body += f"--{BOUNDARY}--\r\n".encode()
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+    async def receive():
+        chunk = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    headers = [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())]
+    headers.append((b"content-length", str(content_length or len(body)).encode()))
+    return Request({"type": "http", "method": "POST", "headers": headers}, receive)
+
+def test_receive_file_streams_and_sniffs(tmp_path):
+    store = MediaStore(media_root=tmp_path)
+    request = multipart_request([("caption", None, b"text"), ("file", "../photo.bin", PNG)])
+
+    received = asyncio.run(receive_file(request, store=store))
+
+    assert received.temp_path.read_bytes() == PNG
+    assert received.size == len(PNG)
+    assert received.sha256 == hashlib.sha256(PNG).hexdigest()
+    assert received.content_type == "image/png"
+    assert received.extension == ".png"
+    assert received.message_type == "photo"
+    assert received.filename == "photo.bin"
+
+def test_receive_file_rejects_oversized_body_and_removes_temp_file(tmp_path):
+    store = MediaStore(media_root=tmp_path)
+    request = multipart_request([("file", "big.bin", b"x" * 2048)])
+
+    with pytest.raises(UploadError) as error:
+        asyncio.run(receive_file(request, max_size=1024, store=store))
+
+    assert error.value.status_code == 413
+    assert list(store.temp_dir().iterdir()) == []
+
+def test_receive_file_rejects_declared_oversized_length(tmp_path):
+    store = MediaStore(media_root=tmp_path)
+    request = multipart_request([("file", "big.bin", b"x")], content_length=10 * 1024 * 1024)
+
+    with pytest.raises(UploadError) as error:
+        asyncio.run(receive_file(request, max_size=1024, store=store))
+
+    assert error.value.status_code == 413
+
+def test_receive_file_requires_file_field(tmp_path):
+    store = MediaStore(media_root=tmp_path)
+    request = multipart_request([("caption", None, b"text")])
+
+    with pytest.raises(UploadError) as error:
+        asyncio.run(receive_file(request, store=store))
+
+    assert error.value.status_code == 400
+    assert list(store.temp_dir().iterdir()) == []
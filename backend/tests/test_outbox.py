@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Диспетчер outbox: выборка с сохранением порядка, очереди чатов и retry_after"""
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+
+from outbox import OutboxDispatcher, TokenBucket
+from telegram_api import TelegramAPIError
+
+def make_row(row_id: int, chat_id: str = "100", bot_id: int = 1, attempts: int = 0):
+    return SimpleNamespace(
+        id=row_id, bot_id=bot_id, chat_id=chat_id, method="sendMessage",
+        payload='{"text": "hi"}', ticket_message_id=None, attempts=attempts
+    )
+
+class CapturingSession:
+    """Сессия, которая запоминает выполненные запросы"""
+
+    def __init__(self, statements: list):
+        self.statements = statements
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        return SimpleNamespace(all=lambda: [])
+
+    async def commit(self):
+        pass
+
+class RecordingDispatcher(OutboxDispatcher):
+    """Диспетчер без базы и Telegram: отправки и возвраты в outbox записываются"""
+
+    def __init__(self, retry_ids=()):
+        super().__init__(registry=None, session_factory=None)
+        self.retry_ids = set(retry_ids)
+        self.sent = []
+        self.released = []
+
+    async def _send(self, row):
+        self.sent.append((row.chat_id, row.id))
+        await asyncio.sleep(0)
+        if row.id in self.retry_ids:
+            return datetime.utcnow() + timedelta(seconds=5)
+        return None
+
+    async def _release(self, ids, retry_at):
+        self.released.append(list(ids))
+
+def test_claim_skips_locked_rows_and_waits_for_earlier_messages():
+    statements = []
+    dispatcher = OutboxDispatcher(registry=None, session_factory=lambda: CapturingSession(statements))
+
+    assert asyncio.run(dispatcher._claim(10)) == []
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    assert "FOR UPDATE SKIP LOCKED" in sql
+    assert "ORDER BY outbox_messages.id" in sql
+    # Более раннее отложенное или отправляемое сообщение в тот же чат блокирует выборку
+    assert "NOT (EXISTS" in sql
+    assert "IS NOT DISTINCT FROM outbox_messages.bot_id" in sql
+    assert "outbox_messages_1.id < outbox_messages.id" in sql
+
+def test_chat_messages_are_sent_in_order():
+    dispatcher = RecordingDispatcher()
+
+    async def scenario():
+        dispatcher._dispatch([make_row(1, "100"), make_row(2, "200"), make_row(3, "100"), make_row(4, "200")])
+        await asyncio.gather(*dispatcher._chat_workers.values())
+
+    asyncio.run(scenario())
+    assert [row_id for chat_id, row_id in dispatcher.sent if chat_id == "100"] == [1, 3]
+    assert [row_id for chat_id, row_id in dispatcher.sent if chat_id == "200"] == [2, 4]
+    assert dispatcher._in_flight == 0
+    assert dispatcher._chat_queues == {} and dispatcher._chat_workers == {}
+
+def test_retry_releases_later_messages_of_the_chat():
+    dispatcher = RecordingDispatcher(retry_ids={2})
+
+    async def scenario():
+        dispatcher._dispatch([make_row(1), make_row(2), make_row(3), make_row(4), make_row(5, "200")])
+        await asyncio.gather(*dispatcher._chat_workers.values())
+
+    asyncio.run(scenario())
+    # После отложенного сообщения следующие в этот чат не отправляются, а возвращаются в outbox
+    assert dispatcher.sent == [("100", 1), ("200", 5), ("100", 2)]
+    assert dispatcher.released == [[3, 4]]
+    assert dispatcher._in_flight == 0
+
+def test_retry_after_pauses_buckets_and_keeps_attempts():
+    class FailingClient:
+        async def call(self, method, params, max_attempts=1):
+            raise TelegramAPIError("Too Many Requests", error_code=429, retry_after=30)
+
+    class Registry:
+        async def resolve(self, bot_id):
+            return SimpleNamespace(id=bot_id, client=FailingClient())
+
+    retries = []
+
+    class Dispatcher(OutboxDispatcher):
+        async def _retry(self, row, retry_at, attempts, error):
+            retries.append((row.id, attempts, error))
+
+    dispatcher = Dispatcher(registry=Registry(), session_factory=None)
+    started = datetime.utcnow()
+    retry_at = asyncio.run(dispatcher._send(make_row(7, attempts=3)))
+
+    assert retries == [(7, 3, "Too Many Requests")]
+    assert retry_at - started >= timedelta(seconds=30)
+    now = time.monotonic()
+    assert dispatcher._bot_bucket(1).paused_until > now + 25
+    assert dispatcher._chat_bucket(1, "100").paused_until > now + 25
+
+def test_token_bucket_pause_delays_acquire():
+    bucket = TokenBucket(rate=100, capacity=5)
+
+    async def scenario():
+        await bucket.acquire()
+        bucket.pause(0.05)
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.05
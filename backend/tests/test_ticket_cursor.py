@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""Курсоры keyset-пагинации списка тикетов"""
+
+import base64
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from main import decode_ticket_cursor, encode_ticket_cursor
+
+def test_cursor_roundtrip():
+    sort_value = datetime(2026, 3, 1, 12, 30, 15, 123456)
+    cursor = encode_ticket_cursor(sort_value, 42)
+    assert decode_ticket_cursor(cursor) == (sort_value, 42)
+
+def test_cursor_without_sort_value():
+    assert decode_ticket_cursor(encode_ticket_cursor(None, 7)) == (None, 7)
+
+def test_cursor_is_url_safe():
+    cursor = encode_ticket_cursor(datetime(2026, 3, 1), 10 ** 12)
+    assert not set(cursor) & set("+/")
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b'{"v": null}').decode("ascii"),
+    base64.urlsafe_b64encode(b'{"v": "yesterday", "id": 1}').decode("ascii"),
+    base64.urlsafe_b64encode(b"[1, 2]").decode("ascii"),
+])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_ticket_cursor(cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Ticket Index - Активные тикеты клиентов в памяти процесса ботов
+telegram_user_id -> id активного тикета: сообщение клиента маршрутизируется
+в тикет без запроса к базе. Индекс загружается при подписке на шину событий
+и поддерживается событиями ticket.created / ticket.updated (архивация и смена
+статуса в админке). Пока подписки нет, ответ берется из базы.
+"""
+
+import logging
+import threading
+from typing import Dict, Optional, Set
+
+from sqlalchemy import select
+
+from database import ActiveTicket, AsyncSessionLocal, SessionLocal
+from events import PostgresEventListener, TICKET_CREATED, TICKET_UPDATED
+
+logger = logging.getLogger(__name__)
+
+# Статус, при котором сообщения клиента добавляются в тикет
+ACTIVE_STATUS = "active"
+
+class ActiveTicketIndex:
+    """Индекс активных тикетов по telegram_user_id"""
+
+    def __init__(self, session_factory=SessionLocal, async_session_factory=AsyncSessionLocal):
+        # Загрузка идет в потоке LISTEN (синхронная сессия), запросы ботов - в event loop
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+        self._tickets: Dict[str, int] = {}
+        # Клиенты, чей ответ нужно перечитать из базы (тикет ушел из active)
+        self._unknown: Set[str] = set()
+        self._lock = threading.Lock()
+        self._listener: Optional[PostgresEventListener] = None
+
+    @property
+    def ready(self) -> bool:
+        """Индекс загружен и получает события - ему можно верить"""
+        return self._listener is not None and self._listener.connected.is_set()
+
+    def start(self, listener: Optional[PostgresEventListener] = None):
+        """Подписывается на события тикетов (повторный вызов ничего не делает)
+
+        listener - общее LISTEN-соединение процесса; его владелец сам передает
+        события в handle_event и вызывает warm() при подключении.
+        """
+        if self._listener is not None:
+            return
+        if listener is not None:
+            self._listener = listener
+            return
+        self._listener = PostgresEventListener(self.handle_event, on_connect=self.warm)
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def warm(self):
+        """Загружает все активные тикеты одним запросом"""
+        with self.session_factory() as session:
+            rows = session.query(ActiveTicket.telegram_user_id, ActiveTicket.id).filter(
+                ActiveTicket.status == ACTIVE_STATUS
+            ).order_by(ActiveTicket.id.desc()).all()
+        # При нескольких активных тикетах у клиента берем самый ранний
+        tickets = {telegram_user_id: ticket_id for telegram_user_id, ticket_id in rows}
+        with self._lock:
+            self._tickets = tickets
+            self._unknown = set()
+        logger.info(f"Индекс активных тикетов загружен: {len(tickets)}")
+
+    def handle_event(self, event: dict):
+        """Применяет событие тикета из шины (вызывается в потоке LISTEN)"""
+        if event.get("type") not in (TICKET_CREATED, TICKET_UPDATED):
+            return
+        telegram_user_id = event.get("telegram_user_id")
+        ticket_id = event.get("ticket_id")
+        if not telegram_user_id or ticket_id is None:
+            return
+        if event.get("status") == ACTIVE_STATUS:
+            self.add(telegram_user_id, ticket_id)
+        else:
+            self.remove(telegram_user_id, ticket_id)
+
+    def add(self, telegram_user_id, ticket_id: int):
+        """Запоминает активный тикет клиента"""
+        key = str(telegram_user_id)
+        with self._lock:
+            current = self._tickets.get(key)
+            if current is None or ticket_id < current:
+                self._tickets[key] = ticket_id
+            self._unknown.discard(key)
+
+    def remove(self, telegram_user_id, ticket_id: int):
+        """Тикет больше не активен"""
+        key = str(telegram_user_id)
+        with self._lock:
+            if self._tickets.get(key) == ticket_id:
+                del self._tickets[key]
+                # У клиента может быть еще один активный тикет - уточним при следующем сообщении
+                self._unknown.add(key)
+
+    async def lookup(self, telegram_user_id) -> Optional[int]:
+        """Id активного тикета клиента или None"""
+        key = str(telegram_user_id)
+        if self.ready:
+            with self._lock:
+                if key not in self._unknown:
+                    return self._tickets.get(key)
+
+        async with self.async_session_factory() as session:
+            ticket_id = (await session.execute(
+                select(ActiveTicket.id).where(
+                    ActiveTicket.telegram_user_id == key,
+                    ActiveTicket.status == ACTIVE_STATUS
+                ).order_by(ActiveTicket.id).limit(1)
+            )).scalar()
+
+        if self.ready:
+            with self._lock:
+                if ticket_id is not None:
+                    self._tickets[key] = ticket_id
+                else:
+                    self._tickets.pop(key, None)
+                self._unknown.discard(key)
+        return ticket_id
+
+# Индекс процесса (общий для всех ботов менеджера)
+active_tickets = ActiveTicketIndex()
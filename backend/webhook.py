@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ZAZA Webhook - Прием обновлений Telegram для всех ботов через один HTTP endpoint
+Telegram присылает обновления на POST {WEBHOOK_PATH}/{bot_id} с секретным токеном
+в заголовке; обновление передается в Application нужного бота.
+ASGI-приложение обслуживает менеджер ботов (там живут Application),
+его же можно подключить через mount в другое приложение того же процесса.
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+from typing import Callable, Dict, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+
+from message_writer import message_writer
+
+logger = logging.getLogger(__name__)
+
+# Режим получения обновлений ботами: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный https-адрес, по которому Telegram достучится до endpoint (без пути)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+# Общий секрет, из которого выводится секретный токен каждого бота
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or os.getenv("SECRET_KEY", "")
+
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookOverloaded(Exception):
+    """Обновление сейчас не принять - Telegram повторит доставку позже"""
+
+def webhook_enabled() -> bool:
+    """Включен ли режим webhook (иначе боты работают через polling)"""
+    return BOT_MODE == "webhook" and bool(WEBHOOK_BASE_URL) and bool(WEBHOOK_SECRET)
+
+def webhook_url(bot_id: int) -> str:
+    """Адрес webhook бота для setWebhook"""
+    return f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}/{bot_id}"
+
+def webhook_secret(bot_id: int) -> str:
+    """Секретный токен бота: HMAC общего секрета, в токене допустимы только [A-Za-z0-9_-]"""
+    return hmac.new(WEBHOOK_SECRET.encode("utf-8"), f"bot:{bot_id}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+class WebhookDispatcher:
+    """Applications запущенных ботов по id и прием их обновлений"""
+
+    def __init__(self):
+        self._applications: Dict[int, Application] = {}
+        # Дополнительные данные для health (например, готовность ботов менеджера)
+        self.status_provider: Optional[Callable[[], dict]] = None
+
+    def register(self, bot_id: int, application: Application):
+        """Начинает принимать обновления бота"""
+        self._applications[bot_id] = application
+
+    def unregister(self, bot_id: int):
+        """Прекращает принимать обновления бота"""
+        self._applications.pop(bot_id, None)
+
+    def get(self, bot_id: int) -> Optional[Application]:
+        return self._applications.get(bot_id)
+
+    async def handle_update(self, request: Request) -> Response:
+        try:
+            bot_id = int(request.path_params["bot_id"])
+        except ValueError:
+            return Response(status_code=404)
+
+        # Секрет проверяем до всего остального, чтобы не раскрывать список ботов
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, webhook_secret(bot_id)):
+            logger.warning(f"Webhook бота {bot_id}: неверный секретный токен")
+            return Response(status_code=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+
+        try:
+            delivered = await self.deliver(bot_id, data)
+        except WebhookOverloaded as e:
+            logger.error(f"Webhook бота {bot_id}: {e}")
+            return Response(status_code=503)
+        if not delivered:
+            # Бот остановлен - подтверждаем, чтобы Telegram не повторял доставку
+            logger.warning(f"Webhook бота {bot_id}: бот не запущен, обновление пропущено")
+        return Response(status_code=200)
+
+    async def deliver(self, bot_id: int, data: dict) -> bool:
+        """Передает обновление в Application бота, False - бот не запущен"""
+        application = self._applications.get(bot_id)
+        if application is None:
+            return False
+        update = Update.de_json(data, application.bot)
+        # Обработка идет в очереди Application - ответ Telegram не ждет хэндлеров
+        await application.update_queue.put(update)
+        return True
+
+    async def health(self, request: Request) -> Response:
+        return JSONResponse({
+            "status": "ok",
+            "bots": sorted(self._applications),
+            "message_writer": message_writer.snapshot(),
+            **({"readiness": self.status_provider()} if self.status_provider else {})
+        })
+
+def create_webhook_app(dispatcher: WebhookDispatcher) -> Starlette:
+    """ASGI-приложение с endpoint для обновлений всех ботов"""
+    return Starlette(routes=[
+        Route(WEBHOOK_PATH + "/health", dispatcher.health, methods=["GET"]),
+        Route(WEBHOOK_PATH + "/{bot_id}", dispatcher.handle_update, methods=["POST"]),
+    ])
+
+# Диспетчер процесса
+webhook_dispatcher = WebhookDispatcher()
@@ -220,6 +220,8 @@ async function checkAuth() {
 // Logout function
 function logout() {
     localStorage.removeItem('access_token');
+    // Cookie медиафайлов удаляет сервер; keepalive - запрос переживет переход на страницу входа
+    fetch('/api/logout', { method: 'POST', keepalive: true }).catch(() => {});
     window.location.href = '/static/login.html';
 }
 
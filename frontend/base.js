@@ -389,8 +389,71 @@ function checkAuth() {
     return true;
 }
 
+// Типы событий тикетов по умолчанию
+const TICKET_EVENT_TYPES = ['ticket.created', 'ticket.updated', 'message.created', 'ticket.courier_invited'];
+
+// Подписка на поток событий тикетов (SSE) вместо частого опроса сервера.
+// onEvent(type, data) вызывается на каждое событие; ticketId - только события одного тикета.
+// EventSource сам переподключается при обрыве соединения. Токен в URL не передается
+// (он попал бы в логи): сервер авторизует поток по HttpOnly cookie, которую ставит вход и /api/me.
+// Возвращает объект с методом close() или null, если подписка недоступна.
+function subscribeTicketEvents(onEvent, ticketId = null, eventTypes = TICKET_EVENT_TYPES) {
+    const token = getToken();
+    if (!token || !window.EventSource) {
+        return null;
+    }
+
+    const params = new URLSearchParams();
+    if (ticketId) {
+        params.set('ticket_id', ticketId);
+    }
+
+    const subscription = { source: null, closed: false, cookieRefreshed: false };
+
+    const open = () => {
+        const source = new EventSource(`/api/events?${params}`);
+        eventTypes.forEach(type => {
+            source.addEventListener(type, (event) => {
+                try {
+                    onEvent(type, JSON.parse(event.data));
+                } catch (error) {
+                    console.error('Ошибка обработки события:', error);
+                }
+            });
+        });
+        source.addEventListener('error', async () => {
+            // Ответ 401 закрывает поток насовсем: у сессии, начатой до появления cookie,
+            // ее еще нет - получаем через /api/me и подключаемся один раз заново
+            if (source.readyState !== EventSource.CLOSED || subscription.closed || subscription.cookieRefreshed) {
+                return;
+            }
+            subscription.cookieRefreshed = true;
+            try {
+                const response = await fetch('/api/me', {
+                    headers: { 'Authorization': `Bearer ${getToken()}` }
+                });
+                if (response.ok && !subscription.closed) {
+                    subscription.source = open();
+                }
+            } catch (error) {
+                console.error('Ошибка переподключения к потоку событий:', error);
+            }
+        });
+        return source;
+    };
+
+    subscription.source = open();
+    subscription.close = () => {
+        subscription.closed = true;
+        subscription.source.close();
+    };
+    return subscription;
+}
+
 function logout() {
     localStorage.removeItem('access_token');
+    // Cookie медиафайлов удаляет сервер; keepalive - запрос переживет переход на страницу входа
+    fetch('/api/logout', { method: 'POST', keepalive: true }).catch(() => {});
     window.location.href = '/static/login.html';
 }
 